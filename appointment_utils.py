@@ -1,11 +1,13 @@
 import sqlite3
 
-def create_appointment(name, phone, datetime, notes):
+def create_appointment(name, phone, datetime, notes, service=None):
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
-    c.execute('INSERT INTO appointments (name, phone, datetime, notes) VALUES (?, ?, ?, ?)', (name, phone, datetime, notes))
+    c.execute('INSERT INTO appointments (name, phone, datetime, service, notes) VALUES (?, ?, ?, ?, ?)', (name, phone, datetime, service, notes))
+    appointment_id = c.lastrowid
     conn.commit()
     conn.close()
+    return appointment_id
 
 def get_appointments():
     conn = sqlite3.connect('appointments.db')
@@ -0,0 +1,377 @@
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from caller_utils import normalize_e164
+
+# Retention for call_logs. Calls older than the policy's keep_days are moved
+# out of appointments.db into gzip NDJSON files, one per day of calls
+# (ARCHIVE_DIR/2024/call_logs-2024-03-05.ndjson.gz). Each run appends a new
+# gzip member, which gzip readers treat as one continuous file.
+#
+# A small index (ARCHIVE_DIR/index.db) holds one row per archived call, with
+# everything except the transcript, and one row per partition. Lookups by
+# phone or date only read the index. Fetching a transcript decompresses that
+# one day's file.
+#
+# Order per batch: write the partition file, commit the index, then delete
+# the rows from call_logs (and the transcripts in their change events). A crash part way through leaves a call in both
+# places, never in neither; re-running is safe because lookups stop at the
+# first copy. The freed pages are returned to the filesystem a few at a time
+# with PRAGMA incremental_vacuum, so the main database is never locked for a
+# full VACUUM.
+#
+# Dashboard rollups are left alone: they count calls ever made (see stats_utils).
+# A rollup rebuild adds the archived calls back from the index.
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'call_archive')
+CALL_LOG_RETENTION_DAYS = int(os.getenv('CALL_LOG_RETENTION_DAYS', '365'))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv('ARCHIVE_INTERVAL_HOURS', '6'))
+
+CALL_COLUMNS = ['id', 'call_id', 'phone_number', 'user_name', 'conversation_data',
+                'intent', 'sentiment', 'duration_seconds', 'created_at']
+
+def init_archive_tables(conn):
+    """Create the retention policy table and the call_logs age index"""
+    c = conn.cursor()
+    c.execute('CREATE INDEX IF NOT EXISTS idx_call_logs_created_at ON call_logs (created_at)')
+    c.execute('''CREATE TABLE IF NOT EXISTS retention_policies (
+        table_name TEXT PRIMARY KEY,
+        keep_days INTEGER NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    # keep_days = 0 keeps everything in the main database
+    c.execute('INSERT OR IGNORE INTO retention_policies (table_name, keep_days) VALUES (?, ?)',
+              ('call_logs', CALL_LOG_RETENTION_DAYS))
+
+def _connect_index():
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(ARCHIVE_DIR, 'index.db'))
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS archived_calls (
+        call_id TEXT PRIMARY KEY,
+        id INTEGER,
+        phone_number TEXT,
+        phone_key TEXT,
+        user_name TEXT,
+        intent TEXT,
+        sentiment TEXT,
+        duration_seconds INTEGER,
+        created_at TEXT,
+        partition TEXT
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_archived_calls_phone ON archived_calls (phone_key, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_archived_calls_created_at ON archived_calls (created_at)')
+    c.execute('''CREATE TABLE IF NOT EXISTS archive_partitions (
+        partition TEXT PRIMARY KEY,
+        day TEXT,
+        calls INTEGER,
+        bytes INTEGER,
+        updated_at TEXT
+    )''')
+    return conn
+
+def archived_call_rollups(conn):
+    """(day, intent, sentiment, calls, total_duration) for archived calls that are no longer in call_logs"""
+    if not os.path.exists(os.path.join(ARCHIVE_DIR, 'index.db')):
+        return []
+    index = _connect_index()
+    ic = index.cursor()
+    ic.execute('SELECT MAX(created_at) FROM archived_calls')
+    newest = ic.fetchone()[0]
+    rows = []
+    if newest is not None:
+        # A crash between indexing and deleting can leave a call in both places
+        c = conn.cursor()
+        c.execute('SELECT id FROM call_logs WHERE created_at <= ?', (newest,))
+        both = json.dumps([row[0] for row in c.fetchall()])
+        ic.execute('''SELECT date(coalesce(created_at, 'now')), coalesce(intent, 'unknown'), coalesce(sentiment, 'neutral'),
+                             COUNT(*), coalesce(SUM(duration_seconds), 0)
+                      FROM archived_calls WHERE id NOT IN (SELECT value FROM json_each(?)) GROUP BY 1, 2, 3''', (both,))
+        rows = ic.fetchall()
+    index.close()
+    return rows
+
+def _partition_for(created_at):
+    day = (created_at or '')[:10]
+    try:
+        datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        return 'undated', 'call_logs-undated.ndjson.gz'
+    return day, f"{day[:4]}/call_logs-{day}.ndjson.gz"
+
+def _partition_path(partition):
+    """File path of a partition, or None for a name that points outside ARCHIVE_DIR"""
+    path = os.path.normpath(os.path.join(ARCHIVE_DIR, partition))
+    if not path.startswith(os.path.normpath(ARCHIVE_DIR) + os.sep):
+        return None
+    return path
+
+def _call_record(row):
+    record = dict(zip(CALL_COLUMNS, row))
+    record['conversation_data'] = json.loads(record['conversation_data']) if record['conversation_data'] else []
+    return record
+
+def get_retention_days():
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute("SELECT keep_days FROM retention_policies WHERE table_name = 'call_logs'")
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else CALL_LOG_RETENTION_DAYS
+
+def set_retention_days(keep_days):
+    keep_days = int(keep_days)
+    if keep_days < 0:
+        raise ValueError("keep_days must be 0 (keep everything) or more")
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('''INSERT INTO retention_policies (table_name, keep_days) VALUES ('call_logs', ?)
+                 ON CONFLICT (table_name) DO UPDATE SET keep_days = excluded.keep_days, updated_at = CURRENT_TIMESTAMP''',
+              (keep_days,))
+    conn.commit()
+    conn.close()
+
+# --- Incremental vacuum ---
+
+def incremental_vacuum(max_pages=20000, step=500, pause=0.05):
+    """Release up to max_pages free pages, `step` pages per short write transaction"""
+    conn = sqlite3.connect('appointments.db', timeout=30)
+    c = conn.cursor()
+    c.execute('PRAGMA auto_vacuum')
+    if c.fetchone()[0] != 2:
+        conn.close()
+        return 0
+    released = 0
+    c.execute('PRAGMA freelist_count')
+    free = c.fetchone()[0]
+    while free and released < max_pages:
+        # executescript steps the pragma to completion; execute() would free a single page
+        conn.executescript(f'PRAGMA incremental_vacuum({min(step, max_pages - released)});')
+        c.execute('PRAGMA freelist_count')
+        remaining = c.fetchone()[0]
+        if remaining >= free:
+            break
+        released += free - remaining
+        free = remaining
+        time.sleep(pause)
+    conn.close()
+    return released
+
+def enable_incremental_vacuum():
+    """Switch an existing database to auto_vacuum=INCREMENTAL (one full VACUUM; locks the database while it runs)"""
+    conn = sqlite3.connect('appointments.db', timeout=30)
+    c = conn.cursor()
+    c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    c.execute('VACUUM')
+    c.execute('PRAGMA auto_vacuum')
+    mode = c.fetchone()[0]
+    conn.close()
+    return mode == 2
+
+# --- Archiving ---
+
+class CallLogArchiver:
+    """Moves expired call logs to the archive on a timer or on demand"""
+
+    def __init__(self, batch_size=1000, pause=0.1):
+        self.batch_size = batch_size
+        self.pause = pause          # between batches, so live writes get the lock
+        self.run_lock = threading.Lock()
+        self.thread = None
+        self.last_run = None
+
+    def run(self, keep_days=None, vacuum_pages=20000):
+        """Archive calls older than keep_days (default: the stored policy); returns a summary"""
+        keep_days = get_retention_days() if keep_days is None else int(keep_days)
+        if keep_days <= 0:
+            return {"status": "skipped", "reason": "retention disabled (keep_days = 0)"}
+        if not self.run_lock.acquire(blocking=False):
+            return {"status": "skipped", "reason": "an archive run is already in progress"}
+        try:
+            started = time.time()
+            # created_at is CURRENT_TIMESTAMP, i.e. UTC
+            cutoff = (datetime.utcnow() - timedelta(days=keep_days)).strftime('%Y-%m-%d 00:00:00')
+            archived = 0
+            partitions = set()
+            while True:
+                moved, touched = self._archive_batch(cutoff)
+                if not moved:
+                    break
+                archived += moved
+                partitions |= touched
+                time.sleep(self.pause)
+            pages = incremental_vacuum(max_pages=vacuum_pages)
+            self.last_run = {
+                "status": "success",
+                "keep_days": keep_days,
+                "cutoff": cutoff,
+                "archived_calls": archived,
+                "partitions_written": sorted(partitions),
+                "pages_released": pages,
+                "seconds": round(time.time() - started, 2),
+                "finished_at": datetime.now().isoformat(timespec='seconds')
+            }
+            if archived:
+                print(f"[Archive] Moved {archived} call logs older than {cutoff} into {len(partitions)} partitions; released {pages} pages")
+            return self.last_run
+        finally:
+            self.run_lock.release()
+
+    def _archive_batch(self, cutoff):
+        conn = sqlite3.connect('appointments.db', timeout=30)
+        c = conn.cursor()
+        c.execute(f'''SELECT {', '.join(CALL_COLUMNS)} FROM call_logs
+                      WHERE created_at < ? ORDER BY created_at, id LIMIT ?''', (cutoff, self.batch_size))
+        rows = c.fetchall()
+        if not rows:
+            conn.close()
+            return 0, set()
+
+        by_partition = {}
+        for row in rows:
+            day, partition = _partition_for(row[8])
+            by_partition.setdefault((day, partition), []).append(row)
+
+        # 1. Append to the partition files
+        index = _connect_index()
+        ic = index.cursor()
+        for (day, partition), part_rows in by_partition.items():
+            path = _partition_path(partition)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                    for row in part_rows:
+                        f.write(json.dumps(_call_record(row), ensure_ascii=False).encode('utf-8') + b'\n')
+                raw.flush()
+                os.fsync(raw.fileno())
+
+            # 2. Index them
+            ic.executemany('''INSERT OR REPLACE INTO archived_calls
+                              (call_id, id, phone_number, phone_key, user_name, intent, sentiment, duration_seconds, created_at, partition)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                           [(row[1] or f"id-{row[0]}", row[0], row[2], normalize_e164(row[2]), row[3],
+                             row[5], row[6], row[7], row[8], partition) for row in part_rows])
+            ic.execute('''INSERT OR REPLACE INTO archive_partitions (partition, day, calls, bytes, updated_at)
+                          VALUES (?, ?, (SELECT COUNT(*) FROM archived_calls WHERE partition = ?), ?, ?)''',
+                       (partition, day, partition, os.path.getsize(path), datetime.now().isoformat(timespec='seconds')))
+        index.commit()
+        index.close()
+
+        # 3. Drop them from the main database, including the transcript copies
+        # in their change events (the events stay so event ids remain contiguous)
+        ids = json.dumps([row[0] for row in rows])
+        c.execute('DELETE FROM call_logs WHERE id IN (SELECT value FROM json_each(?))', (ids,))
+        c.execute('''UPDATE change_events SET payload = json_object('id', entity_id, 'archived', 1)
+                     WHERE entity = 'call' AND entity_id IN (SELECT value FROM json_each(?))''', (ids,))
+        conn.commit()
+        conn.close()
+        return len(rows), {partition for _, partition in by_partition}
+
+    # --- Scheduling ---
+
+    def start(self, interval_hours=ARCHIVE_INTERVAL_HOURS, first_delay=60):
+        """Run the retention policy every interval_hours on a background thread"""
+        if not interval_hours or (self.thread and self.thread.is_alive()):
+            return
+        self.thread = threading.Thread(target=self._loop, args=(interval_hours * 3600, first_delay),
+                                       daemon=True, name='call-archiver')
+        self.thread.start()
+
+    def _loop(self, interval, first_delay):
+        time.sleep(first_delay)
+        while True:
+            try:
+                self.run()
+            except Exception as e:
+                print(f"[Archive] Retention run failed: {e}")
+            time.sleep(interval)
+
+    # --- Lookups ---
+
+    def find(self, phone=None, start=None, end=None, limit=50):
+        """Archived calls (without transcripts) by caller and/or created_at range, newest first"""
+        if not os.path.exists(os.path.join(ARCHIVE_DIR, 'index.db')):
+            return []
+        clauses, params = [], []
+        if phone:
+            clauses.append('phone_key = ?')
+            params.append(normalize_e164(phone))
+        if start:
+            clauses.append('created_at >= ?')
+            params.append(start)
+        if end:
+            clauses.append('created_at < ?')
+            params.append(end)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        index = _connect_index()
+        c = index.cursor()
+        c.execute(f'''SELECT id, call_id, phone_number, user_name, intent, sentiment, duration_seconds, created_at, partition
+                      FROM archived_calls {where} ORDER BY created_at DESC LIMIT ?''', params + [limit])
+        rows = c.fetchall()
+        index.close()
+        return [
+            {
+                "id": row[0],
+                "call_id": row[1],
+                "phone_number": row[2],
+                "user_name": row[3],
+                "intent": row[4],
+                "sentiment": row[5],
+                "duration_seconds": row[6],
+                "created_at": row[7],
+                "partition": row[8]
+            }
+            for row in rows
+        ]
+
+    def get(self, call_id):
+        """Full archived call including its transcript, or None"""
+        if not os.path.exists(os.path.join(ARCHIVE_DIR, 'index.db')):
+            return None
+        index = _connect_index()
+        c = index.cursor()
+        c.execute('SELECT partition FROM archived_calls WHERE call_id = ?', (call_id,))
+        row = c.fetchone()
+        index.close()
+        path = _partition_path(row[0]) if row else None
+        if not path or not os.path.exists(path):
+            return None
+        needle = json.dumps(call_id)
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                # Cheap substring test before parsing
+                if needle in line:
+                    record = json.loads(line)
+                    if record.get('call_id') == call_id:
+                        return record
+        return None
+
+    def stats(self):
+        summary = {"keep_days": get_retention_days(), "archive_dir": ARCHIVE_DIR,
+                   "partitions": 0, "archived_calls": 0, "archive_bytes": 0, "last_run": self.last_run}
+        if os.path.exists(os.path.join(ARCHIVE_DIR, 'index.db')):
+            index = _connect_index()
+            c = index.cursor()
+            c.execute('SELECT COUNT(*), COALESCE(SUM(calls), 0), COALESCE(SUM(bytes), 0) FROM archive_partitions')
+            summary["partitions"], summary["archived_calls"], summary["archive_bytes"] = c.fetchone()
+            index.close()
+        conn = sqlite3.connect('appointments.db')
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) FROM call_logs')
+        summary["hot_calls"] = c.fetchone()[0]
+        c.execute('PRAGMA auto_vacuum')
+        summary["incremental_vacuum"] = c.fetchone()[0] == 2
+        c.execute('PRAGMA freelist_count')
+        summary["free_pages"] = c.fetchone()[0]
+        c.execute('PRAGMA page_count')
+        page_count = c.fetchone()[0]
+        c.execute('PRAGMA page_size')
+        summary["database_bytes"] = page_count * c.fetchone()[0]
+        conn.close()
+        return summary
+
+call_archive = CallLogArchiver()
@@ -0,0 +1,101 @@
+import io
+import threading
+import wave
+import numpy as np
+import ffmpeg
+from stream_utils import resample
+
+# In-memory audio decoding for transcription. Uploaded or recorded audio is
+# decoded straight from bytes: 16-bit PCM WAV with numpy, anything else
+# through a single ffmpeg pipe (stdin -> stdout), resampled once to 16 kHz
+# mono float32. Nothing is written to disk.
+
+SAMPLE_RATE = 16000
+CHUNK_SECONDS = 30
+
+def read_audio_input(audio):
+    """Bytes from bytes/bytearray/memoryview, a binary file-like object, or a path"""
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        return bytes(audio)
+    if hasattr(audio, 'read'):
+        return audio.read()
+    with open(audio, 'rb') as f:
+        return f.read()
+
+def _decode_wav(data, sr):
+    with wave.open(io.BytesIO(data), 'rb') as wav:
+        if wav.getsampwidth() != 2 or wav.getcomptype() != 'NONE':
+            return None
+        rate = wav.getframerate()
+        channels = wav.getnchannels()
+        frames = wav.readframes(wav.getnframes())
+    samples = np.frombuffer(frames, dtype=np.int16).astype(np.float32) / 32768.0
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    return resample(samples, rate, sr)
+
+def iter_decoded_chunks(data, sr=SAMPLE_RATE, chunk_seconds=CHUNK_SECONDS):
+    """Decode audio bytes with ffmpeg and yield float32 chunks as they are produced"""
+    process = (
+        ffmpeg
+        .input('pipe:0')
+        .output('pipe:1', format='s16le', acodec='pcm_s16le', ac=1, ar=sr)
+        .global_args('-loglevel', 'error', '-nostdin')
+        .run_async(pipe_stdin=True, pipe_stdout=True)
+    )
+
+    def feed():
+        try:
+            process.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            pass
+        finally:
+            process.stdin.close()
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    chunk_bytes = int(sr * chunk_seconds) * 2
+    try:
+        while True:
+            raw = process.stdout.read(chunk_bytes)
+            if not raw:
+                break
+            yield np.frombuffer(raw[:len(raw) - len(raw) % 2], dtype=np.int16).astype(np.float32) / 32768.0
+    finally:
+        process.stdout.close()
+        writer.join()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to decode audio (exit code {process.returncode})")
+
+def decode_audio(audio, sr=SAMPLE_RATE):
+    """Decode bytes, a buffer, or a path into mono float32 samples at `sr`"""
+    if isinstance(audio, np.ndarray):
+        return audio.astype(np.float32)
+    data = read_audio_input(audio)
+    if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+        try:
+            samples = _decode_wav(data, sr)
+            if samples is not None:
+                return samples
+        except (wave.Error, EOFError):
+            pass
+    chunks = list(iter_decoded_chunks(data, sr))
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+
+def split_on_silence(samples, sr=SAMPLE_RATE, chunk_seconds=CHUNK_SECONDS, search_seconds=2.0):
+    """Split long audio into <= chunk_seconds pieces, cutting at the quietest
+    100 ms window near each boundary so words are not cut in half"""
+    max_len = int(chunk_seconds * sr)
+    window = sr // 10
+    search = int(search_seconds * sr)
+    chunks = []
+    start = 0
+    while len(samples) - start > max_len:
+        end = start + max_len
+        region = samples[end - search:end]
+        energy = np.convolve(region * region, np.ones(window), mode='valid')
+        cut = end - search + int(np.argmin(energy)) + window // 2
+        chunks.append(samples[start:cut])
+        start = cut
+    chunks.append(samples[start:])
+    return [c for c in chunks if len(c)]
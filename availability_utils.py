@@ -0,0 +1,493 @@
+import bisect
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from events_utils import latest_event_id, read_events_since
+from import_utils import normalize_datetime
+
+# Slot availability. Each provider's scheduled appointments are kept in a
+# sorted interval list, so a conflict check is two binary searches plus the
+# handful of overlapping bookings, and free-slot queries walk the provider's
+# working hours checking each slot the same way. The index is built once
+# from `appointments` and then kept current from change_events (written by
+# triggers on every appointment insert/update/delete, from any process), so
+# it never rescans the table. Weekly working hours live in provider_schedules.
+
+DEFAULT_DURATION = 30
+DEFAULT_PROVIDER = 'default'
+SCHEDULE_REFRESH_SECONDS = 60
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+def init_availability_tables(conn):
+    """Add provider/duration to appointments and create provider_schedules"""
+    c = conn.cursor()
+    c.execute('PRAGMA table_info(appointments)')
+    columns = {row[1] for row in c.fetchall()}
+    if 'provider' not in columns:
+        c.execute('ALTER TABLE appointments ADD COLUMN provider TEXT')
+    if 'duration_minutes' not in columns:
+        c.execute('ALTER TABLE appointments ADD COLUMN duration_minutes INTEGER')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_appointments_datetime ON appointments (datetime)')
+
+    # One row per provider, service and weekday (0 = Monday). A NULL service
+    # means the provider offers every service.
+    c.execute('''CREATE TABLE IF NOT EXISTS provider_schedules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        provider TEXT NOT NULL,
+        service TEXT,
+        weekday INTEGER NOT NULL,
+        start_time TEXT NOT NULL,
+        end_time TEXT NOT NULL,
+        slot_minutes INTEGER DEFAULT 30,
+        capacity INTEGER DEFAULT 1
+    )''')
+    c.execute('SELECT COUNT(*) FROM provider_schedules')
+    if c.fetchone()[0] == 0:
+        # Default: one provider, any service, weekdays 9 to 5
+        c.executemany('''INSERT INTO provider_schedules (provider, service, weekday, start_time, end_time)
+                         VALUES (?, NULL, ?, '09:00', '17:00')''',
+                      [(DEFAULT_PROVIDER, day) for day in range(5)])
+
+def parse_appointment_time(value):
+    """Stored/submitted datetime string -> datetime, or None for free text"""
+    try:
+        return datetime.strptime(normalize_datetime(value), '%Y-%m-%d %H:%M:%S')
+    except (ValueError, TypeError):
+        return None
+
+def _clock(day, hhmm):
+    hours, minutes = hhmm.split(':')
+    return datetime.combine(day, datetime.min.time()).replace(hour=int(hours), minute=int(minutes))
+
+def _service_key(service):
+    return (service or '').strip().lower()
+
+class SlotUnavailable(Exception):
+    """The requested slot is taken or outside working hours"""
+
+    def __init__(self, message, alternatives=None):
+        super().__init__(message)
+        self.alternatives = alternatives or []
+
+class IntervalIndex:
+    """Bookings for one provider as (start, end, appointment_id), sorted by start"""
+
+    def __init__(self):
+        self.items = []
+        self.by_id = {}
+        self.max_length = timedelta(0)
+
+    def add(self, appointment_id, start, end):
+        bisect.insort(self.items, (start, end, appointment_id))
+        self.by_id[appointment_id] = (start, end)
+        self.max_length = max(self.max_length, end - start)
+
+    def remove(self, appointment_id):
+        interval = self.by_id.pop(appointment_id, None)
+        if interval is None:
+            return
+        i = bisect.bisect_left(self.items, (interval[0], interval[1], appointment_id))
+        if i < len(self.items) and self.items[i][2] == appointment_id:
+            del self.items[i]
+
+    def overlapping(self, start, end):
+        """Bookings that overlap [start, end)"""
+        # Anything overlapping must start after start - max_length and before end
+        lo = bisect.bisect_left(self.items, (start - self.max_length,))
+        hi = bisect.bisect_left(self.items, (end,))
+        return [item for item in self.items[lo:hi] if item[1] > start]
+
+    def __len__(self):
+        return len(self.items)
+
+class AvailabilityEngine:
+    """Per-provider interval indexes plus weekly schedules"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.indexes = {}
+        self.providers_by_id = {}
+        self.schedules = []
+        self.schedules_loaded_at = 0
+        self.last_event_id = None
+
+    # --- Index maintenance ---
+
+    def _index_row(self, appointment_id, start_value, duration, provider, status):
+        self._unindex(appointment_id)
+        if status != 'scheduled':
+            return
+        start = parse_appointment_time(start_value)
+        if start is None:
+            # Free-text times (e.g. from older dialog bookings) cannot be placed
+            return
+        provider = provider or DEFAULT_PROVIDER
+        end = start + timedelta(minutes=duration or DEFAULT_DURATION)
+        self.indexes.setdefault(provider, IntervalIndex()).add(appointment_id, start, end)
+        self.providers_by_id[appointment_id] = provider
+
+    def _unindex(self, appointment_id):
+        provider = self.providers_by_id.pop(appointment_id, None)
+        if provider is not None:
+            self.indexes[provider].remove(appointment_id)
+
+    def rebuild(self):
+        """Build every index from the appointments table"""
+        with self.lock:
+            # Read the event cursor first so writes made during the scan are replayed
+            last_event_id = latest_event_id()
+            conn = sqlite3.connect('appointments.db')
+            c = conn.cursor()
+            c.execute('''SELECT id, datetime, duration_minutes, provider, status
+                         FROM appointments WHERE status = 'scheduled' ''')
+            rows = c.fetchall()
+            conn.close()
+            self.indexes = {}
+            self.providers_by_id = {}
+            for row in rows:
+                self._index_row(*row)
+            self.last_event_id = last_event_id
+            self._load_schedules()
+
+    def sync(self):
+        """Apply appointment changes recorded since the last sync"""
+        with self.lock:
+            if self.last_event_id is None:
+                self.rebuild()
+                return
+            if time.time() - self.schedules_loaded_at > SCHEDULE_REFRESH_SECONDS:
+                self._load_schedules()
+            while True:
+                events, _ = read_events_since(self.last_event_id)
+                if events and events[0]['id'] != self.last_event_id + 1:
+                    # Events we have not seen were pruned
+                    self.rebuild()
+                    return
+                ids = {e['entity_id'] for e in events if e['entity'] == 'appointment'}
+                if ids:
+                    self._refresh_ids(ids)
+                if events:
+                    self.last_event_id = events[-1]['id']
+                if len(events) < 500:
+                    return
+
+    def _refresh_ids(self, ids):
+        conn = sqlite3.connect('appointments.db')
+        c = conn.cursor()
+        placeholders = ','.join('?' * len(ids))
+        c.execute(f'''SELECT id, datetime, duration_minutes, provider, status
+                      FROM appointments WHERE id IN ({placeholders})''', list(ids))
+        rows = {row[0]: row for row in c.fetchall()}
+        conn.close()
+        for appointment_id in ids:
+            if appointment_id in rows:
+                self._index_row(*rows[appointment_id])
+            else:
+                self._unindex(appointment_id)
+
+    def _load_schedules(self):
+        conn = sqlite3.connect('appointments.db')
+        c = conn.cursor()
+        c.execute('''SELECT provider, service, weekday, start_time, end_time, slot_minutes, capacity
+                     FROM provider_schedules ORDER BY provider, weekday, start_time''')
+        self.schedules = [
+            {
+                'provider': row[0],
+                'service': row[1],
+                'weekday': row[2],
+                'start_time': row[3],
+                'end_time': row[4],
+                'slot_minutes': row[5] or DEFAULT_DURATION,
+                'capacity': row[6] or 1
+            }
+            for row in c.fetchall()
+        ]
+        conn.close()
+        self.schedules_loaded_at = time.time()
+
+    # --- Queries ---
+
+    def _windows(self, day, service=None, provider=None):
+        """Working-hour windows on a date as (provider, start, end, schedule)"""
+        key = _service_key(service)
+        windows = []
+        for schedule in self.schedules:
+            if schedule['weekday'] != day.weekday():
+                continue
+            if provider and schedule['provider'] != provider:
+                continue
+            if key and schedule['service'] and _service_key(schedule['service']) != key:
+                continue
+            windows.append((schedule['provider'], _clock(day, schedule['start_time']),
+                            _clock(day, schedule['end_time']), schedule))
+        return windows
+
+    def providers(self, service=None):
+        """Providers with working hours for a service"""
+        key = _service_key(service)
+        return sorted({s['provider'] for s in self.schedules
+                       if not key or not s['service'] or _service_key(s['service']) == key})
+
+    def conflicts(self, provider, start, end, exclude_id=None):
+        """Appointment ids of the provider's bookings overlapping [start, end)"""
+        index = self.indexes.get(provider)
+        if not index:
+            return []
+        return [item[2] for item in index.overlapping(start, end) if item[2] != exclude_id]
+
+    def _free_provider(self, start, end, service=None, provider=None, exclude_id=None, within_schedule=True):
+        """First provider that can take [start, end), or None"""
+        for name, window_start, window_end, schedule in self._windows(start.date(), service, provider):
+            if window_start <= start and end <= window_end and \
+                    len(self.conflicts(name, start, end, exclude_id)) < schedule['capacity']:
+                return name
+        if not within_schedule:
+            # Outside working hours (admin bookings): only the overlap check applies
+            candidates = [provider] if provider else (self.providers(service) or [DEFAULT_PROVIDER])
+            for name in candidates:
+                if not self.conflicts(name, start, end, exclude_id):
+                    return name
+        return None
+
+    def duration_for(self, start, service=None, provider=None):
+        for _, _, _, schedule in self._windows(start.date(), service, provider):
+            return schedule['slot_minutes']
+        return DEFAULT_DURATION
+
+    def check(self, start, service=None, provider=None, duration=None, exclude_id=None, within_schedule=True):
+        """Whether a slot can be booked: {available, provider, conflicts, alternatives}"""
+        with self.lock:
+            self.sync()
+            duration = duration or self.duration_for(start, service, provider)
+            end = start + timedelta(minutes=duration)
+            free = self._free_provider(start, end, service, provider, exclude_id, within_schedule)
+            if free:
+                return {"available": True, "provider": free, "conflicts": [], "alternatives": []}
+            names = [provider] if provider else (self.providers(service) or [DEFAULT_PROVIDER])
+            conflicts = sorted({i for name in names for i in self.conflicts(name, start, end, exclude_id)})
+            return {
+                "available": False,
+                "provider": None,
+                "conflicts": conflicts,
+                "alternatives": self.nearest_slots(start, service, provider, duration)
+            }
+
+    def free_slots(self, start, end, service=None, provider=None, duration=None, limit=20):
+        """Free slots between two datetimes, earliest first"""
+        with self.lock:
+            self.sync()
+            now = datetime.now()
+            slots = []
+            day = start.date()
+            while day <= end.date() and len(slots) < limit:
+                day_slots = []
+                for name, window_start, window_end, schedule in self._windows(day, service, provider):
+                    length = timedelta(minutes=duration or schedule['slot_minutes'])
+                    step = timedelta(minutes=schedule['slot_minutes'])
+                    t = window_start
+                    while t + length <= window_end:
+                        if t >= start and t + length <= end and t >= now and \
+                                len(self.conflicts(name, t, t + length)) < schedule['capacity']:
+                            day_slots.append({"start": t, "end": t + length, "provider": name})
+                        t += step
+                day_slots.sort(key=lambda s: (s['start'], s['provider']))
+                # One entry per start time when several providers are free
+                seen = set()
+                for slot in day_slots:
+                    if slot['start'] not in seen:
+                        seen.add(slot['start'])
+                        slots.append(slot)
+                day += timedelta(days=1)
+            return [
+                {
+                    "start": s['start'].strftime('%Y-%m-%d %H:%M:%S'),
+                    "end": s['end'].strftime('%Y-%m-%d %H:%M:%S'),
+                    "provider": s['provider']
+                }
+                for s in slots[:limit]
+            ]
+
+    def nearest_slots(self, start, service=None, provider=None, duration=None, count=3, days=7):
+        """Free slots closest to a requested time (same day first, then the following days)"""
+        day_start = datetime.combine(start.date(), datetime.min.time())
+        same_day = self.free_slots(day_start, day_start + timedelta(days=1), service, provider, duration, limit=100)
+        same_day.sort(key=lambda s: abs((datetime.strptime(s['start'], '%Y-%m-%d %H:%M:%S') - start).total_seconds()))
+        slots = same_day[:count]
+        if len(slots) < count:
+            later = self.free_slots(day_start + timedelta(days=1), day_start + timedelta(days=days), service,
+                                    provider, duration, limit=count - len(slots))
+            slots.extend(later)
+        return sorted(slots, key=lambda s: s['start'])
+
+    # --- Booking ---
+
+    def book(self, name, phone, start, service=None, notes='', provider=None, duration=None, within_schedule=True):
+        """Insert an appointment if its slot is free; raises SlotUnavailable otherwise"""
+        with self.lock:
+            result = self.check(start, service, provider, duration, within_schedule=within_schedule)
+            if not result['available']:
+                raise SlotUnavailable("That time is not available", result['alternatives'])
+            provider = result['provider']
+            duration = duration or self.duration_for(start, service, provider)
+            end = start + timedelta(minutes=duration)
+            conn = sqlite3.connect('appointments.db', isolation_level=None)
+            c = conn.cursor()
+            try:
+                # Re-check inside a write transaction so another process cannot
+                # take the slot between the index check and the insert
+                c.execute('BEGIN IMMEDIATE')
+                c.execute('''SELECT datetime, duration_minutes, provider FROM appointments
+                             WHERE datetime >= ? AND datetime < ? AND status = 'scheduled' ''',
+                          ((start - self._max_length(provider)).strftime('%Y-%m-%d %H:%M:%S'),
+                           end.strftime('%Y-%m-%d %H:%M:%S')))
+                capacity = self._capacity(start, end, service, provider)
+                overlapping = 0
+                for value, minutes, other_provider in c.fetchall():
+                    other = parse_appointment_time(value)
+                    if (other_provider or DEFAULT_PROVIDER) == provider and other and \
+                            other + timedelta(minutes=minutes or DEFAULT_DURATION) > start:
+                        overlapping += 1
+                if overlapping >= capacity:
+                    c.execute('ROLLBACK')
+                    raise SlotUnavailable("That time was just booked",
+                                          self.nearest_slots(start, service, provider, duration))
+                c.execute('''INSERT INTO appointments (name, phone, datetime, service, notes, provider, duration_minutes)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                          (name, phone, start.strftime('%Y-%m-%d %H:%M:%S'), service, notes, provider, duration))
+                appointment_id = c.lastrowid
+                c.execute('COMMIT')
+            except sqlite3.Error:
+                c.execute('ROLLBACK')
+                raise
+            finally:
+                conn.close()
+            self.sync()
+            return {"id": appointment_id, "provider": provider, "datetime": start.strftime('%Y-%m-%d %H:%M:%S'),
+                    "duration_minutes": duration}
+
+    def _max_length(self, provider):
+        index = self.indexes.get(provider)
+        return max(index.max_length if index else timedelta(0), timedelta(minutes=DEFAULT_DURATION))
+
+    def _capacity(self, start, end, service, provider):
+        for name, window_start, window_end, schedule in self._windows(start.date(), service, provider):
+            if window_start <= start and end <= window_end:
+                return schedule['capacity']
+        return 1
+
+    def set_schedule(self, provider, entries):
+        """Replace a provider's weekly hours: entries of {weekday, start_time, end_time, service, slot_minutes, capacity}"""
+        for e in entries:
+            if not (0 <= int(e['weekday']) <= 6):
+                raise ValueError(f"weekday must be 0-6, got {e['weekday']}")
+            for key in ('start_time', 'end_time'):
+                if not re.fullmatch(r'([01]\d|2[0-3]):[0-5]\d', str(e[key])):
+                    raise ValueError(f"{key} must be HH:MM, got {e[key]}")
+        conn = sqlite3.connect('appointments.db')
+        c = conn.cursor()
+        c.execute('DELETE FROM provider_schedules WHERE provider = ?', (provider,))
+        c.executemany('''INSERT INTO provider_schedules (provider, service, weekday, start_time, end_time, slot_minutes, capacity)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                      [(provider, e.get('service'), int(e['weekday']), e['start_time'], e['end_time'],
+                        int(e.get('slot_minutes') or DEFAULT_DURATION), int(e.get('capacity') or 1))
+                       for e in entries])
+        conn.commit()
+        conn.close()
+        with self.lock:
+            self._load_schedules()
+
+    def get_schedules(self):
+        with self.lock:
+            self._load_schedules()
+            return list(self.schedules)
+
+availability = AvailabilityEngine()
+
+# --- Spoken date/time parsing for the voice dialog ---
+
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+          'august', 'september', 'october', 'november', 'december']
+PARTS_OF_DAY = {'morning': (9, 12), 'afternoon': (12, 17), 'evening': (17, 21)}
+
+def _spoken_day(text, now):
+    if 'day after tomorrow' in text:
+        return (now + timedelta(days=2)).date()
+    if 'tomorrow' in text:
+        return (now + timedelta(days=1)).date()
+    if 'today' in text or 'tonight' in text:
+        return now.date()
+    for i, name in enumerate(WEEKDAYS):
+        if re.search(rf'\b{name}\b', text):
+            ahead = (i - now.weekday()) % 7
+            if ahead == 0 or re.search(rf'\bnext {name}\b', text):
+                ahead = ahead or 7
+            return (now + timedelta(days=ahead)).date()
+    for i, name in enumerate(MONTHS):
+        match = re.search(rf'\b(\d{{1,2}})(?:st|nd|rd|th)? (?:of )?{name[:3]}[a-z]*\b', text) or \
+                re.search(rf'\b{name[:3]}[a-z]*\.? (\d{{1,2}})(?:st|nd|rd|th)?\b', text)
+        if match:
+            try:
+                day = now.replace(month=i + 1, day=int(match.group(1))).date()
+            except ValueError:
+                return None
+            # A date that has already passed means next year
+            return day if day >= now.date() else day.replace(year=day.year + 1)
+    return None
+
+def _spoken_time(text):
+    if re.search(r'\b(noon|midday)\b', text):
+        return 12, 0
+    match = re.search(r'\b(\d{1,2})(?:[:.](\d{2})| (\d{2})(?= ?[ap]))? ?([ap])\.? ?m\b', text)
+    if match:
+        hour = int(match.group(1)) % 12 + (12 if match.group(4) == 'p' else 0)
+        return hour, int(match.group(2) or match.group(3) or 0)
+    match = re.search(r"\bat (\d{1,2})(?:[:.](\d{2}))?\b", text) or \
+        re.search(r"\b(\d{1,2})(?:[:.](\d{2}))? ?o'? ?clock\b", text) or \
+        re.search(r"\b(\d{1,2})[:.](\d{2})\b", text)
+    if match:
+        hour = int(match.group(1))
+        if hour > 23:
+            return None
+        # "at 3" means 3 pm during working hours
+        if 1 <= hour <= 7:
+            hour += 12
+        return hour, int(match.group(2) or 0)
+    return None
+
+def parse_spoken_datetime(text, now=None, default_day=None):
+    """Read a requested time from speech.
+
+    Returns (start, end, exact): an exact time gives start == end and
+    exact=True; "Tuesday afternoon" gives the range and exact=False.
+    Returns None if neither a day nor a time can be found.
+    """
+    now = now or datetime.now()
+    try:
+        start = datetime.strptime(normalize_datetime(text), '%Y-%m-%d %H:%M:%S')
+        return start, start, True
+    except ValueError:
+        pass
+    text = ' ' + (text or '').lower().replace(',', ' ') + ' '
+    day = _spoken_day(text, now)
+    clock = _spoken_time(text)
+    if day is None and clock is None:
+        return None
+    if day is None:
+        day = default_day or (now.date() if clock and (clock[0], clock[1]) > (now.hour, now.minute)
+                              else (now + timedelta(days=1)).date())
+    if clock:
+        start = datetime.combine(day, datetime.min.time()).replace(hour=clock[0], minute=clock[1])
+        return start, start, True
+    base = datetime.combine(day, datetime.min.time())
+    for part, (first, last) in PARTS_OF_DAY.items():
+        if part in text:
+            return base.replace(hour=first), base.replace(hour=last), False
+    return base, base + timedelta(days=1), False
+
+def describe_slot(value):
+    """'2025-03-04 15:30:00' -> 'Tuesday March 4 at 3:30 PM' for TTS"""
+    start = datetime.strptime(value, '%Y-%m-%d %H:%M:%S') if isinstance(value, str) else value
+    clock = start.strftime('%I:%M %p').lstrip('0').replace(':00', '')
+    return f"{start.strftime('%A %B')} {start.day} at {clock}"
@@ -0,0 +1,306 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hf_utils
+from hf_utils import top_label, normalize_intent, normalize_sentiment
+
+# Offline benchmark for the intent/sentiment backends: the Hugging Face
+# Inference API (replaced by a local stub unless --remote live), the same
+# models run locally with transformers, and the dialog's keyword fallback.
+# Each backend runs over a labelled corpus and is scored for speed
+# (throughput, latency percentiles, memory) and quality (accuracy, macro F1,
+# per-language accuracy). Results are written as JSON to benchmark_results/
+# so runs can be compared.
+#
+# Usage: python benchmark_utils.py --task intent --backends remote,local,keyword --compare latest
+
+CORPUS_PATH = 'benchmark_corpus.jsonl'
+RESULTS_DIR = 'benchmark_results'
+
+def load_corpus(path=CORPUS_PATH):
+    """Labelled utterances: {text, lang, intent, sentiment} per line"""
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                items.append(json.loads(line))
+    return items
+
+# --- Backends: text -> raw label (or None) ---
+
+def _backends(task):
+    if task == 'intent':
+        return {
+            'remote': lambda text: top_label(hf_utils.hf_intent_classification(text)),
+            'local': lambda text: top_label(hf_utils.local_intent_classification(text)),
+            'keyword': hf_utils.keyword_intent,
+        }
+    return {
+        'remote': lambda text: top_label(hf_utils.hf_sentiment_analysis(text)),
+        'local': lambda text: top_label(hf_utils.local_sentiment_analysis(text)),
+        # The dialog has no sentiment keywords; it falls back to neutral
+        'keyword': lambda text: 'neutral',
+    }
+
+# --- Remote API stub ---
+
+class StubInferenceAPI:
+    """Local stand-in for the Inference API with a fixed response delay.
+
+    Measures the client side (HTTP round trip, JSON) without network or rate
+    limits. Its labels come from the keyword rules, so its accuracy is not
+    the real model's.
+    """
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                text = str(body.get('inputs', ''))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if hf_utils.SENTIMENT_MODEL in self.path:
+                    labels = [{'label': 'Neutral', 'score': 0.9}]
+                else:
+                    labels = [{'label': hf_utils.keyword_intent(text), 'score': 0.9}]
+                payload = json.dumps([labels]).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/models'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.previous_url = hf_utils.HF_API_URL
+        hf_utils.HF_API_URL = self.url
+        return self
+
+    def __exit__(self, *exc):
+        hf_utils.HF_API_URL = self.previous_url
+        self.server.shutdown()
+        self.server.server_close()
+
+# --- Measurement ---
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+def score(gold, predicted, langs):
+    """Accuracy, macro F1, per-label precision/recall/F1, per-language accuracy, confusion counts"""
+    labels = sorted(set(gold) | set(predicted))
+    per_label = {}
+    for label in labels:
+        tp = sum(1 for g, p in zip(gold, predicted) if g == label and p == label)
+        fp = sum(1 for g, p in zip(gold, predicted) if g != label and p == label)
+        fn = sum(1 for g, p in zip(gold, predicted) if g == label and p != label)
+        precision = tp / (tp + fp) if tp + fp else 0.0
+        recall = tp / (tp + fn) if tp + fn else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        per_label[label] = {"precision": round(precision, 4), "recall": round(recall, 4),
+                            "f1": round(f1, 4), "support": gold.count(label)}
+    gold_labels = [label for label in labels if per_label[label]['support']]
+    by_lang = defaultdict(list)
+    for g, p, lang in zip(gold, predicted, langs):
+        by_lang[lang].append(g == p)
+    confusion = Counter(f"{g}->{p}" for g, p in zip(gold, predicted) if g != p)
+    return {
+        "accuracy": round(sum(g == p for g, p in zip(gold, predicted)) / len(gold), 4) if gold else None,
+        "macro_f1": round(sum(per_label[l]['f1'] for l in gold_labels) / len(gold_labels), 4) if gold_labels else None,
+        "per_label": per_label,
+        "per_language_accuracy": {lang: round(sum(v) / len(v), 4) for lang, v in sorted(by_lang.items())},
+        "confusions": dict(confusion.most_common())
+    }
+
+def run_backend(name, classify, corpus, task, repeat=1):
+    """Time one backend over the corpus; quality is scored on the first pass"""
+    normalize = normalize_intent if task == 'intent' else normalize_sentiment
+    rss_before = _rss_mb()
+
+    # Warm-up call: model loading and connection setup are reported separately
+    started = time.perf_counter()
+    try:
+        classify(corpus[0]['text'])
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    warmup_seconds = time.perf_counter() - started
+
+    latencies = []
+    predicted = []
+    raw_labels = Counter()
+    errors = 0
+    total_started = time.perf_counter()
+    for i in range(repeat):
+        for item in corpus:
+            t = time.perf_counter()
+            try:
+                label = classify(item['text'])
+            except Exception:
+                label = None
+                errors += 1
+            latencies.append((time.perf_counter() - t) * 1000)
+            if i == 0:
+                raw_labels[str(label)] += 1
+                predicted.append(normalize(label))
+    total_seconds = time.perf_counter() - total_started
+    rss_after = _rss_mb()
+
+    gold = [item[task] for item in corpus]
+    return {
+        "items": len(latencies),
+        "errors": errors,
+        "warmup_seconds": round(warmup_seconds, 4),
+        "throughput_per_second": round(len(latencies) / total_seconds, 2) if total_seconds else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 3),
+            "p50": round(_percentile(latencies, 50), 3),
+            "p90": round(_percentile(latencies, 90), 3),
+            "p99": round(_percentile(latencies, 99), 3),
+            "max": round(max(latencies), 3)
+        },
+        "memory_mb": {
+            "rss_before": round(rss_before, 1) if rss_before else None,
+            "rss_after": round(rss_after, 1) if rss_after else None,
+            "rss_delta": round(rss_after - rss_before, 1) if rss_before and rss_after else None,
+            # Peak for the whole process so far (ru_maxrss is in KB on Linux)
+            "peak_rss": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        },
+        "raw_labels": dict(raw_labels.most_common()),
+        **score(gold, predicted, [item.get('lang', 'unknown') for item in corpus])
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run_benchmark(task='intent', backends=('remote', 'local', 'keyword'), corpus_path=CORPUS_PATH,
+                  remote='stub', stub_latency_ms=0, repeat=1):
+    """Run the selected backends and return the results document"""
+    corpus = load_corpus(corpus_path)
+    with open(corpus_path, 'rb') as f:
+        corpus_hash = hashlib.sha1(f.read()).hexdigest()[:12]
+    available = _backends(task)
+    results = {}
+    for name in backends:
+        print(f"[Benchmark] {task}/{name} on {len(corpus)} utterances x{repeat}")
+        if name == 'remote' and remote == 'stub':
+            with StubInferenceAPI(stub_latency_ms):
+                results[name] = run_backend(name, available[name], corpus, task, repeat)
+            results[name]['stubbed'] = True
+        else:
+            results[name] = run_backend(name, available[name], corpus, task, repeat)
+    return {
+        "run_at": datetime.now().isoformat(timespec='seconds'),
+        "git_commit": _git_commit(),
+        "task": task,
+        "corpus": {"path": corpus_path, "items": len(corpus), "sha1": corpus_hash,
+                   "languages": dict(Counter(item.get('lang', 'unknown') for item in corpus))},
+        "settings": {"remote": remote, "stub_latency_ms": stub_latency_ms, "repeat": repeat},
+        "backends": results
+    }
+
+def save_results(results, directory=RESULTS_DIR):
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(directory, f"{stamp}_{results['task']}.json")
+    n = 1
+    while os.path.exists(path):
+        n += 1
+        path = os.path.join(directory, f"{stamp}-{n}_{results['task']}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    return path
+
+def latest_results(task, directory=RESULTS_DIR, exclude=None):
+    paths = sorted(p for p in glob.glob(os.path.join(directory, f'*_{task}.json')) if p != exclude)
+    return paths[-1] if paths else None
+
+def compare(current, previous):
+    """Print metric changes between two results documents"""
+    print(f"Compared with {previous['run_at']} ({previous.get('git_commit')}):")
+    for name, now in current['backends'].items():
+        before = previous['backends'].get(name)
+        if not before or 'error' in now or 'error' in before:
+            continue
+        rows = [
+            ('accuracy', now['accuracy'], before['accuracy']),
+            ('macro_f1', now['macro_f1'], before['macro_f1']),
+            ('p50 ms', now['latency_ms']['p50'], before['latency_ms']['p50']),
+            ('p99 ms', now['latency_ms']['p99'], before['latency_ms']['p99']),
+            ('items/s', now['throughput_per_second'], before['throughput_per_second']),
+        ]
+        changes = ', '.join(f"{label} {old} -> {new}" for label, new, old in rows if new != old)
+        print(f"  {name}: {changes or 'no change'}")
+
+def print_summary(results):
+    print(f"\n{results['task']} benchmark, {results['corpus']['items']} utterances {results['corpus']['languages']}")
+    print(f"{'backend':<10}{'acc':>8}{'F1':>8}{'p50 ms':>10}{'p99 ms':>10}{'items/s':>10}{'RSS +MB':>9}  per-language")
+    for name, r in results['backends'].items():
+        if 'error' in r:
+            print(f"{name:<10}  unavailable: {r['error']}")
+            continue
+        label = name + ('*' if r.get('stubbed') else '')
+        print(f"{label:<10}{r['accuracy']:>8}{r['macro_f1']:>8}{r['latency_ms']['p50']:>10}{r['latency_ms']['p99']:>10}"
+              f"{r['throughput_per_second']:>10}{str(r['memory_mb']['rss_delta']):>9}  {r['per_language_accuracy']}")
+    if any(r.get('stubbed') for r in results['backends'].values()):
+        print("* remote API stubbed locally: latency is client overhead, labels are not the real model's")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark intent/sentiment backends on a labelled corpus')
+    parser.add_argument('--task', choices=['intent', 'sentiment'], default='intent')
+    parser.add_argument('--backends', default='remote,local,keyword')
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument('--remote', choices=['stub', 'live'], default='stub',
+                        help='stub: local fake Inference API (default); live: call Hugging Face')
+    parser.add_argument('--stub-latency-ms', type=float, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='passes over the corpus for latency figures')
+    parser.add_argument('--out', default=RESULTS_DIR)
+    parser.add_argument('--compare', help="earlier results file, or 'latest'")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.task, [b.strip() for b in args.backends.split(',') if b.strip()],
+                            args.corpus, args.remote, args.stub_latency_ms, max(1, args.repeat))
+    path = save_results(results, args.out)
+    print_summary(results)
+    print(f"\nSaved {path}")
+    if args.compare:
+        previous_path = latest_results(args.task, args.out, exclude=path) if args.compare == 'latest' else args.compare
+        if previous_path:
+            with open(previous_path, encoding='utf-8') as f:
+                compare(results, json.load(f))
+        else:
+            print("No earlier results to compare with")
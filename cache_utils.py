@@ -0,0 +1,88 @@
+import json
+import sqlite3
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi.responses import Response
+
+# Per-table data versions and a cache of serialized list responses.
+# Triggers bump a table's row in table_versions on every insert, update and
+# delete, so every writer invalidates cached responses: any route, a bulk
+# import, another worker process or the re-scoring CLI, with nothing to
+# remember in the write path. List routes derive their ETag from those
+# versions (one small indexed read), so an unchanged poll is answered with
+# 304 (or the cached body) without running the list query.
+
+VERSIONED_TABLES = ('appointments', 'call_logs', 'system_prompts')
+
+_started_at = time.time()
+response_cache = {}
+
+def init_version_table(conn, tables=VERSIONED_TABLES):
+    """Create table_versions and the triggers that bump it"""
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS table_versions (
+        table_name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0,
+        modified_at REAL
+    )''')
+    for table in tables:
+        # Versions start from the creation time, so a recreated database never reuses an old ETag
+        c.execute('INSERT OR IGNORE INTO table_versions (table_name, version, modified_at) VALUES (?, ?, ?)',
+                  (table, int(time.time()), time.time()))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                UPDATE table_versions SET version = version + 1, modified_at = (julianday('now') - 2440587.5) * 86400.0
+                    WHERE table_name = '{table}';
+            END''')
+
+def current_versions(tables):
+    """(version, modified_at) per table, read from table_versions"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    placeholders = ','.join('?' * len(tables))
+    c.execute(f'SELECT table_name, version, modified_at FROM table_versions WHERE table_name IN ({placeholders})', list(tables))
+    versions = {row[0]: (row[1], row[2]) for row in c.fetchall()}
+    conn.close()
+    return {t: versions.get(t, (0, _started_at)) for t in tables}
+
+def current_etag(tables, versions=None):
+    """Strong ETag for a response built from `tables`"""
+    versions = versions or current_versions(tables)
+    return '"' + '-'.join(f"{t}.{versions[t][0]}" for t in tables) + '"'
+
+def _not_modified(request, etag, modified):
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since
+        candidates = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in candidates or '*' in candidates or f'W/{etag}' in candidates
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def cached_json_response(request, key, tables, build):
+    """Serve build() as JSON with ETag/Last-Modified, reusing the cached body while `tables` are unchanged"""
+    # Read the version before building so a concurrent write can only make
+    # the cached body newer than its ETag, never older.
+    versions = current_versions(tables)
+    etag = current_etag(tables, versions)
+    modified = max(versions[t][1] or _started_at for t in tables)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(modified, usegmt=True),
+        "Cache-Control": "no-cache"
+    }
+    if _not_modified(request, etag, modified):
+        return Response(status_code=304, headers=headers)
+
+    entry = response_cache.get(key)
+    if entry and entry[0] == etag:
+        body = entry[1]
+    else:
+        body = json.dumps(build()).encode('utf-8')
+        response_cache[key] = (etag, body)
+    return Response(content=body, media_type="application/json", headers=headers)
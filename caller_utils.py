@@ -0,0 +1,189 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from appointment_utils import load_user_memory
+
+# Caller context cache. Everything a dialog turn needs to know about a
+# caller (their rolling memory and upcoming appointments) is loaded once,
+# keyed by E.164 number, as soon as the call starts ringing. Later turns read
+# it from memory. Writes in this process update or refresh the entry; the TTL
+# only bounds staleness from writes made by other processes, and expired
+# entries are served while a background reload runs.
+
+DEFAULT_COUNTRY_CODE = os.getenv('DEFAULT_COUNTRY_CODE', '1')
+CALLER_CACHE_SIZE = int(os.getenv('CALLER_CACHE_SIZE', '1000'))
+CALLER_CACHE_TTL = int(os.getenv('CALLER_CACHE_TTL', '300'))
+
+def normalize_e164(phone, default_country=DEFAULT_COUNTRY_CODE):
+    """'+1 (555) 123-4567', '555-123-4567' and '0015551234567' -> '+15551234567'"""
+    if not phone:
+        return None
+    phone = str(phone).strip()
+    digits = re.sub(r'\D', '', phone)
+    if not digits:
+        return None
+    if phone.startswith('+'):
+        return '+' + digits
+    if digits.startswith('00'):
+        return '+' + digits[2:]
+    if len(digits) == 10:
+        return '+' + default_country + digits
+    return '+' + digits
+
+def load_upcoming_appointments(phone):
+    """Scheduled future appointments for a number, matched on normalized phone"""
+    key = normalize_e164(phone)
+    if not key:
+        return []
+    # The trigram index on phone digits (search_utils) avoids scanning the table
+    # for numbers stored in other formats
+    suffix = key[1:][-10:]
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('''SELECT a.id, a.name, a.phone, a.datetime, a.service, a.notes, a.status
+                 FROM appointments_fts f JOIN appointments a ON a.id = f.rowid
+                 WHERE appointments_fts MATCH ? AND a.status = 'scheduled' AND a.datetime >= ?
+                 ORDER BY a.datetime''',
+              (f'phone_digits : "{suffix}"', datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    rows = c.fetchall()
+    conn.close()
+    return [
+        {
+            'id': row[0],
+            'name': row[1],
+            'phone': row[2],
+            'datetime': row[3],
+            'service': row[4],
+            'notes': row[5],
+            'status': row[6]
+        }
+        for row in rows
+        if normalize_e164(row[2]) == key
+    ]
+
+class CallerContextCache:
+    """LRU of caller contexts with background warming and write-through updates"""
+
+    def __init__(self, max_entries=CALLER_CACHE_SIZE, ttl=CALLER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.memory_writes = {}   # memory saved while a load was in flight
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='caller-context')
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key, context):
+        with self.lock:
+            self.entries[key] = context
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _load(self, key, phone):
+        return {
+            'phone': key,
+            'memory': load_user_memory(phone),
+            'appointments': load_upcoming_appointments(key),
+            'loaded_at': time.time()
+        }
+
+    def _start_load(self, key, phone):
+        # Caller holds self.lock; one load per number at a time
+        future = self.loading.get(key)
+        if future is None:
+            future = self.executor.submit(self._load, key, phone)
+            self.loading[key] = future
+            future.add_done_callback(lambda _: self._load_done(key, future))
+        return future
+
+    def _load_done(self, key, future):
+        with self.lock:
+            # A load superseded by refresh_appointments() is discarded
+            current = self.loading.get(key) is future
+            if current:
+                del self.loading[key]
+                memory = self.memory_writes.pop(key, None)
+        if future.exception():
+            print(f"[Caller Context] Failed to load {key}: {future.exception()}")
+        elif current:
+            context = future.result()
+            if memory is not None:
+                context['memory'] = memory
+            self._store(key, context)
+
+    def warm(self, phone):
+        """Load a caller's context in the background unless it is already fresh"""
+        key = normalize_e164(phone)
+        if not key:
+            return None
+        with self.lock:
+            context = self.entries.get(key)
+            if context and time.time() - context['loaded_at'] < self.ttl:
+                return None
+            return self._start_load(key, phone)
+
+    def get(self, phone):
+        """The caller's context: cached, the in-flight warm-up, or a synchronous load"""
+        key = normalize_e164(phone)
+        if not key:
+            return {'phone': None, 'memory': [], 'appointments': [], 'loaded_at': time.time()}
+        with self.lock:
+            future = self.loading.get(key)
+            context = self.entries.get(key)
+            if context and not future:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                if time.time() - context['loaded_at'] >= self.ttl:
+                    self._start_load(key, phone)
+                return self._copy(context)
+            self.misses += 1
+            if not future:
+                future = self._start_load(key, phone)
+        return self._copy(future.result())
+
+    def _copy(self, context):
+        # Dialog code appends to the memory list; keep the cached one intact
+        return {**context, 'memory': list(context['memory']), 'appointments': list(context['appointments'])}
+
+    def set_memory(self, phone, memory):
+        """Write-through after save_user_memory"""
+        key = normalize_e164(phone)
+        with self.lock:
+            context = self.entries.get(key)
+            if context:
+                context['memory'] = list(memory)
+            if key in self.loading:
+                self.memory_writes[key] = list(memory)
+
+    def refresh_appointments(self, *phones):
+        """Reload appointments for the given numbers (all cached callers if none given)"""
+        with self.lock:
+            if phones:
+                keys = {normalize_e164(p): p for p in phones if normalize_e164(p)}
+            else:
+                keys = {key: key for key in self.entries}
+            for key, phone in keys.items():
+                if key in self.entries or key in self.loading:
+                    # Drop a load that may have read the old rows, then reload
+                    self.loading.pop(key, None)
+                    self._start_load(key, phone)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "loading": len(self.loading),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+caller_context = CallerContextCache()
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+
+# Change feed for the admin console. Triggers append a row to change_events
+# for every appointment create/update/delete and every logged call, so the
+# feed sees writes from any route (or any worker process). A single poller
+# per process reads new rows and fans them out to all connected clients;
+# clients resume with the SSE Last-Event-ID and only receive deltas.
+# Call events carry metadata only; the transcript is read from
+# /api/admin/calls/{call_id} when it is opened. A background thread keeps the
+# table to the newest events whether or not anyone is subscribed.
+
+APPOINTMENT_JSON = "json_object('id', {r}.id, 'name', {r}.name, 'phone', {r}.phone, 'datetime', {r}.datetime, 'service', {r}.service, 'notes', {r}.notes, 'status', {r}.status, 'created_at', {r}.created_at)"
+CALL_JSON = "json_object('id', new.id, 'call_id', new.call_id, 'phone_number', new.phone_number, 'user_name', new.user_name, 'intent', new.intent, 'sentiment', new.sentiment, 'duration_seconds', new.duration_seconds, 'created_at', new.created_at)"
+
+def init_events_table(conn):
+    """Create the change_events table and the triggers that feed it"""
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS change_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type TEXT,
+        entity TEXT,
+        entity_id INTEGER,
+        payload TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS appointments_events_ai AFTER INSERT ON appointments BEGIN
+        INSERT INTO change_events (event_type, entity, entity_id, payload)
+            VALUES ('appointment.created', 'appointment', new.id, {APPOINTMENT_JSON.format(r='new')});
+    END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS appointments_events_au AFTER UPDATE ON appointments BEGIN
+        INSERT INTO change_events (event_type, entity, entity_id, payload)
+            VALUES (CASE WHEN old.status IS NOT new.status THEN 'appointment.status_changed' ELSE 'appointment.updated' END,
+                    'appointment', new.id, {APPOINTMENT_JSON.format(r='new')});
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS appointments_events_ad AFTER DELETE ON appointments BEGIN
+        INSERT INTO change_events (event_type, entity, entity_id, payload)
+            VALUES ('appointment.deleted', 'appointment', old.id, json_object('id', old.id));
+    END''')
+    # Recreated so databases from before call events dropped the transcript pick up the new payload
+    c.execute('DROP TRIGGER IF EXISTS call_logs_events_ai')
+    c.execute(f'''CREATE TRIGGER call_logs_events_ai AFTER INSERT ON call_logs BEGIN
+        INSERT INTO change_events (event_type, entity, entity_id, payload)
+            VALUES ('call.ended', 'call', new.id, {CALL_JSON});
+    END''')
+    c.execute('''UPDATE change_events SET payload = json_remove(payload, '$.conversation_data')
+                 WHERE entity = 'call' AND json_type(payload, '$.conversation_data') IS NOT NULL''')
+
+def latest_event_id():
+    """Id of the newest change event (0 if none)"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('SELECT MAX(id) FROM change_events')
+    row = c.fetchone()
+    conn.close()
+    return row[0] or 0
+
+def read_events_since(last_id, limit=500):
+    """Return up to `limit` events newer than last_id, plus the oldest retained id"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('''SELECT id, event_type, entity, entity_id, payload, created_at
+                 FROM change_events WHERE id > ? ORDER BY id LIMIT ?''', (last_id, limit))
+    rows = c.fetchall()
+    c.execute('SELECT MIN(id) FROM change_events')
+    oldest = c.fetchone()[0]
+    conn.close()
+    events = [
+        {
+            "id": row[0],
+            "type": row[1],
+            "entity": row[2],
+            "entity_id": row[3],
+            "data": json.loads(row[4]) if row[4] else {},
+            "created_at": row[5]
+        }
+        for row in rows
+    ]
+    return events, oldest
+
+def prune_events(keep=10000):
+    """Drop all but the newest `keep` change events"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('DELETE FROM change_events WHERE id <= (SELECT MAX(id) FROM change_events) - ?', (keep,))
+    conn.commit()
+    conn.close()
+
+def format_sse(event):
+    """Serialize an event in text/event-stream format"""
+    return f"id: {event['id']}\ndata: {json.dumps(event)}\n\n"
+
+class ChangeFeed:
+    """Per-process fan-out of change_events to SSE subscribers"""
+
+    def __init__(self, buffer_size=2000, poll_interval=2.0, heartbeat=15.0, keep_events=10000):
+        self.buffer = deque(maxlen=buffer_size)
+        self.poll_interval = poll_interval
+        self.heartbeat = heartbeat
+        self.keep_events = keep_events
+        self.last_id = 0
+        self.loop = None
+        self.wakeup = None
+        self.condition = None
+        self.task = None
+        self.prune_thread = None
+
+    def start_pruning(self, interval_seconds=300):
+        """Prune change_events every interval_seconds on a background thread, subscribers or not"""
+        if not interval_seconds or (self.prune_thread and self.prune_thread.is_alive()):
+            return
+        self.prune_thread = threading.Thread(target=self._prune_loop, args=(interval_seconds,),
+                                             daemon=True, name='change-events-pruner')
+        self.prune_thread.start()
+
+    def _prune_loop(self, interval):
+        while True:
+            try:
+                prune_events(self.keep_events)
+            except Exception as e:
+                print(f"[Change Feed] Prune error: {e}")
+            time.sleep(interval)
+
+    async def ensure_started(self):
+        """Start the poller on first use, so the feed costs nothing until someone listens"""
+        if self.task and not self.task.done():
+            return
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.condition = asyncio.Condition()
+        self.last_id = await self.loop.run_in_executor(None, latest_event_id)
+        self.task = asyncio.create_task(self._poll())
+
+    def notify(self):
+        """Wake the poller after a local write; safe to call from any thread"""
+        if self.loop and self.wakeup and self.task and not self.task.done():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def _poll(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                events, _ = await self.loop.run_in_executor(None, read_events_since, self.last_id)
+                if events:
+                    async with self.condition:
+                        self.buffer.extend(events)
+                        self.last_id = events[-1]["id"]
+                        self.condition.notify_all()
+                    if len(events) == 500:
+                        self.wakeup.set()
+            except Exception as e:
+                print(f"[Change Feed] Poll error: {e}")
+
+    def _buffered_since(self, last_id):
+        """Buffered events after last_id, or None if the buffer no longer reaches back that far"""
+        if self.buffer and last_id < self.buffer[0]["id"] - 1:
+            return None
+        return [e for e in self.buffer if e["id"] > last_id]
+
+    def _reset_event(self, last_id):
+        return {"id": last_id, "type": "reset", "entity": None, "entity_id": None, "data": {}, "created_at": None}
+
+    async def subscribe(self, last_id):
+        """Yield events after last_id as they arrive; yields None as a keep-alive"""
+        await self.ensure_started()
+
+        # Catch up from the database if the client is behind the in-memory buffer
+        while last_id < self.last_id and (not self.buffer or self._buffered_since(last_id) is None):
+            events, oldest = await self.loop.run_in_executor(None, read_events_since, last_id)
+            if oldest is not None and last_id < oldest - 1:
+                # Events the client missed were pruned: ask it to refetch
+                last_id = oldest - 1
+                yield self._reset_event(last_id)
+                continue
+            if not events:
+                break
+            for event in events:
+                yield event
+            last_id = events[-1]["id"]
+
+        while True:
+            async with self.condition:
+                pending = self._buffered_since(last_id)
+                if pending is None:
+                    # Fell behind the buffer while streaming: ask the client to refetch
+                    last_id = self.last_id
+                    pending = [self._reset_event(last_id)]
+                elif not pending:
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), timeout=self.heartbeat)
+                    except asyncio.TimeoutError:
+                        pass
+                    pending = self._buffered_since(last_id) or []
+            if not pending:
+                yield None
+                continue
+            for event in pending:
+                yield event
+            last_id = pending[-1]["id"]
+
+change_feed = ChangeFeed()
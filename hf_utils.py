@@ -1,11 +1,16 @@
 import os
+import time
 import requests
 from dotenv import load_dotenv
 load_dotenv()
 import json
+from llm_pool_utils import LLMEndpointPool
 
 HF_API_TOKEN = os.getenv('HF_API_TOKEN')  # Optional, for higher rate limits
 LLAMA3_API_URL = os.getenv('LLAMA3_API_URL', 'http://localhost:11434/api/chat')
+# Several Ollama instances: comma-separated chat URLs, load balanced (see llm_pool_utils)
+LLAMA3_API_URLS = [u.strip() for u in os.getenv('LLAMA3_API_URLS', LLAMA3_API_URL).split(',') if u.strip()]
+HF_API_URL = os.getenv('HF_API_URL', 'https://api-inference.huggingface.co/models')  # overridable for local stubs
 
 # Hugging Face Inference API endpoints
 INTENT_MODEL = 'Falconsai/intent_classification'
@@ -14,7 +19,7 @@ LLAMA3_MODEL = 'meta-llama/Llama-3.1-8B-Instruct'  # Updated to latest/popular v
 
 
 def hf_intent_classification(text):
-    url = f'https://api-inference.huggingface.co/models/{INTENT_MODEL}'
+    url = f'{HF_API_URL}/{INTENT_MODEL}'
     headers = {'Authorization': f'Bearer {HF_API_TOKEN}'} if HF_API_TOKEN else {}
     response = requests.post(url, headers=headers, json={"inputs": text})
     if response.status_code == 200:
@@ -22,17 +27,101 @@ def hf_intent_classification(text):
     return {"error": response.text}
 
 def hf_sentiment_analysis(text):
-    url = f'https://api-inference.huggingface.co/models/{SENTIMENT_MODEL}'
+    url = f'{HF_API_URL}/{SENTIMENT_MODEL}'
     headers = {'Authorization': f'Bearer {HF_API_TOKEN}'} if HF_API_TOKEN else {}
     response = requests.post(url, headers=headers, json={"inputs": text})
     if response.status_code == 200:
         return response.json()
     return {"error": response.text}
 
+def keyword_intent(text):
+    # Fallback used by the voice dialog when the classifier gives no label
+    text = text.lower()
+    if "book" in text:
+        return "book"
+    if "reschedule" in text:
+        return "reschedule"
+    if "cancel" in text:
+        return "cancel"
+    if "service" in text or "offer" in text:
+        return "service"
+    return "unknown"
+
+# Label handling, shared by the dialog, call logging and batch re-scoring
+
+def top_label(result):
+    """Highest-scoring label from an Inference API / pipeline response, or None"""
+    if isinstance(result, dict):
+        return None if 'error' in result else result.get('label')
+    if isinstance(result, list) and result:
+        if isinstance(result[0], list):
+            result = result[0]
+        scored = [r for r in result if isinstance(r, dict) and 'label' in r]
+        if scored:
+            return max(scored, key=lambda r: r.get('score', 0))['label']
+    return None
+
+def normalize_intent(label):
+    """Map a model's intent label onto the dialog's book/reschedule/cancel/service/unknown"""
+    label = (label or '').lower()
+    if 'reschedul' in label or 'change' in label or 'move' in label:
+        return 'reschedule'
+    if 'cancel' in label:
+        return 'cancel'
+    if 'book' in label or 'schedule' in label or 'reserv' in label:
+        return 'book'
+    if 'service' in label or 'info' in label or 'price' in label or 'hour' in label:
+        return 'service'
+    return 'unknown'
+
+def normalize_sentiment(label):
+    """Map 'Very Negative', 'LABEL_2', '4 stars', ... onto negative/neutral/positive"""
+    label = (label or '').lower()
+    if 'neg' in label or label.startswith(('1 star', '2 star')) or label == 'label_0':
+        return 'negative'
+    if 'pos' in label or label.startswith(('4 star', '5 star')) or label == 'label_2':
+        return 'positive'
+    return 'neutral'
+
+# Local copies of the same models, for offline and batch use (loaded on first call)
+_local_classifiers = {}
+
+def _local_classifier(model_name):
+    if model_name not in _local_classifiers:
+        from transformers import pipeline
+        _local_classifiers[model_name] = pipeline('text-classification', model=model_name)
+    return _local_classifiers[model_name]
+
+def load_local_classifiers():
+    _local_classifier(INTENT_MODEL)
+    _local_classifier(SENTIMENT_MODEL)
+
+def local_intent_classification(text):
+    # Same shape as the Inference API response: [{"label": ..., "score": ...}]
+    return _local_classifier(INTENT_MODEL)(text)
+
+def local_sentiment_analysis(text):
+    return _local_classifier(SENTIMENT_MODEL)(text)
+
+def local_classify_batch(texts, task='intent', batch_size=64):
+    """Top {"label", "score"} per text, run through the local model in padded batches"""
+    model_name = SENTIMENT_MODEL if task == 'sentiment' else INTENT_MODEL
+    return _local_classifier(model_name)(list(texts), batch_size=batch_size, truncation=True)
+
+llm_pool = LLMEndpointPool(
+    LLAMA3_API_URLS,
+    strategy=os.getenv('LLAMA3_LB_STRATEGY', 'least_outstanding'),
+    health_interval=float(os.getenv('LLAMA3_HEALTH_INTERVAL', '10'))
+)
+
 # Llama 3 chat completion via local Ollama API
 # history: list of {"role": "user"|"assistant", "content": ...}
-def local_llama3_chat_completion(messages, system_prompt=None):
-    url = LLAMA3_API_URL
+def local_llama3_chat_stream(messages, system_prompt=None, session_key=None):
+    """Yield reply text pieces from the local Ollama API as they are generated.
+
+    session_key (e.g. the caller's number) keeps a conversation on one endpoint.
+    A request that fails before any text arrives is retried on another endpoint.
+    """
     # Ollama expects a 'messages' list with role/content, and optionally a system prompt
     payload = {
         "model": "llama3",
@@ -40,22 +129,55 @@ def local_llama3_chat_completion(messages, system_prompt=None):
     }
     if system_prompt:
         payload["system"] = system_prompt
+    tried = set()
+    last_error = None
+    while True:
+        endpoint = llm_pool.acquire(session_key, exclude=tried)
+        if endpoint is None:
+            raise last_error or RuntimeError("No Llama 3 endpoints configured")
+        tried.add(endpoint.url)
+        started = time.time()
+        first_token_ms = None
+        error = None
+        try:
+            with requests.post(endpoint.url, json=payload, timeout=60, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line:
+                        try:
+                            chunk = json.loads(line.decode("utf-8"))
+                        except Exception as e:
+                            print("[Llama3 Ollama] Chunk parse error:", e)
+                            continue
+                        if 'message' in chunk and 'content' in chunk['message']:
+                            if first_token_ms is None:
+                                first_token_ms = (time.time() - started) * 1000
+                            yield chunk['message']['content']
+        except requests.RequestException as e:
+            error = e
+        finally:
+            # Also runs when the consumer stops early, which is not a failure
+            llm_pool.release(endpoint, error=error, latency_ms=first_token_ms)
+        if error is None:
+            return
+        last_error = error
+        if first_token_ms is not None:
+            # Part of the reply was already passed on; a retry would repeat it
+            raise error
+        print(f"[Llama3 Ollama] {endpoint.url} failed ({error}); trying another endpoint")
+
+def local_llama3_chat_completion(messages, system_prompt=None, session_key=None):
     try:
-        response = requests.post(url, json=payload, timeout=60, stream=True)
-        content = ""
-        for line in response.iter_lines():
-            if line:
-                try:
-                    chunk = json.loads(line.decode("utf-8"))
-                    if 'message' in chunk and 'content' in chunk['message']:
-                        content += chunk['message']['content']
-                except Exception as e:
-                    print("[Llama3 Ollama] Chunk parse error:", e)
+        content = "".join(local_llama3_chat_stream(messages, system_prompt=system_prompt, session_key=session_key))
         return content.strip() if content else "Sorry, I could not process your request right now."
     except Exception as e:
         print(f"[Llama3 Ollama] Exception: {e}")
         return "Sorry, I could not process your request right now."
 
-def llama3_chat_completion(user_message, system_prompt=None, max_tokens=256):
+def llama3_chat_completion(user_message, system_prompt=None, max_tokens=256, session_key=None):
+    messages = [{"role": "user", "content": user_message}]
+    return local_llama3_chat_completion(messages, system_prompt=system_prompt, session_key=session_key)
+
+def llama3_chat_stream(user_message, system_prompt=None, session_key=None):
     messages = [{"role": "user", "content": user_message}]
-    return local_llama3_chat_completion(messages, system_prompt=system_prompt) 
\ No newline at end of file
+    return local_llama3_chat_stream(messages, system_prompt=system_prompt, session_key=session_key)
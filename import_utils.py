@@ -0,0 +1,229 @@
+import codecs
+import csv
+import json
+import queue
+import sqlite3
+import time
+from datetime import datetime
+
+# Bulk appointment import. The request body is streamed into a bounded
+# queue by the web handler and parsed here on a worker thread, so memory
+# stays flat regardless of file size. Valid rows are inserted with
+# executemany, one transaction per chunk; invalid rows are reported by
+# row number and skipped.
+
+VALID_STATUSES = {'scheduled', 'completed', 'cancelled', 'no-show'}
+MAX_REPORTED_ERRORS = 1000
+
+DATETIME_FORMATS = [
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d %I:%M %p',
+    '%d/%m/%Y %H:%M',
+    '%d/%m/%Y %I:%M %p',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y %I:%M %p',
+    '%d-%m-%Y %H:%M',
+    '%Y/%m/%d %H:%M',
+    '%d %b %Y %H:%M',
+    '%b %d %Y %I:%M %p',
+]
+
+FIELD_ALIASES = {
+    'date_time': 'datetime',
+    'appointment_time': 'datetime',
+    'appointment_datetime': 'datetime',
+    'phone_number': 'phone',
+    'customer_name': 'name',
+    'patient_name': 'name',
+    'service_type': 'service',
+    'note': 'notes',
+}
+
+def normalize_datetime(value):
+    """Parse a datetime string into the 'YYYY-MM-DD HH:MM:SS' form the app queries on"""
+    value = (value or '').strip()
+    if not value:
+        raise ValueError("datetime is required")
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        parsed = None
+        for fmt in DATETIME_FORMATS:
+            try:
+                parsed = datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                continue
+        if parsed is None:
+            raise ValueError(f"unrecognised datetime '{value}'")
+    if parsed.tzinfo is not None:
+        # Stored datetimes are naive local times, like the rest of the app
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+def validate_row(row):
+    """Turn a raw CSV/NDJSON record into an insert tuple, or raise ValueError"""
+    if not isinstance(row, dict):
+        raise ValueError("row must be an object")
+    record = {}
+    for key, value in row.items():
+        if key is None:
+            raise ValueError("too many columns")
+        key = str(key).strip().lower()
+        if isinstance(value, (dict, list)):
+            raise ValueError(f"{key} must be a single value")
+        # NDJSON values may be numbers or booleans; everything is stored as text
+        record[FIELD_ALIASES.get(key, key)] = None if value is None else str(value).strip()
+
+    name = record.get('name')
+    phone = record.get('phone')
+    if not name:
+        raise ValueError("name is required")
+    if not phone:
+        raise ValueError("phone is required")
+    if sum(ch.isdigit() for ch in phone) < 7:
+        raise ValueError(f"invalid phone '{phone}'")
+    status = (record.get('status') or 'scheduled').lower()
+    if status not in VALID_STATUSES:
+        raise ValueError(f"invalid status '{status}'")
+    return (
+        name,
+        phone,
+        normalize_datetime(record.get('datetime')),
+        record.get('service') or None,
+        record.get('notes') or '',
+        status,
+    )
+
+class ChunkLineReader:
+    """Bounded byte-chunk queue that a worker thread reads back as text lines"""
+
+    def __init__(self, maxsize=64, encoding='utf-8'):
+        self.chunks = queue.Queue(maxsize=maxsize)
+        self.encoding = encoding
+        self.finished = False
+
+    def feed(self, chunk):
+        """Add a chunk (blocks when the worker falls behind); None marks the end"""
+        self.chunks.put(chunk)
+
+    def drain(self):
+        """Discard remaining chunks so a blocked producer can finish"""
+        while not self.finished:
+            self.finished = self.chunks.get() is None
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        pending = ''
+        first = True
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.finished = True
+                break
+            text = decoder.decode(chunk)
+            if first and text:
+                text = text.lstrip('\ufeff')
+                first = False
+            pending += text
+            # Keep the trailing partial line for the next chunk
+            lines = pending.split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            yield pending
+
+def _iter_records(lines, fmt):
+    """Yield (row_number, record_or_error) from CSV or NDJSON lines"""
+    if fmt == 'ndjson':
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, ValueError(f"invalid JSON: {e}")
+    else:
+        # The csv module raises on NUL bytes and broken quoting; report the
+        # offending line (DictReader.line_num only advances on good rows, so
+        # read the underlying reader's) and carry on from the next one
+        reader = csv.DictReader(lines)
+        try:
+            reader.fieldnames
+        except csv.Error as e:
+            yield reader.reader.line_num, ValueError(f"malformed CSV header: {e}")
+            return
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                yield reader.reader.line_num, ValueError(f"malformed CSV: {e}")
+                continue
+            yield reader.line_num, row
+
+def import_appointments(lines, fmt='csv', chunk_size=2000):
+    """Validate and insert appointments from an iterable of text lines; returns a summary"""
+    started = time.time()
+    conn = sqlite3.connect('appointments.db', isolation_level=None)
+    c = conn.cursor()
+    # Per-connection settings only: bulk writes can skip the per-commit fsync
+    c.execute('PRAGMA synchronous = NORMAL')
+
+    imported = 0
+    failed = 0
+    errors = []
+    batch = []
+
+    def flush():
+        c.execute('BEGIN')
+        try:
+            c.executemany('''INSERT INTO appointments (name, phone, datetime, service, notes, status)
+                             VALUES (?, ?, ?, ?, ?, ?)''', batch)
+            c.execute('COMMIT')
+        except Exception:
+            c.execute('ROLLBACK')
+            raise
+
+    try:
+        for row_number, record in _iter_records(lines, fmt):
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                batch.append(validate_row(record))
+            except Exception as e:
+                # A bad row is reported and skipped; it never aborts the rest of the file
+                failed += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({"row": row_number, "error": str(e) or type(e).__name__})
+                continue
+            if len(batch) >= chunk_size:
+                flush()
+                imported += len(batch)
+                batch = []
+        if batch:
+            flush()
+            imported += len(batch)
+    finally:
+        conn.close()
+
+    duration = time.time() - started
+    return {
+        "imported": imported,
+        "failed": failed,
+        "errors": errors,
+        "errors_truncated": failed > len(errors),
+        "duration_seconds": round(duration, 3),
+        "rows_per_second": round((imported + failed) / duration) if duration > 0 else None
+    }
+
+def import_from_reader(reader, fmt='csv'):
+    """Run import_appointments over a ChunkLineReader, draining it if the import fails"""
+    try:
+        return import_appointments(reader, fmt)
+    except Exception:
+        reader.drain()
+        raise
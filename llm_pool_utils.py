@@ -0,0 +1,234 @@
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+import requests
+
+# Load balancing across several Ollama instances. Each request goes to the
+# healthy endpoint with the fewest requests in flight ('least_outstanding'),
+# or to the one with the lowest expected wait, meaning its smoothed
+# time-to-first-token multiplied by its queue ('latency').
+#
+# A caller stays on the endpoint that served them before, so Ollama can reuse
+# the conversation's prompt cache. The caller only moves if that endpoint is
+# ejected or much busier than the rest.
+#
+# An endpoint is ejected after repeated failures and retried with
+# exponential backoff. A background thread health-checks every endpoint
+# (GET /api/tags) and brings recovered ones back.
+
+LB_STRATEGIES = ('least_outstanding', 'latency')
+
+class LLMEndpoint:
+    def __init__(self, url):
+        self.url = url
+        parts = urlsplit(url)
+        self.base_url = f"{parts.scheme}://{parts.netloc}"
+        self.outstanding = 0
+        self.latency_ms = None      # EWMA of time to first token
+        self.requests = 0
+        self.failures = 0           # consecutive
+        self.ejections = 0
+        self.ejected_until = 0
+        self.last_error = None
+
+    def available(self, now):
+        return self.ejected_until <= now
+
+    def stats(self, now):
+        return {
+            "url": self.url,
+            "healthy": self.available(now),
+            "outstanding": self.outstanding,
+            "latency_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "requests": self.requests,
+            "consecutive_failures": self.failures,
+            "ejected_for_seconds": round(max(0, self.ejected_until - now), 1),
+            "last_error": self.last_error
+        }
+
+class LLMEndpointPool:
+    """Picks an endpoint per request; callers report back with release()"""
+
+    def __init__(self, urls, strategy='least_outstanding', max_failures=2, base_backoff=5.0, max_backoff=60.0,
+                 health_interval=10.0, sticky_size=10000, sticky_ttl=1800, sticky_slack=4):
+        if strategy not in LB_STRATEGIES:
+            raise ValueError(f"strategy must be one of {LB_STRATEGIES}")
+        self.endpoints = [LLMEndpoint(url) for url in urls]
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.health_interval = health_interval
+        self.sticky = OrderedDict()     # session key -> (endpoint, last used)
+        self.sticky_size = sticky_size
+        self.sticky_ttl = sticky_ttl
+        self.sticky_slack = sticky_slack
+        self.lock = threading.Lock()
+        self.health_thread = None
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def _cost(self, endpoint):
+        if self.strategy == 'latency':
+            # Unmeasured endpoints look cheap so they get tried
+            return (endpoint.latency_ms or 0) * (endpoint.outstanding + 1), endpoint.outstanding
+        return endpoint.outstanding, endpoint.latency_ms or 0
+
+    def acquire(self, session_key=None, exclude=()):
+        """Endpoint for the next request (counted as outstanding), or None if all are excluded"""
+        self._ensure_health_checks()
+        with self.lock:
+            now = time.time()
+            candidates = [e for e in self.endpoints if e.url not in exclude]
+            if not candidates:
+                return None
+            healthy = [e for e in candidates if e.available(now)]
+            if not healthy:
+                # Everything is ejected: try the one that comes back soonest rather than fail outright
+                healthy = [min(candidates, key=lambda e: e.ejected_until)]
+            best = min(healthy, key=self._cost)
+            chosen = best
+            if session_key is not None:
+                entry = self.sticky.get(session_key)
+                if entry and now - entry[1] < self.sticky_ttl and entry[0] in healthy and \
+                        entry[0].outstanding - best.outstanding <= self.sticky_slack:
+                    chosen = entry[0]
+                self.sticky[session_key] = (chosen, now)
+                self.sticky.move_to_end(session_key)
+                while len(self.sticky) > self.sticky_size:
+                    self.sticky.popitem(last=False)
+            chosen.outstanding += 1
+            chosen.requests += 1
+            return chosen
+
+    def release(self, endpoint, error=None, latency_ms=None):
+        """Report the outcome of a request made with acquire()"""
+        with self.lock:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+            if error is None:
+                endpoint.failures = 0
+                endpoint.ejections = 0
+                if latency_ms is not None:
+                    endpoint.latency_ms = latency_ms if endpoint.latency_ms is None else \
+                        0.8 * endpoint.latency_ms + 0.2 * latency_ms
+            else:
+                endpoint.failures += 1
+                endpoint.last_error = str(error)[:200]
+                if endpoint.failures >= self.max_failures:
+                    self._eject(endpoint)
+
+    def _eject(self, endpoint):
+        endpoint.ejections += 1
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** (endpoint.ejections - 1))
+        endpoint.ejected_until = time.time() + backoff
+        print(f"[LLM Pool] Ejected {endpoint.url} for {backoff:.0f}s: {endpoint.last_error}")
+
+    # --- Health checks ---
+
+    def _ensure_health_checks(self):
+        if self.health_interval and (self.health_thread is None or not self.health_thread.is_alive()):
+            with self.lock:
+                if self.health_thread is None or not self.health_thread.is_alive():
+                    self.health_thread = threading.Thread(target=self._health_loop, daemon=True, name='llm-health')
+                    self.health_thread.start()
+
+    def check_health(self):
+        """Probe every endpoint once; ejected ones are only probed after their backoff"""
+        for endpoint in self.endpoints:
+            if not endpoint.available(time.time()):
+                continue
+            try:
+                response = requests.get(f"{endpoint.base_url}/api/tags", timeout=3)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                with self.lock:
+                    endpoint.failures = self.max_failures
+                    endpoint.last_error = f"health check: {e}"[:200]
+                    self._eject(endpoint)
+                continue
+            with self.lock:
+                if endpoint.failures or endpoint.ejections:
+                    print(f"[LLM Pool] {endpoint.url} is healthy again")
+                endpoint.failures = 0
+                endpoint.ejections = 0
+                endpoint.ejected_until = 0
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            try:
+                self.check_health()
+            except Exception as e:
+                print(f"[LLM Pool] Health check error: {e}")
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return {
+                "strategy": self.strategy,
+                "sticky_sessions": len(self.sticky),
+                "endpoints": [e.stats(now) for e in self.endpoints]
+            }
+
+# --- Local stub for testing: python llm_pool_utils.py ---
+
+def start_stub_ollama(port=0, first_token_delay=0.05, fail=False, tokens=('Hello', ' there', '.')):
+    """Minimal Ollama look-alike (/api/chat streaming, /api/tags) on a background thread"""
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if fail:
+                self.send_error(503)
+                return
+            body = json.dumps({"models": [{"name": "llama3"}]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if fail:
+                self.send_error(503)
+                return
+            time.sleep(first_token_delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            for token in tokens:
+                self.wfile.write(json.dumps({"message": {"role": "assistant", "content": token}}).encode() + b'\n')
+                self.wfile.flush()
+            self.wfile.write(json.dumps({"done": True}).encode() + b'\n')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/api/chat"
+
+if __name__ == '__main__':
+    # Three stubs (fast, slow, failing); 60 concurrent chats from 10 callers
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import Counter
+    import hf_utils
+
+    stubs = [start_stub_ollama(first_token_delay=0.02), start_stub_ollama(first_token_delay=0.2),
+             start_stub_ollama(fail=True)]
+    for strategy in LB_STRATEGIES:
+        hf_utils.llm_pool = LLMEndpointPool([url for _, url in stubs], strategy=strategy, health_interval=1)
+
+        def chat(i):
+            reply = hf_utils.llama3_chat_completion(f"question {i}", session_key=f"+1555000{i % 10:04d}")
+            return reply
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            replies = list(pool.map(chat, range(60)))
+        print(f"\n{strategy}: {Counter(replies)}")
+        for endpoint in hf_utils.llm_pool.stats()['endpoints']:
+            print(f"  {endpoint}")
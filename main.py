@@ -1,5 +1,5 @@
 import os
-from fastapi import FastAPI, Request, Body
+from fastapi import FastAPI, Request, Body, WebSocket, WebSocketDisconnect
 from fastapi.responses import PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from twilio.twiml.voice_response import VoiceResponse, Gather
@@ -7,17 +7,35 @@ from twilio.rest import Client
 import requests
 import sqlite3
 from dotenv import load_dotenv
-from appointment_utils import create_appointment, save_user_memory, load_user_memory
-from hf_utils import hf_intent_classification, hf_sentiment_analysis, llama3_chat_completion
+from appointment_utils import create_appointment, save_user_memory
+from caller_utils import caller_context
+from profiler_utils import turn_profiler, profiled_turn
+from availability_utils import (init_availability_tables, availability, SlotUnavailable,
+                                parse_appointment_time, parse_spoken_datetime, describe_slot)
+from search_utils import init_search_index, search_appointments
+from stats_utils import init_stats_tables, backfill_rollups, get_dashboard_stats
+from messaging_utils import (init_reminder_tables, reminder_dispatcher, set_reminder_channel, known_email,
+                             reminder_settings, valid_twilio_request, REMINDER_CHANNELS, MESSAGE_CHANNELS)
+from rescore_utils import init_rescore_table, get_rescore_jobs
+from archive_utils import init_archive_tables, call_archive, set_retention_days, enable_incremental_vacuum
+from events_utils import init_events_table, change_feed, format_sse, latest_event_id
+from cache_utils import init_version_table, cached_json_response
+from import_utils import ChunkLineReader, import_from_reader
+from stream_utils import MediaStreamSession, twiml_for_stream
+from worker_utils import (MODEL_WORKERS_ENABLED, ModelWorkerBusy, start_model_workers,
+                          stop_model_workers, model_pools, transcribe_audio, transcribe_pcm, transcribe_wav2vec2,
+                          synthesize, classify)
+from hf_utils import keyword_intent, top_label, normalize_intent, normalize_sentiment, llama3_chat_completion, llama3_chat_stream, llm_pool
 from whisper_utils import whisper_transcribe
-from tts_utils import coqui_tts
+from tts_utils import coqui_tts, start_speech_reply, speech_replies
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, FileResponse
 from fastapi import Form
 import pathlib
 import json
 from datetime import datetime, timedelta
 import uuid
+import asyncio
 
 # Load environment variables
 load_dotenv()
@@ -26,6 +44,9 @@ TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
 TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER')
 
+# Speak dialog replies with Coqui TTS, synthesized sentence by sentence as Llama 3 generates
+TTS_PIPELINE = os.getenv('TTS_PIPELINE', '0') == '1'
+
 # Initialize Twilio client for outbound calls
 twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN) if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN else None
 
@@ -39,6 +60,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def start_workers():
+    # Fork model worker processes after the models are loaded (MODEL_WORKERS=1)
+    if MODEL_WORKERS_ENABLED:
+        start_model_workers()
+    # Move call logs past the retention policy into the compressed archive
+    call_archive.start()
+    # Send due SMS/email reminders
+    reminder_dispatcher.start()
+    # Keep the admin change feed's history bounded
+    change_feed.start_pruning()
+
+@app.on_event("shutdown")
+def stop_workers():
+    stop_model_workers()
+
 # --- Simple in-memory session state (for demo) ---
 session_state = {}
 
@@ -47,6 +84,10 @@ def init_db():
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
     
+    # Lets the call log archiver hand freed pages back a few at a time.
+    # Only takes effect on a new database; see enable_incremental_vacuum().
+    c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    
     # Appointments table
     c.execute('''CREATE TABLE IF NOT EXISTS appointments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -88,6 +129,30 @@ def init_db():
                'You are a friendly and clear-speaking AI assistant for a medical appointment booking system. Always respond in a polite and casual tone. Keep your replies short, helpful, and easy to speak aloud. Help users book, reschedule, or cancel appointments, and answer questions about services.',
                1))
     
+    # Providers, durations and weekly working hours for slot availability
+    init_availability_tables(conn)
+    
+    # Reminder preference per appointment and SMS/email delivery tracking
+    init_reminder_tables(conn)
+    
+    # Appointment search indexes (FTS5, kept in sync by triggers)
+    init_search_index(conn)
+    
+    # Dashboard rollup tables (maintained by triggers)
+    init_stats_tables(conn)
+    
+    # Change feed for the admin console (appended by triggers)
+    init_events_table(conn)
+    
+    # Call log retention policy
+    init_archive_tables(conn)
+    
+    # Checkpoints for intent/sentiment re-scoring jobs (python rescore_utils.py)
+    init_rescore_table(conn)
+    
+    # Per-table versions behind the list routes' ETags (bumped by triggers)
+    init_version_table(conn)
+    
     conn.commit()
     conn.close()
 
@@ -98,9 +163,33 @@ BASE_DIR = pathlib.Path(__file__).parent.resolve()
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
 
 # --- Helper Functions ---
+def mark_changed():
+    """Call after a write to push it to the change feed now rather than on the next poll
+    (cached list responses are invalidated by the table_versions triggers)"""
+    change_feed.notify()
+
+def appointments_changed(*phones):
+    """mark_changed for appointment writes; also refreshes the affected callers' cached context
+    (every cached caller when no numbers are given, e.g. after a bulk import)"""
+    mark_changed()
+    caller_context.refresh_appointments(*phones)
+
+def appointment_phone(appointment_id):
+    """Phone number on an appointment, read before it is updated or deleted"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('SELECT phone FROM appointments WHERE id = ?', (appointment_id,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
 def log_call(phone_number, user_name, conversation_data, intent, sentiment, duration_seconds=0):
     """Log call details to database"""
     call_id = str(uuid.uuid4())
+    # Store one label vocabulary (book/.../unknown, positive/neutral/negative) whatever
+    # model answered, so rollups and the re-scoring job agree
+    intent = normalize_intent(intent)
+    sentiment = normalize_sentiment(sentiment)
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
     c.execute('''INSERT INTO call_logs 
@@ -109,6 +198,7 @@ def log_call(phone_number, user_name, conversation_data, intent, sentiment, dura
               (call_id, phone_number, user_name, json.dumps(conversation_data), intent, sentiment, duration_seconds))
     conn.commit()
     conn.close()
+    mark_changed()
     return call_id
 
 def get_active_system_prompt():
@@ -134,6 +224,7 @@ def update_system_prompt(scenario_name, prompt_text, make_active=False):
     
     conn.commit()
     conn.close()
+    mark_changed()
 
 def make_reminder_call(phone_number, appointment_data):
     """Make an outbound reminder call"""
@@ -155,7 +246,7 @@ def make_reminder_call(phone_number, appointment_data):
             from_=TWILIO_PHONE_NUMBER,
             method='POST',
             status_callback=f"http://localhost:8000/twilio/status-callback",
-            status_callback_event=['completed'],
+            status_callback_event=['initiated', 'ringing', 'completed'],
             status_callback_method='POST'
         )
         
@@ -177,7 +268,7 @@ def get_upcoming_appointments(hours_ahead=24):
     now_str = now.strftime('%Y-%m-%d %H:%M:%S')
     future_str = future_time.strftime('%Y-%m-%d %H:%M:%S')
     
-    c.execute('''SELECT id, name, phone, datetime, service, notes, status 
+    c.execute('''SELECT id, name, phone, datetime, service, notes, status, reminder_channel 
                   FROM appointments 
                   WHERE datetime >= ? AND datetime <= ? AND status = 'scheduled'
                   ORDER BY datetime''', 
@@ -192,7 +283,8 @@ def get_upcoming_appointments(hours_ahead=24):
             'datetime': row[3],
             'service': row[4],
             'notes': row[5],
-            'status': row[6]
+            'status': row[6],
+            'reminder_channel': row[7]
         })
     
     conn.close()
@@ -247,8 +339,11 @@ def admin_reminders(request: Request):
 
 # --- Admin API Endpoints ---
 @app.get("/api/admin/appointments")
-def get_appointments_api():
+def get_appointments_api(request: Request):
     """Get all appointments as JSON"""
+    return cached_json_response(request, 'admin_appointments', ['appointments'], build_appointments_payload)
+
+def build_appointments_payload():
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
     c.execute('''SELECT id, name, phone, datetime, service, notes, status, created_at 
@@ -272,9 +367,20 @@ def get_appointments_api():
         ]
     }
 
+@app.get("/api/admin/appointments/search")
+def search_appointments_api(q: str = "", limit: int = 20):
+    """Search appointments by phone suffix, name prefix, or misspelled name"""
+    if not q.strip():
+        return JSONResponse({"error": "Query parameter 'q' is required"}, status_code=400)
+    limit = max(1, min(limit, 100))
+    return {"query": q, "appointments": search_appointments(q, limit=limit)}
+
 @app.get("/api/admin/calls")
-def get_calls_api():
+def get_calls_api(request: Request):
     """Get all call logs as JSON"""
+    return cached_json_response(request, 'admin_calls', ['call_logs'], build_calls_payload)
+
+def build_calls_payload():
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
     c.execute('''SELECT id, call_id, phone_number, user_name, conversation_data, 
@@ -300,9 +406,206 @@ def get_calls_api():
         ]
     }
 
+@app.get("/api/admin/calls/archive")
+def search_archived_calls_api(phone: str = None, start: str = None, end: str = None, limit: int = 50):
+    """Archived call logs (without transcripts) by phone number and/or created_at range"""
+    limit = max(1, min(limit, 500))
+    return {"calls": call_archive.find(phone=phone, start=start, end=end, limit=limit)}
+
+@app.get("/api/admin/calls/{call_id}")
+def get_call_api(call_id: str):
+    """One call log with its transcript, from the main database or the archive"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('''SELECT id, call_id, phone_number, user_name, conversation_data,
+                         intent, sentiment, duration_seconds, created_at
+                  FROM call_logs WHERE call_id = ?''', (call_id,))
+    row = c.fetchone()
+    conn.close()
+    if row:
+        return {
+            "id": row[0],
+            "call_id": row[1],
+            "phone_number": row[2],
+            "user_name": row[3],
+            "conversation_data": json.loads(row[4]) if row[4] else [],
+            "intent": row[5],
+            "sentiment": row[6],
+            "duration_seconds": row[7],
+            "created_at": row[8],
+            "archived": False
+        }
+    record = call_archive.get(call_id)
+    if not record:
+        return JSONResponse({"error": "Call not found"}, status_code=404)
+    return {**record, "archived": True}
+
+@app.get("/api/admin/rescore-jobs")
+def get_rescore_jobs_api():
+    """Progress of intent/sentiment re-scoring jobs"""
+    return {"jobs": get_rescore_jobs()}
+
+@app.get("/api/admin/archive")
+def get_archive_api():
+    """Retention policy, archive size and main database size"""
+    return call_archive.stats()
+
+@app.post("/api/admin/archive/policy")
+def set_archive_policy_api(data: dict = Body(...)):
+    """Set how many days of call logs stay in the main database (0 keeps everything)"""
+    try:
+        set_retention_days(data.get("keep_days"))
+    except (TypeError, ValueError) as e:
+        return JSONResponse({"error": f"Invalid keep_days: {e}"}, status_code=400)
+    return call_archive.stats()
+
+@app.post("/api/admin/archive/run")
+def run_archive_api(data: dict = Body(default={})):
+    """Apply the retention policy now: {keep_days, vacuum_pages} override the defaults"""
+    try:
+        return call_archive.run(keep_days=data.get("keep_days"), vacuum_pages=int(data.get("vacuum_pages", 20000)))
+    except (TypeError, ValueError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+@app.post("/api/admin/archive/enable-incremental-vacuum")
+def enable_incremental_vacuum_api():
+    """One-off full VACUUM that switches an existing database to incremental vacuum"""
+    return {"incremental_vacuum": enable_incremental_vacuum()}
+
+@app.get("/api/admin/stats")
+def get_stats_api(days: int = 7):
+    """Dashboard counts by intent, sentiment, day and appointment status"""
+    days = max(1, min(days, 366))
+    return get_dashboard_stats(days=days)
+
+@app.post("/api/admin/stats/backfill")
+def backfill_stats_api():
+    """Rebuild the dashboard rollup tables from the raw tables"""
+    conn = sqlite3.connect('appointments.db')
+    backfill_rollups(conn)
+    conn.commit()
+    conn.close()
+    return {"status": "success", "message": "Rollup tables rebuilt"}
+
+@app.get("/api/admin/events")
+async def admin_events_stream(request: Request, last_event_id: int = None):
+    """Server-sent events feed of appointment and call-log changes"""
+    # EventSource sends Last-Event-ID on reconnect; new clients start from now
+    header_id = request.headers.get('last-event-id')
+    if last_event_id is None and header_id and header_id.isdigit():
+        last_event_id = int(header_id)
+    if last_event_id is None:
+        last_event_id = latest_event_id()
+    
+    async def event_stream():
+        yield 'retry: 3000\n\n'
+        async for event in change_feed.subscribe(last_event_id):
+            if await request.is_disconnected():
+                break
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield format_sse(event)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.get("/api/admin/workers")
+def get_workers_api():
+    """Model worker pool status"""
+    return {
+        "enabled": MODEL_WORKERS_ENABLED,
+        "pools": {name: pool.stats() for name, pool in model_pools.items()}
+    }
+
+@app.get("/api/availability")
+def get_availability(service: str = None, date: str = None, start: str = None, end: str = None,
+                     provider: str = None, duration: int = None, limit: int = 20):
+    """Free slots for a day (date=YYYY-MM-DD) or between start and end"""
+    if date:
+        range_start = parse_appointment_time(f"{date} 00:00")
+        range_end = range_start + timedelta(days=1) if range_start else None
+    else:
+        range_start = parse_appointment_time(start) if start else datetime.now()
+        range_end = parse_appointment_time(end) if end else (range_start + timedelta(days=7) if range_start else None)
+    if not range_start or not range_end:
+        return JSONResponse({"error": "Invalid date range"}, status_code=400)
+    slots = availability.free_slots(range_start, range_end, service, provider, duration, limit=min(limit, 200))
+    return {"slots": slots}
+
+@app.get("/api/availability/check")
+def check_availability(datetime: str, service: str = None, provider: str = None, duration: int = None):
+    """Whether a time can be booked, with the conflicting appointments and nearby alternatives"""
+    start = parse_appointment_time(datetime)
+    if not start:
+        return JSONResponse({"error": "Invalid datetime"}, status_code=400)
+    return availability.check(start, service, provider, duration)
+
+@app.get("/api/admin/schedules")
+def get_schedules_api():
+    """Weekly working hours per provider"""
+    return {"schedules": availability.get_schedules()}
+
+@app.post("/api/admin/schedules")
+def set_schedule_api(data: dict = Body(...)):
+    """Replace one provider's weekly hours"""
+    provider = data.get("provider")
+    entries = data.get("entries")
+    if not provider or not isinstance(entries, list):
+        return JSONResponse({"error": "provider and entries are required"}, status_code=400)
+    try:
+        availability.set_schedule(provider, entries)
+    except (KeyError, ValueError, TypeError) as e:
+        return JSONResponse({"error": f"Invalid schedule entry: {e}"}, status_code=400)
+    return {"status": "success", "schedules": availability.get_schedules()}
+
+@app.get("/api/admin/profiler")
+def get_profiler_api():
+    """Profiler settings and captured slow-turn profiles"""
+    return {**turn_profiler.status(), "profiles": turn_profiler.list_profiles()}
+
+@app.post("/api/admin/profiler")
+def configure_profiler_api(data: dict = Body(...)):
+    """Switch turn profiling on/off: {enabled, sample_rate, phone, threshold_ms, interval_ms, duration_minutes}"""
+    try:
+        turn_profiler.configure(
+            enabled=data.get("enabled", True),
+            sample_rate=data.get("sample_rate", 1.0),
+            phone=data.get("phone"),
+            threshold_ms=data.get("threshold_ms", 2000),
+            interval_ms=data.get("interval_ms", 5),
+            duration_minutes=data.get("duration_minutes", 30)
+        )
+    except (TypeError, ValueError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return turn_profiler.status()
+
+@app.get("/api/admin/profiler/profiles/{name}")
+def download_profile(name: str):
+    """Collapsed stacks for one slow turn (for flamegraph.pl, speedscope or inferno)"""
+    path = turn_profiler.profile_path(name)
+    if not path:
+        return JSONResponse({"error": "Profile not found"}, status_code=404)
+    return FileResponse(path, media_type="text/plain", filename=name)
+
+@app.get("/api/admin/llm-backends")
+def get_llm_backends_api():
+    """Ollama endpoint pool: health, load and latency per endpoint"""
+    return llm_pool.stats()
+
+@app.get("/api/admin/caller-cache")
+def get_caller_cache_api():
+    """Caller context cache status"""
+    return caller_context.stats()
+
 @app.get("/api/admin/prompts")
-def get_prompts_api():
+def get_prompts_api(request: Request):
     """Get all system prompts as JSON"""
+    return cached_json_response(request, 'admin_prompts', ['system_prompts'], build_prompts_payload)
+
+def build_prompts_payload():
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
     c.execute('SELECT id, scenario_name, prompt_text, is_active, created_at FROM system_prompts')
@@ -335,6 +638,35 @@ def create_prompt_api(data: dict = Body(...)):
     update_system_prompt(scenario_name, prompt_text, make_active)
     return {"status": "success", "message": "Prompt updated successfully"}
 
+@app.post("/api/admin/appointments/import")
+async def import_appointments_api(request: Request, format: str = None):
+    """Bulk import appointments from a streamed CSV or NDJSON body"""
+    content_type = request.headers.get('content-type', '')
+    fmt = (format or ('ndjson' if 'ndjson' in content_type or 'jsonl' in content_type else 'csv')).lower()
+    if fmt not in ('csv', 'ndjson'):
+        return JSONResponse({"error": "format must be 'csv' or 'ndjson'"}, status_code=400)
+    
+    # Parse and insert on a worker thread while the body is still arriving
+    loop = asyncio.get_running_loop()
+    reader = ChunkLineReader()
+    worker = loop.run_in_executor(None, import_from_reader, reader, fmt)
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await loop.run_in_executor(None, reader.feed, chunk)
+    finally:
+        await loop.run_in_executor(None, reader.feed, None)
+    
+    try:
+        summary = await worker
+    except Exception as e:
+        print("[Bulk Import Error]", e)
+        return JSONResponse({"error": f"Import failed: {e}"}, status_code=500)
+    finally:
+        appointments_changed()
+    
+    return {"status": "success", **summary}
+
 @app.put("/api/admin/appointments/{appointment_id}")
 def update_appointment_api(appointment_id: int, data: dict = Body(...)):
     """Update appointment status"""
@@ -342,11 +674,13 @@ def update_appointment_api(appointment_id: int, data: dict = Body(...)):
     if not status:
         return JSONResponse({"error": "Status is required"}, status_code=400)
     
+    phone = appointment_phone(appointment_id)
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
     c.execute("UPDATE appointments SET status = ? WHERE id = ?", (status, appointment_id))
     conn.commit()
     conn.close()
+    appointments_changed(phone)
     
     return {"status": "success", "message": "Appointment updated successfully"}
 
@@ -364,16 +698,30 @@ def new_appointment_form(request: Request):
 @app.post("/appointments/new")
 def create_appointment_form(request: Request, name: str = Form(...), phone: str = Form(...), datetime: str = Form(...), notes: str = Form("")):
     from appointment_utils import create_appointment
-    create_appointment(name, phone, datetime, notes)
+    start = parse_appointment_time(datetime)
+    if start:
+        try:
+            availability.book(name, phone, start, notes=notes, within_schedule=False)
+        except SlotUnavailable as e:
+            free = ', '.join(slot['start'][:16] for slot in e.alternatives)
+            return templates.TemplateResponse("new.html", {
+                "request": request,
+                "error": f"{start.strftime('%Y-%m-%d %H:%M')} is already booked." + (f" Free: {free}" if free else "")
+            }, status_code=409)
+    else:
+        create_appointment(name, phone, datetime, notes)
+    appointments_changed(phone)
     return RedirectResponse(url="/", status_code=303)
 
 @app.post("/appointments/{appointment_id}/delete")
 def delete_appointment_form(appointment_id: int):
+    phone = appointment_phone(appointment_id)
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
     c.execute("DELETE FROM appointments WHERE id = ?", (appointment_id,))
     conn.commit()
     conn.close()
+    appointments_changed(phone)
     return RedirectResponse(url="/", status_code=303)
 
 @app.get("/health")
@@ -383,21 +731,33 @@ def health():
 @app.post("/twilio/webhook", response_class=PlainTextResponse)
 async def twilio_webhook(request: Request):
     print("Twilio webhook called")
-    resp = VoiceResponse()
-    call_start_time = datetime.now()
-    conversation_data = []
-    
     try:
         form = await request.form()
         print("Form data received:", form)
         speech_result = form.get('SpeechResult')
         from_number = form.get('From')
         attempt = int(form.get('attempt', 1)) if 'attempt' in form else 1
-        
-        # --- Persistent memory: Load from DB if not in session ---
+    except Exception as e:
+        print("[Twilio Webhook Error]", e)
+        resp = VoiceResponse()
+        resp.say('Sorry, an error occurred. Please try again later. Goodbye!')
+        resp.hangup()
+        return str(resp)
+    
+    return dialog_turn(from_number, speech_result, attempt)
+
+@profiled_turn
+def dialog_turn(from_number, speech_result, attempt=1):
+    """Run one step of the voice dialog for a caller and return the TwiML reply"""
+    resp = VoiceResponse()
+    call_start_time = datetime.now()
+    conversation_data = []
+    
+    try:
+        # --- Persistent memory: loaded in the background while the greeting plays ---
         if from_number not in session_state:
-            user_memory = load_user_memory(from_number)
-            session_state[from_number] = {'history': user_memory, 'step': 'greet'}
+            caller_context.warm(from_number)
+            session_state[from_number] = {'step': 'greet'}
         state = session_state[from_number]
 
         # --- Step 1: Service Introduction ---
@@ -406,7 +766,7 @@ async def twilio_webhook(request: Request):
             gather.say('Welcome to Smart Appointment Services! I am your virtual assistant. I can help you book, reschedule, or cancel appointments, and answer questions about our services. How can I help you today?')
             resp.append(gather)
             resp.say('I did not hear anything. Please say if you want to book, reschedule, or cancel an appointment, or ask about our services.')
-            session_state[from_number] = {"step": "intent"}
+            session_state[from_number] = {"step": "intent", "history": state.get("history")}
             
             # Log the greeting
             conversation_data.append({
@@ -440,36 +800,26 @@ async def twilio_webhook(request: Request):
             })
             
             # --- Enhanced: Detect intent and sentiment ---
-            intent_result = hf_intent_classification(speech_result)
-            sentiment_result = hf_sentiment_analysis(speech_result)
+            # Local models in the classify worker pool when MODEL_WORKERS=1, else the Inference API
+            intent_result = classify(speech_result, task='intent')
+            sentiment_result = classify(speech_result, task='sentiment')
             
-            # Extract intent and sentiment labels (fallback to 'unknown' if not found)
-            intent_label = None
-            if isinstance(intent_result, dict):
-                if 'error' in intent_result:
-                    intent_label = 'unknown'
-                elif isinstance(intent_result, list) and len(intent_result) > 0 and 'label' in intent_result[0]:
-                    intent_label = intent_result[0]['label']
-                elif 'label' in intent_result:
-                    intent_label = intent_result['label']
+            # Extract intent and sentiment labels (API and pipeline responses differ in shape)
+            intent_label = top_label(intent_result)
             if not intent_label:
                 # fallback to keyword logic
-                intent_label = "book" if "book" in speech_result.lower() else ("reschedule" if "reschedule" in speech_result.lower() else ("cancel" if "cancel" in speech_result.lower() else ("service" if "service" in speech_result.lower() or "offer" in speech_result.lower() else "unknown")))
+                intent_label = keyword_intent(speech_result)
             
-            sentiment_label = None
-            if isinstance(sentiment_result, dict):
-                if 'error' in sentiment_result:
-                    sentiment_label = 'neutral'
-                elif isinstance(sentiment_result, list) and len(sentiment_result) > 0 and 'label' in sentiment_result[0]:
-                    sentiment_label = sentiment_result[0]['label']
-                elif 'label' in sentiment_result:
-                    sentiment_label = sentiment_result['label']
+            sentiment_label = top_label(sentiment_result)
             if not sentiment_label:
                 sentiment_label = 'neutral'
             
             # --- Advanced Memory: Store rolling history of last 5 user inputs, intents, sentiments ---
             session_state[from_number] = session_state.get(from_number, {})
-            history = session_state[from_number].get('history', [])
+            caller = caller_context.get(from_number)
+            history = session_state[from_number].get('history')
+            if history is None:
+                history = caller['memory']
             history.append({
                 'input': speech_result,
                 'intent': intent_label,
@@ -481,11 +831,24 @@ async def twilio_webhook(request: Request):
             
             # Save persistent memory after each turn
             save_user_memory(from_number, history)
+            caller_context.set_memory(from_number, history)
+            
+            # A booking request starts the guided booking steps (service, time, name, reminder)
+            if normalize_intent(intent_label) == 'book':
+                gather = Gather(input='speech', action='/twilio/webhook', method='POST', timeout=10)
+                gather.say('Sure! Which service would you like to book, like consultation, check-up, or therapy session?')
+                resp.append(gather)
+                session_state[from_number] = {"step": "ask_service", "history": history}
+                return str(resp)
             
             # Build a memory string for Llama 3
             memory_str = ''
             for h in history[:-1]:
                 memory_str += f"User said: '{h['input']}' (intent: {h['intent']}, sentiment: {h['sentiment']}).\n"
+            if intent_label in ('reschedule', 'cancel') and caller['appointments']:
+                memory_str += "The caller's upcoming appointments: " + "; ".join(
+                    f"{a['service'] or 'appointment'} on {a['datetime']}" for a in caller['appointments']
+                ) + ".\n"
             
             # --- Enhanced: Build system prompt for Llama 3 with memory ---
             system_prompt = get_active_system_prompt()
@@ -494,20 +857,6 @@ async def twilio_webhook(request: Request):
 
 The user intent is {intent_label}, and the user sentiment is {sentiment_label}. If the user seems negative or angry, soften your tone and show empathy. If the user is happy, sound more cheerful. Use simple, human-friendly words. Add polite conversational fillers like 'sure!', 'got it!', or 'let me check!' to make the tone more friendly. Break long answers into short sentences (ideally under 15 words) so the TTS sounds natural. Here is some context from earlier in the conversation: {memory_str} User: {speech_result} Assistant:"""
             
-            # --- Enhanced: Get Llama 3 response ---
-            ai_response = llama3_chat_completion(speech_result, system_prompt=enhanced_prompt)
-            
-            # --- Fallback logic if Llama 3 fails ---
-            if not ai_response or 'Sorry, I could not process' in ai_response or len(ai_response.strip()) < 2:
-                ai_response = "Hmm, I'm still learning that. Would you like me to search more?"
-            
-            # Log AI response
-            conversation_data.append({
-                "timestamp": datetime.now().isoformat(),
-                "speaker": "ai",
-                "message": ai_response
-            })
-            
             # --- Enhanced: Post-process for TTS ---
             import re
             def split_sentences(text):
@@ -522,10 +871,36 @@ The user intent is {intent_label}, and the user sentiment is {sentiment_label}.
                 else:
                     return sentence
             
-            sentences = split_sentences(ai_response)
-            
             # If user says goodbye/bye, end the call, else keep the session open for more questions
             end_keywords = ['goodbye', 'bye', 'see you', 'exit', 'quit']
+            
+            # --- Pipelined speech: synthesize each sentence while Llama 3 is still generating ---
+            if TTS_PIPELINE and not any(kw in speech_result.lower() for kw in end_keywords):
+                reply = start_speech_reply(
+                    llama3_chat_stream(speech_result, system_prompt=enhanced_prompt, session_key=from_number),
+                    transform=lambda s: add_filler(s, sentiment_label),
+                    max_sentences=4,
+                    synthesize=synthesize
+                )
+                session_state[from_number]["step"] = "intent"
+                return speech_reply_twiml(reply, 0)
+            
+            # --- Enhanced: Get Llama 3 response ---
+            ai_response = llama3_chat_completion(speech_result, system_prompt=enhanced_prompt, session_key=from_number)
+            
+            # --- Fallback logic if Llama 3 fails ---
+            if not ai_response or 'Sorry, I could not process' in ai_response or len(ai_response.strip()) < 2:
+                ai_response = "Hmm, I'm still learning that. Would you like me to search more?"
+            
+            # Log AI response
+            conversation_data.append({
+                "timestamp": datetime.now().isoformat(),
+                "speaker": "ai",
+                "message": ai_response
+            })
+            
+            sentences = split_sentences(ai_response)
+            
             if any(kw in speech_result.lower() for kw in end_keywords):
                 for i, s in enumerate(sentences[:4]):
                     s = add_filler(s, sentiment_label)
@@ -568,7 +943,36 @@ The user intent is {intent_label}, and the user sentiment is {sentiment_label}.
                 gather.say('Please say the date and time for your appointment.')
                 resp.append(gather)
                 return str(resp)
-            session_state[from_number] = {"step": "ask_name", "service": state.get("service", "General"), "datetime": speech_result}
+            service = state.get("service", "General")
+            requested = parse_spoken_datetime(speech_result, default_day=state.get("offered_day"))
+            if requested:
+                start, end, exact = requested
+                intro = ''
+                if exact:
+                    result = availability.check(start, service)
+                    if result["available"]:
+                        session_state[from_number] = {"step": "ask_name", "service": service,
+                                                      "datetime": start.strftime('%Y-%m-%d %H:%M:%S'),
+                                                      "provider": result["provider"]}
+                        gather = Gather(input='speech', action='/twilio/webhook', method='POST', timeout=10)
+                        gather.say(f'{describe_slot(start)} is available. Can I have your name, please?')
+                        resp.append(gather)
+                        return str(resp)
+                    slots = result["alternatives"]
+                    intro = f'Sorry, {describe_slot(start)} is not available. '
+                else:
+                    slots = availability.free_slots(start, end, service, limit=3)
+                # Offer free times and stay on this step; "at 3" then means the offered day
+                gather = Gather(input='speech', action='/twilio/webhook', method='POST', timeout=10)
+                if slots:
+                    state["offered_day"] = parse_appointment_time(slots[0]["start"]).date()
+                    gather.say(intro + 'The nearest free times are ' + ', '.join(describe_slot(slot["start"]) for slot in slots) + '. Which would you like?')
+                else:
+                    gather.say(intro + 'There are no free times then. Please say another day and time.')
+                resp.append(gather)
+                return str(resp)
+            # No recognisable time: keep the caller's words as before
+            session_state[from_number] = {"step": "ask_name", "service": service, "datetime": speech_result}
             gather = Gather(input='speech', action='/twilio/webhook', method='POST', timeout=10)
             gather.say('Thank you. Can I have your name, please?')
             resp.append(gather)
@@ -584,8 +988,28 @@ The user intent is {intent_label}, and the user sentiment is {sentiment_label}.
             # Save appointment
             dt = state.get("datetime", "TBD")
             service = state.get("service", "General")
-            create_appointment(name=speech_result, phone=from_number, datetime=dt, service=service, notes="booked via AI")
-            session_state[from_number] = {"step": "confirm", "service": service, "datetime": dt, "name": speech_result}
+            if state.get("provider"):
+                try:
+                    booked = availability.book(speech_result, from_number, parse_appointment_time(dt), service,
+                                               notes="booked via AI", provider=state["provider"])
+                except SlotUnavailable as e:
+                    # Taken by someone else since it was offered
+                    session_state[from_number] = {"step": "ask_datetime", "service": service}
+                    gather = Gather(input='speech', action='/twilio/webhook', method='POST', timeout=10)
+                    if e.alternatives:
+                        session_state[from_number]["offered_day"] = parse_appointment_time(e.alternatives[0]["start"]).date()
+                        gather.say('Sorry, that time was just booked. The nearest free times are ' + ', '.join(describe_slot(slot["start"]) for slot in e.alternatives) + '. Which would you like?')
+                    else:
+                        gather.say('Sorry, that time was just booked. Please say another day and time.')
+                    resp.append(gather)
+                    return str(resp)
+                dt = describe_slot(dt)
+                appointment_id = booked["id"]
+            else:
+                appointment_id = create_appointment(name=speech_result, phone=from_number, datetime=dt, service=service, notes="booked via AI")
+            appointments_changed(from_number)
+            session_state[from_number] = {"step": "confirm", "service": service, "datetime": dt, "name": speech_result,
+                                          "appointment_id": appointment_id}
             gather = Gather(input='speech', action='/twilio/webhook', method='POST', timeout=10)
             gather.say(f'Thank you, {speech_result}. Your {service} appointment for {dt} is booked. Would you like a reminder before your appointment?')
             resp.append(gather)
@@ -607,12 +1031,25 @@ The user intent is {intent_label}, and the user sentiment is {sentiment_label}.
 
         # --- Step 7: Reminder Preference ---
         if state["step"] == "reminder_pref":
+            appointment_id = state.get("appointment_id")
             if speech_result and ("sms" in speech_result.lower() or "text" in speech_result.lower()):
+                if appointment_id:
+                    set_reminder_channel(appointment_id, 'sms')
                 resp.say('A reminder will be sent by SMS before your appointment. Thank you for calling! Goodbye!')
             elif speech_result and "email" in speech_result.lower():
-                resp.say('A reminder will be sent by email before your appointment. Thank you for calling! Goodbye!')
+                # An address cannot be taken reliably by voice; use one given on an earlier booking
+                if known_email(from_number):
+                    if appointment_id:
+                        set_reminder_channel(appointment_id, 'email', known_email(from_number))
+                    resp.say('A reminder will be sent by email before your appointment. Thank you for calling! Goodbye!')
+                else:
+                    if appointment_id:
+                        set_reminder_channel(appointment_id, 'sms')
+                    resp.say('We do not have an email address for you yet, so we will send your reminder by SMS. Thank you for calling! Goodbye!')
             else:
                 resp.say('Thank you for calling! Your appointment is confirmed. Goodbye!')
+            if appointment_id:
+                appointments_changed(from_number)
             resp.hangup()
             session_state.pop(from_number, None)
             return str(resp)
@@ -641,6 +1078,7 @@ The user intent is {intent_label}, and the user sentiment is {sentiment_label}.
                 history = history[-5:]
             session_state[from_number]['history'] = history
             save_user_memory(from_number, history)
+            caller_context.set_memory(from_number, history)
             memory_str = ''
             for h in history[:-1]:
                 memory_str += f"User said: '{h['input']}' (intent: {h['intent']}, sentiment: {h['sentiment']}).\n"
@@ -649,7 +1087,7 @@ The user intent is {intent_label}, and the user sentiment is {sentiment_label}.
 {system_prompt}
 
 The user intent is {intent_label}, and the user sentiment is {sentiment_label}. If the user seems negative or angry, soften your tone and show empathy. If the user is happy, sound more cheerful. Use simple, human-friendly words. Add polite conversational fillers like 'sure!', 'got it!', or 'let me check!' to make the tone more friendly. Break long answers into short sentences (ideally under 15 words) so the TTS sounds natural. Here is some context from earlier in the conversation: {memory_str} User: {speech_result} Assistant:"""
-            ai_response = llama3_chat_completion(speech_result, system_prompt=enhanced_prompt)
+            ai_response = llama3_chat_completion(speech_result, system_prompt=enhanced_prompt, session_key=from_number)
             if not ai_response or 'Sorry, I could not process' in ai_response or len(ai_response.strip()) < 2:
                 ai_response = "Hmm, I'm still learning that. Would you like me to search more?"
             import re
@@ -693,6 +1131,7 @@ The user intent is {intent_label}, and the user sentiment is {sentiment_label}.
                 history = history[-5:]
             session_state[from_number]['history'] = history
             save_user_memory(from_number, history)
+            caller_context.set_memory(from_number, history)
             memory_str = ''
             for h in history[:-1]:
                 memory_str += f"User said: '{h['input']}' (intent: {h['intent']}, sentiment: {h['sentiment']}).\n"
@@ -701,7 +1140,7 @@ The user intent is {intent_label}, and the user sentiment is {sentiment_label}.
 {system_prompt}
 
 The user intent is {intent_label}, and the user sentiment is {sentiment_label}. If the user seems negative or angry, soften your tone and show empathy. If the user is happy, sound more cheerful. Use simple, human-friendly words. Add polite conversational fillers like 'sure!', 'got it!', or 'let me check!' to make the tone more friendly. Break long answers into short sentences (ideally under 15 words) so the TTS sounds natural. Here is some context from earlier in the conversation: {memory_str} User: {speech_result} Assistant:"""
-            ai_response = llama3_chat_completion(speech_result, system_prompt=enhanced_prompt)
+            ai_response = llama3_chat_completion(speech_result, system_prompt=enhanced_prompt, session_key=from_number)
             if not ai_response or 'Sorry, I could not process' in ai_response or len(ai_response.strip()) < 2:
                 ai_response = "Hmm, I'm still learning that. Would you like me to search more?"
             import re
@@ -738,6 +1177,144 @@ The user intent is {intent_label}, and the user sentiment is {sentiment_label}.
         resp.hangup()
         return str(resp)
 
+# --- Twilio Media Streams (real-time transcription) ---
+def media_stream_url(connection):
+    """wss:// URL of the media-stream endpoint as seen by Twilio"""
+    host = connection.headers.get('x-forwarded-host') or connection.headers.get('host')
+    proto = connection.headers.get('x-forwarded-proto') or connection.url.scheme
+    scheme = 'wss' if proto in ('https', 'wss') else 'ws'
+    return f"{scheme}://{host}/twilio/media-stream"
+
+@app.post("/twilio/stream-webhook", response_class=PlainTextResponse)
+async def twilio_stream_webhook(request: Request):
+    """Voice webhook that streams caller audio to /twilio/media-stream instead of using <Gather>"""
+    form = await request.form()
+    from_number = form.get('From')
+    twiml = dialog_turn(from_number, None)
+    return twiml_for_stream(twiml, media_stream_url(request), {'from': from_number})
+
+@app.websocket("/twilio/media-stream")
+async def twilio_media_stream(websocket: WebSocket):
+    """Receive <Stream> audio, transcribe utterances locally, and answer through the dialog"""
+    await websocket.accept()
+    loop = asyncio.get_running_loop()
+    session = MediaStreamSession(transcribe_pcm)
+    stream_url = media_stream_url(websocket)
+    
+    try:
+        while True:
+            message = json.loads(await websocket.receive_text())
+            for text in await session.handle_message(message):
+                from_number = session.parameters.get('from')
+                print(f"[Media Stream] {from_number}: {text}")
+                twiml = await loop.run_in_executor(None, dialog_turn, from_number, text)
+                twiml = twiml_for_stream(twiml, stream_url, {'from': from_number})
+                
+                if session.parameters.get('replay'):
+                    # Local replay client: report instead of redirecting a real call
+                    await websocket.send_text(json.dumps({"event": "transcript", "text": text, "twiml": twiml}))
+                elif twilio_client and session.call_sid:
+                    # Redirect the live call: speak the reply, then stream again
+                    await loop.run_in_executor(None, lambda: twilio_client.calls(session.call_sid).update(twiml=twiml))
+            if message.get('event') == 'stop':
+                break
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print("[Media Stream Error]", e)
+
+@app.post("/api/transcribe")
+async def transcribe_api(request: Request, engine: str = "whisper", language: str = None):
+    """Transcribe audio sent as the raw request body (WAV, MP3, OGG, ...), decoded in memory"""
+    data = await request.body()
+    if not data:
+        return JSONResponse({"error": "Audio body is required"}, status_code=400)
+    if engine not in ("whisper", "wav2vec2"):
+        return JSONResponse({"error": "engine must be 'whisper' or 'wav2vec2'"}, status_code=400)
+    
+    loop = asyncio.get_running_loop()
+    try:
+        if engine == "wav2vec2":
+            text = await loop.run_in_executor(None, transcribe_wav2vec2, data)
+        else:
+            text = await loop.run_in_executor(None, lambda: transcribe_audio(data, language=language))
+    except ModelWorkerBusy as e:
+        return JSONResponse({"error": str(e)}, status_code=503)
+    except Exception as e:
+        print("[Transcribe Error]", e)
+        return JSONResponse({"error": f"Could not transcribe audio: {e}"}, status_code=400)
+    return {"engine": engine, "text": text}
+
+# --- Pipelined TTS playback ---
+def speech_reply_twiml(reply, index):
+    """Play clip `index` of a speech reply, then redirect for the next one; ask for the next question when done"""
+    resp = VoiceResponse()
+    path = reply.wait_for_clip(index, timeout=30)
+    if path:
+        resp.play(f"/tts/{reply.id}/{index}.wav")
+        resp.redirect(f"/twilio/tts-play?reply_id={reply.id}&index={index + 1}", method='POST')
+        return str(resp)
+    
+    gather = Gather(input='speech', action='/twilio/webhook', method='POST', timeout=10)
+    if index == 0:
+        # Nothing was synthesized (LLM or TTS failure)
+        gather.say("Hmm, I'm still learning that. Would you like me to search more?")
+    gather.say("If you have another question, please speak after the beep. Or say 'goodbye' to end the call.")
+    resp.append(gather)
+    return str(resp)
+
+@app.post("/twilio/tts-play", response_class=PlainTextResponse)
+async def twilio_tts_play(reply_id: str, index: int = 0):
+    """Continue playing a pipelined reply; the next clip is usually ready while the previous one plays"""
+    reply = speech_replies.get(reply_id)
+    if not reply:
+        resp = VoiceResponse()
+        gather = Gather(input='speech', action='/twilio/webhook', method='POST', timeout=10)
+        gather.say("If you have another question, please speak after the beep. Or say 'goodbye' to end the call.")
+        resp.append(gather)
+        return str(resp)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, speech_reply_twiml, reply, index)
+
+@app.post("/ai/speak")
+async def ai_speak(data: dict = Body(...)):
+    """Start a spoken Llama 3 reply; clips are published one sentence at a time"""
+    message = data.get("message", "")
+    if not message:
+        return JSONResponse({"error": "Please provide a message."}, status_code=400)
+    reply = start_speech_reply(llama3_chat_stream(message), language=data.get("language", "en"), synthesize=synthesize)
+    return {"reply_id": reply.id, "status_url": f"/api/tts/replies/{reply.id}"}
+
+@app.get("/api/tts/replies/{reply_id}")
+def get_speech_reply(reply_id: str):
+    """Clips synthesized so far for a pipelined reply"""
+    reply = speech_replies.get(reply_id)
+    if not reply:
+        return JSONResponse({"error": "Reply not found"}, status_code=404)
+    return {
+        "reply_id": reply.id,
+        "done": reply.done,
+        "error": reply.error,
+        "text": reply.text,
+        "first_clip_seconds": reply.first_clip_seconds,
+        "clips": [
+            {"index": i, "url": f"/tts/{reply.id}/{i}.wav", "text": sentence}
+            for i, sentence in enumerate(list(reply.sentences))
+        ]
+    }
+
+@app.get("/tts/{reply_id}/{index:int}.wav")
+async def get_speech_clip(reply_id: str, index: int):
+    """Serve one clip, waiting for it if it is still being synthesized"""
+    reply = speech_replies.get(reply_id)
+    if not reply:
+        return JSONResponse({"error": "Reply not found"}, status_code=404)
+    loop = asyncio.get_running_loop()
+    path = await loop.run_in_executor(None, reply.wait_for_clip, index, 30)
+    if not path:
+        return JSONResponse({"error": "Clip not available"}, status_code=404)
+    return FileResponse(path, media_type="audio/wav")
+
 @app.post("/twilio/reminder-webhook", response_class=PlainTextResponse)
 async def reminder_webhook(request: Request):
     """Handle outbound reminder calls"""
@@ -781,6 +1358,11 @@ async def status_callback(request: Request):
     # Log the call status
     print(f"Call {call_sid} status: {call_status}")
     
+    # Warm the caller's context before the first dialog turn needs it
+    if call_status in ('initiated', 'ringing'):
+        direction = form_data.get('Direction', 'inbound')
+        caller_context.warm(form_data.get('From') if direction == 'inbound' else form_data.get('To'))
+    
     return {"status": "received"}
 
 # --- Reminder API Endpoints ---
@@ -810,12 +1392,19 @@ async def send_reminder_call(appointment_id: int):
     return result
 
 @app.post("/api/reminders/send-all")
-async def send_all_reminders():
-    """Send reminder calls for all upcoming appointments"""
+def send_all_reminders():
+    """Send SMS/email reminders where the caller chose them, and reminder calls for the rest"""
     upcoming_appointments = get_upcoming_appointments(hours_ahead=24)
+    messages = reminder_dispatcher.dispatch(hours_ahead=24)
+    # A message reminder that could not be queued or has failed falls back to a call
+    covered = reminder_dispatcher.covered(upcoming_appointments)
     
     results = []
     for appointment in upcoming_appointments:
+        if appointment['id'] in covered:
+            continue
+        if appointment['reminder_channel'] in MESSAGE_CHANNELS:
+            print(f"[Reminders] No {appointment['reminder_channel']} delivery for appointment {appointment['id']}; calling instead")
         result = make_reminder_call(appointment['phone'], appointment)
         results.append({
             'appointment_id': appointment['id'],
@@ -826,9 +1415,38 @@ async def send_all_reminders():
     
     return {
         "total_appointments": len(upcoming_appointments),
-        "results": results
+        "results": results,
+        "messages": messages
     }
 
+@app.post("/api/reminders/dispatch")
+def dispatch_reminders_api(hours_ahead: int = 24):
+    """Queue and send due SMS/email reminders now instead of waiting for the next scheduled run"""
+    return reminder_dispatcher.dispatch(hours_ahead=max(1, min(hours_ahead, 168)))
+
+@app.get("/api/reminders/deliveries")
+def get_reminder_deliveries_api(status: str = None, appointment_id: int = None, limit: int = 100):
+    """SMS/email reminder deliveries, newest first, with counts per channel and status"""
+    return {
+        **reminder_dispatcher.stats(),
+        "items": reminder_dispatcher.deliveries(status=status, appointment_id=appointment_id, limit=max(1, min(limit, 1000)))
+    }
+
+@app.post("/twilio/message-status")
+async def message_status_callback(request: Request):
+    """Twilio delivery status for reminder SMS"""
+    form_data = await request.form()
+    if not valid_twilio_request(request.url.path, request.url.query, dict(form_data),
+                                request.headers.get('X-Twilio-Signature', '')):
+        return JSONResponse({"error": "Invalid Twilio signature"}, status_code=403)
+    message_sid = form_data.get('MessageSid', '')
+    message_status = form_data.get('MessageStatus', '')
+    error_code = form_data.get('ErrorCode')
+    print(f"Message {message_sid} status: {message_status}")
+    reminder_dispatcher.update_status(message_sid, message_status, f"Twilio error {error_code}" if error_code else None,
+                                      delivery_id=request.query_params.get('delivery_id'))
+    return {"status": "received"}
+
 @app.get("/api/reminders/upcoming")
 async def get_upcoming_reminders():
     """Get all upcoming appointments that need reminders"""
@@ -836,7 +1454,10 @@ async def get_upcoming_reminders():
     return {"appointments": appointments}
 
 @app.get("/appointments")
-def list_appointments():
+def list_appointments(request: Request):
+    return cached_json_response(request, 'appointments', ['appointments'], build_appointment_list)
+
+def build_appointment_list():
     from appointment_utils import get_appointments
     results = get_appointments()
     # Convert to dicts for JSON response
@@ -859,16 +1480,49 @@ def create_appointment_api(
     phone: str = Body(...),
     datetime: str = Body(...),
     service: str = Body(""),
-    notes: str = Body("")
+    notes: str = Body(""),
+    provider: str = Body(None),
+    duration_minutes: int = Body(None),
+    email: str = Body(None),
+    reminder_channel: str = Body(None)
 ):
     from appointment_utils import create_appointment
-    # service is not used in the current DB schema, but included for future-proofing
-    create_appointment(name, phone, datetime, notes)
-    return {"status": "created"}
+    if reminder_channel is not None and reminder_channel not in REMINDER_CHANNELS:
+        return JSONResponse({"error": f"reminder_channel must be one of {', '.join(REMINDER_CHANNELS)}"}, status_code=400)
+    if reminder_channel == 'email' and not email:
+        return JSONResponse({"error": "An email address is required for email reminders"}, status_code=400)
+    start = parse_appointment_time(datetime)
+    if start:
+        # Parseable times are conflict-checked; working hours are not enforced for staff bookings
+        try:
+            booked = availability.book(name, phone, start, service or None, notes, provider=provider,
+                                       duration=duration_minutes, within_schedule=False)
+        except SlotUnavailable as e:
+            return JSONResponse({"error": str(e), "alternatives": e.alternatives}, status_code=409)
+        if reminder_channel or email:
+            set_reminder_channel(booked["id"], reminder_channel, email)
+        appointments_changed(phone)
+        return {"status": "created", **booked}
+    appointment_id = create_appointment(name, phone, datetime, notes, service=service)
+    if reminder_channel or email:
+        set_reminder_channel(appointment_id, reminder_channel, email)
+    appointments_changed(phone)
+    return {"status": "created", "id": appointment_id}
 
 @app.put("/appointments/{appointment_id}")
-def update_appointment(appointment_id: int, name: str = Body(None), phone: str = Body(None), datetime: str = Body(None), service: str = Body(None), notes: str = Body(None)):
+def update_appointment(appointment_id: int, name: str = Body(None), phone: str = Body(None), datetime: str = Body(None), service: str = Body(None), notes: str = Body(None), provider: str = Body(None), duration_minutes: int = Body(None), email: str = Body(None), reminder_channel: str = Body(None)):
     # Update logic (not present in appointment_utils, so implement inline)
+    if reminder_channel is not None and reminder_channel not in REMINDER_CHANNELS:
+        return JSONResponse({"error": f"reminder_channel must be one of {', '.join(REMINDER_CHANNELS)}"}, status_code=400)
+    if reminder_channel is not None or email is not None:
+        current_channel, current_email = reminder_settings(appointment_id)
+        if (reminder_channel or current_channel) == 'email' and not (email if email is not None else current_email):
+            return JSONResponse({"error": "An email address is required for email reminders"}, status_code=400)
+    old_phone = appointment_phone(appointment_id)
+    if datetime is not None or provider is not None or duration_minutes is not None:
+        conflict = check_appointment_move(appointment_id, datetime, provider, duration_minutes)
+        if conflict:
+            return JSONResponse(conflict, status_code=409)
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
     # Only update provided fields
@@ -889,21 +1543,54 @@ def update_appointment(appointment_id: int, name: str = Body(None), phone: str =
     if notes is not None:
         fields.append("notes = ?")
         values.append(notes)
+    if provider is not None:
+        fields.append("provider = ?")
+        values.append(provider)
+    if duration_minutes is not None:
+        fields.append("duration_minutes = ?")
+        values.append(duration_minutes)
+    if email is not None:
+        fields.append("email = ?")
+        values.append(email)
+    if reminder_channel is not None:
+        fields.append("reminder_channel = ?")
+        values.append(reminder_channel)
     if not fields:
         return {"error": "No fields to update"}
     values.append(appointment_id)
     c.execute(f"UPDATE appointments SET {', '.join(fields)} WHERE id = ?", values)
     conn.commit()
     conn.close()
+    appointments_changed(*[p for p in (old_phone, phone) if p])
     return {"status": "updated"}
 
+def check_appointment_move(appointment_id, new_datetime, new_provider, new_duration):
+    """Conflict check for an edit that changes when or with whom; returns an error payload or None"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('SELECT datetime, service, provider, duration_minutes, status FROM appointments WHERE id = ?', (appointment_id,))
+    row = c.fetchone()
+    conn.close()
+    if not row or row[4] != 'scheduled':
+        return None
+    start = parse_appointment_time(new_datetime if new_datetime is not None else row[0])
+    if not start:
+        return None
+    result = availability.check(start, row[1], new_provider or row[2], new_duration or row[3],
+                                exclude_id=appointment_id, within_schedule=False)
+    if result["available"]:
+        return None
+    return {"error": "That time is not available", "conflicts": result["conflicts"], "alternatives": result["alternatives"]}
+
 @app.delete("/appointments/{appointment_id}")
 def delete_appointment(appointment_id: int):
+    phone = appointment_phone(appointment_id)
     conn = sqlite3.connect('appointments.db')
     c = conn.cursor()
     c.execute("DELETE FROM appointments WHERE id = ?", (appointment_id,))
     conn.commit()
     conn.close()
+    appointments_changed(phone)
     return {"status": "deleted"}
 
 @app.post("/ai/ask")
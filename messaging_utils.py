@@ -0,0 +1,649 @@
+import os
+import smtplib
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from twilio.request_validator import RequestValidator
+from availability_utils import parse_appointment_time, describe_slot
+
+load_dotenv()
+
+# SMS and email appointment reminders. Appointments carry the caller's
+# reminder_channel ('sms', 'email' or 'call'; set by the dialog's
+# reminder_pref step or the appointment API). The dispatcher runs on a
+# timer:
+#   1. It queues one reminder_deliveries row for each scheduled appointment
+#      that is due within REMINDER_HOURS_AHEAD. A unique key on (appointment,
+#      appointment time, channel) means an appointment is reminded once, and
+#      again only after it is moved.
+#   2. It claims queued rows in batches per channel and hands each batch to
+#      that channel's sender.
+#
+# SMS goes through the Twilio Messages REST API. Requests share keep-alive
+# sessions across a few threads. Email goes over a single SMTP connection per
+# batch. Each channel has a token-bucket rate limit. Temporary failures are
+# retried with backoff, up to REMINDER_MAX_ATTEMPTS. Twilio reports later
+# states (delivered, undelivered) to /twilio/message-status, signed with the
+# auth token and checked there (valid_twilio_request). Each result is
+# saved as soon as its send returns, not at the end of the batch, so those
+# callbacks find their row. The callback URL also carries the delivery id.
+#
+# TWILIO_API_BASE and SMTP_HOST/SMTP_PORT can point at the local fakes at the
+# bottom of this file: python messaging_utils.py
+
+TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
+TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER')
+TWILIO_API_BASE = os.getenv('TWILIO_API_BASE', 'https://api.twilio.com')
+SMTP_HOST = os.getenv('SMTP_HOST')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_USER = os.getenv('SMTP_USER')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', '1') == '1'
+SMTP_FROM = os.getenv('SMTP_FROM', SMTP_USER)
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', 'http://localhost:8000')
+
+SMS_RATE_PER_SECOND = float(os.getenv('SMS_RATE_PER_SECOND', '1'))
+EMAIL_RATE_PER_SECOND = float(os.getenv('EMAIL_RATE_PER_SECOND', '5'))
+REMINDER_HOURS_AHEAD = int(os.getenv('REMINDER_HOURS_AHEAD', '24'))
+REMINDER_INTERVAL_MINUTES = float(os.getenv('REMINDER_INTERVAL_MINUTES', '5'))
+REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', '100'))
+REMINDER_MAX_ATTEMPTS = int(os.getenv('REMINDER_MAX_ATTEMPTS', '3'))
+
+REMINDER_CHANNELS = ('sms', 'email', 'call')
+MESSAGE_CHANNELS = ('sms', 'email')
+# Twilio can report states out of order; never move a delivery backwards
+STATUS_RANK = {'queued': 0, 'sending': 1, 'sent': 2, 'delivered': 3, 'undelivered': 3, 'failed': 3}
+
+def init_reminder_tables(conn):
+    """Add email/reminder_channel to appointments and create reminder_deliveries"""
+    c = conn.cursor()
+    c.execute('PRAGMA table_info(appointments)')
+    columns = {row[1] for row in c.fetchall()}
+    if 'email' not in columns:
+        c.execute('ALTER TABLE appointments ADD COLUMN email TEXT')
+    if 'reminder_channel' not in columns:
+        c.execute('ALTER TABLE appointments ADD COLUMN reminder_channel TEXT')
+    c.execute('''CREATE TABLE IF NOT EXISTS reminder_deliveries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        appointment_id INTEGER NOT NULL,
+        appointment_datetime TEXT,
+        channel TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        status TEXT DEFAULT 'queued',
+        provider_id TEXT,
+        error TEXT,
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at TEXT,
+        sent_at TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (appointment_id, appointment_datetime, channel)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reminder_deliveries_queue ON reminder_deliveries (channel, status, next_attempt_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reminder_deliveries_provider ON reminder_deliveries (provider_id)')
+
+def set_reminder_channel(appointment_id, channel, email=None):
+    """Save how an appointment should be reminded and/or the address for email (None keeps the current value)"""
+    if channel is not None and channel not in REMINDER_CHANNELS:
+        raise ValueError(f"reminder channel must be one of {REMINDER_CHANNELS}")
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('UPDATE appointments SET reminder_channel = coalesce(?, reminder_channel), email = coalesce(?, email) WHERE id = ?',
+              (channel, email, appointment_id))
+    conn.commit()
+    conn.close()
+
+def known_email(phone):
+    """Most recent email address given on any appointment for this number, or None"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('''SELECT email FROM appointments WHERE phone = ? AND email IS NOT NULL AND email != ''
+                 ORDER BY id DESC LIMIT 1''', (phone,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def reminder_settings(appointment_id):
+    """(reminder_channel, email) saved on an appointment, or (None, None)"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('SELECT reminder_channel, email FROM appointments WHERE id = ?', (appointment_id,))
+    row = c.fetchone()
+    conn.close()
+    return row if row else (None, None)
+
+def reminder_text(appointment):
+    start = parse_appointment_time(appointment['datetime'])
+    when = describe_slot(start) if start else appointment['datetime']
+    return (f"Hello {appointment['name']}, this is a reminder of your {appointment['service'] or 'appointment'} "
+            f"on {when}. Please call us if you need to reschedule. Thank you!")
+
+def valid_twilio_request(path, query, params, signature):
+    """Check X-Twilio-Signature for a callback Twilio made to PUBLIC_BASE_URL + path (+ ?query)"""
+    if not TWILIO_AUTH_TOKEN or not signature:
+        return False
+    url = f"{PUBLIC_BASE_URL}{path}" + (f"?{query}" if query else '')
+    return RequestValidator(TWILIO_AUTH_TOKEN).validate(url, params, signature)
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+class DeliveryError(Exception):
+    """A message was not accepted; retry marks temporary failures"""
+
+    def __init__(self, message, retry=False):
+        super().__init__(message)
+        self.retry = retry
+
+class RateLimiter:
+    """Token bucket shared by a channel's sending threads"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# --- Senders: send_batch(deliveries, on_result) calls on_result((delivery id, status, provider id, error, retry))
+# as each message is accepted or refused ---
+
+class TwilioSMSSender:
+    def __init__(self, rate=SMS_RATE_PER_SECOND, workers=4):
+        self.limiter = RateLimiter(rate, burst=max(1, int(rate)))
+        self.workers = workers
+        self.local = threading.local()
+        self.executor = None
+
+    def configured(self):
+        return bool(TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_PHONE_NUMBER)
+
+    def _session(self):
+        # One keep-alive session per sending thread
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.auth = (TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            self.local.session = session
+        return session
+
+    def send(self, delivery):
+        self.limiter.acquire()
+        url = f"{TWILIO_API_BASE}/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json"
+        try:
+            response = self._session().post(url, data={
+                'To': delivery['recipient'],
+                'From': TWILIO_PHONE_NUMBER,
+                'Body': reminder_text(delivery),
+                'StatusCallback': f"{PUBLIC_BASE_URL}/twilio/message-status?delivery_id={delivery['id']}"
+            }, timeout=15)
+        except requests.RequestException as e:
+            raise DeliveryError(f"Twilio request failed: {e}", retry=True)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise DeliveryError(f"Twilio HTTP {response.status_code}", retry=True)
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if response.status_code >= 400:
+            # e.g. 21211 invalid 'To' number: retrying will not help
+            raise DeliveryError(f"Twilio error {body.get('code', response.status_code)}: {body.get('message', response.text[:200])}")
+        return body.get('status', 'queued'), body.get('sid')
+
+    def _send_one(self, delivery, on_result):
+        try:
+            status, sid = self.send(delivery)
+            # Twilio's 'queued'/'accepted' means it took the message; callbacks follow
+            on_result((delivery['id'], 'sent' if status in ('queued', 'accepted', 'sending') else status, sid, None, False))
+        except DeliveryError as e:
+            on_result((delivery['id'], 'failed', None, str(e), e.retry))
+
+    def send_batch(self, deliveries, on_result):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sms-sender')
+        list(self.executor.map(lambda delivery: self._send_one(delivery, on_result), deliveries))
+
+class SMTPEmailSender:
+    def __init__(self, rate=EMAIL_RATE_PER_SECOND):
+        self.limiter = RateLimiter(rate, burst=max(1, int(rate)))
+
+    def configured(self):
+        return bool(SMTP_HOST and SMTP_FROM)
+
+    def _connect(self):
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        if SMTP_STARTTLS:
+            server.starttls()
+        if SMTP_USER and SMTP_PASSWORD:
+            server.login(SMTP_USER, SMTP_PASSWORD)
+        return server
+
+    def _message(self, delivery):
+        message = EmailMessage()
+        message['From'] = SMTP_FROM
+        message['To'] = delivery['recipient']
+        message['Subject'] = 'Appointment reminder'
+        message['Date'] = formatdate(localtime=True)
+        message['Message-ID'] = make_msgid()
+        message.set_content(reminder_text(delivery))
+        return message
+
+    def send_batch(self, deliveries, on_result):
+        """Send the whole batch over one SMTP connection, reconnecting if the server drops it"""
+        server = None
+        for delivery in deliveries:
+            self.limiter.acquire()
+            message = self._message(delivery)
+            for attempt in range(2):
+                try:
+                    if server is None:
+                        server = self._connect()
+                    server.send_message(message)
+                    on_result((delivery['id'], 'sent', message['Message-ID'], None, False))
+                    break
+                except smtplib.SMTPServerDisconnected as e:
+                    server = None
+                    if attempt:
+                        on_result((delivery['id'], 'failed', None, f"SMTP disconnected: {e}", True))
+                except smtplib.SMTPRecipientsRefused as e:
+                    code, reason = next(iter(e.recipients.values()))
+                    on_result((delivery['id'], 'failed', None, f"SMTP {code}: {reason!r}", 400 <= code < 500))
+                    break
+                except smtplib.SMTPResponseException as e:
+                    on_result((delivery['id'], 'failed', None, f"SMTP {e.smtp_code}: {e.smtp_error!r}", 400 <= e.smtp_code < 500))
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    server = None
+                    on_result((delivery['id'], 'failed', None, f"SMTP error: {e}", True))
+                    break
+        if server is not None:
+            try:
+                server.quit()
+            except smtplib.SMTPException:
+                pass
+
+# --- Dispatcher ---
+
+class ReminderDispatcher:
+    """Queues due SMS/email reminders and delivers them in per-channel batches"""
+
+    def __init__(self, batch_size=REMINDER_BATCH_SIZE, max_attempts=REMINDER_MAX_ATTEMPTS):
+        self.senders = {'sms': TwilioSMSSender(), 'email': SMTPEmailSender()}
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.run_lock = threading.Lock()
+        self.thread = None
+        self.last_run = None
+
+    def enqueue_due(self, hours_ahead=REMINDER_HOURS_AHEAD):
+        """Queue a delivery for every scheduled appointment due soon that prefers SMS or email"""
+        now = datetime.now()
+        conn = sqlite3.connect('appointments.db', timeout=30)
+        c = conn.cursor()
+        c.execute('''INSERT OR IGNORE INTO reminder_deliveries (appointment_id, appointment_datetime, channel, recipient, next_attempt_at)
+                     SELECT id, datetime, reminder_channel, CASE reminder_channel WHEN 'email' THEN email ELSE phone END, ?
+                     FROM appointments
+                     WHERE status = 'scheduled' AND datetime >= ? AND datetime <= ?
+                       AND reminder_channel IN ('sms', 'email')
+                       AND coalesce(CASE reminder_channel WHEN 'email' THEN email ELSE phone END, '') != '' ''',
+                  (_now(), now.strftime('%Y-%m-%d %H:%M:%S'), (now + timedelta(hours=hours_ahead)).strftime('%Y-%m-%d %H:%M:%S')))
+        queued = c.rowcount
+        conn.commit()
+        conn.close()
+        return queued
+
+    def _claim(self, channel):
+        """Mark the next batch of due deliveries as sending and return them"""
+        conn = sqlite3.connect('appointments.db', timeout=30, isolation_level=None)
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            # Rows left 'sending' by a process that died mid-batch
+            c.execute('''UPDATE reminder_deliveries SET status = 'queued'
+                         WHERE status = 'sending' AND updated_at < datetime('now', '-15 minutes')''')
+            # Appointments cancelled or moved since their reminder was queued (a moved
+            # one gets a fresh row for its new time from enqueue_due)
+            c.execute('''UPDATE reminder_deliveries SET status = 'cancelled', error = 'appointment cancelled or moved',
+                         updated_at = CURRENT_TIMESTAMP
+                         WHERE channel = ? AND status = 'queued' AND NOT EXISTS (
+                             SELECT 1 FROM appointments a WHERE a.id = reminder_deliveries.appointment_id
+                               AND a.status = 'scheduled' AND a.datetime = reminder_deliveries.appointment_datetime)''',
+                      (channel,))
+            c.execute('''SELECT d.id, d.appointment_id, d.recipient, a.name, a.datetime, a.service
+                         FROM reminder_deliveries d JOIN appointments a ON a.id = d.appointment_id
+                         WHERE d.channel = ? AND d.status = 'queued' AND d.next_attempt_at <= ?
+                           AND a.status = 'scheduled' AND a.datetime = d.appointment_datetime
+                         ORDER BY d.id LIMIT ?''', (channel, _now(), self.batch_size))
+            rows = c.fetchall()
+            c.executemany('''UPDATE reminder_deliveries SET status = 'sending', attempts = attempts + 1,
+                             updated_at = CURRENT_TIMESTAMP WHERE id = ?''', [(row[0],) for row in rows])
+            c.execute('COMMIT')
+        except sqlite3.Error:
+            c.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return [
+            {"id": row[0], "appointment_id": row[1], "recipient": row[2], "name": row[3], "datetime": row[4], "service": row[5]}
+            for row in rows
+        ]
+
+    def _record(self, result):
+        """Save one send result right away; returns 'sent', 'failed' or 'retrying'"""
+        delivery_id, status, provider_id, error, retry = result
+        conn = sqlite3.connect('appointments.db', timeout=30)
+        c = conn.cursor()
+        try:
+            if status == 'failed' and retry:
+                c.execute('SELECT attempts FROM reminder_deliveries WHERE id = ?', (delivery_id,))
+                attempts = c.fetchone()[0]
+                if attempts < self.max_attempts:
+                    # Back off 1, 4, 16 ... minutes
+                    next_attempt = (datetime.now() + timedelta(minutes=4 ** (attempts - 1))).strftime('%Y-%m-%d %H:%M:%S')
+                    c.execute('''UPDATE reminder_deliveries SET status = 'queued', error = ?, next_attempt_at = ?,
+                                 updated_at = CURRENT_TIMESTAMP WHERE id = ?''', (error, next_attempt, delivery_id))
+                    conn.commit()
+                    return 'retrying'
+            # A status callback may already have moved the row past 'sending'
+            c.execute('''UPDATE reminder_deliveries SET status = CASE WHEN status = 'sending' THEN ? ELSE status END,
+                         provider_id = coalesce(?, provider_id), error = coalesce(?, error),
+                         sent_at = CASE WHEN ? = 'failed' THEN sent_at ELSE ? END, updated_at = CURRENT_TIMESTAMP
+                         WHERE id = ?''', (status, provider_id, error, status, _now(), delivery_id))
+            conn.commit()
+            return 'failed' if status == 'failed' else 'sent'
+        finally:
+            conn.close()
+
+    def dispatch(self, hours_ahead=REMINDER_HOURS_AHEAD):
+        """Queue due reminders and send everything that is ready; returns counts per channel"""
+        if not self.run_lock.acquire(blocking=False):
+            return {"status": "skipped", "reason": "a dispatch is already running"}
+        try:
+            started = time.time()
+            result = {"status": "success", "queued": self.enqueue_due(hours_ahead), "channels": {}}
+            for channel, sender in self.senders.items():
+                if not sender.configured():
+                    result["channels"][channel] = {"skipped": "not configured"}
+                    continue
+                totals = {'sent': 0, 'failed': 0, 'retrying': 0, 'batches': 0}
+                totals_lock = threading.Lock()
+
+                def on_result(sent_result):
+                    outcome = self._record(sent_result)
+                    with totals_lock:
+                        totals[outcome] += 1
+
+                while True:
+                    batch = self._claim(channel)
+                    if not batch:
+                        break
+                    sender.send_batch(batch, on_result)
+                    totals['batches'] += 1
+                result["channels"][channel] = totals
+            result["seconds"] = round(time.time() - started, 2)
+            self.last_run = {**result, "finished_at": datetime.now().isoformat(timespec='seconds')}
+            sent = sum(t.get('sent', 0) for t in result["channels"].values())
+            if sent or result["queued"]:
+                print(f"[Reminders] Queued {result['queued']}, sent {sent}: {result['channels']}")
+            return result
+        finally:
+            self.run_lock.release()
+
+    def update_status(self, provider_id, status, error=None, delivery_id=None):
+        """Apply a provider status callback, matched by delivery id when the callback URL
+        carries one, else by provider id; returns False for an unknown message"""
+        if status not in STATUS_RANK:
+            return False
+        conn = sqlite3.connect('appointments.db', timeout=30)
+        c = conn.cursor()
+        if delivery_id:
+            # The SID must match once it is known; before that the id from our own callback URL is enough
+            c.execute('''SELECT id, status FROM reminder_deliveries
+                         WHERE id = ? AND (provider_id IS NULL OR ? IS NULL OR provider_id = ?)''',
+                      (delivery_id, provider_id or None, provider_id or None))
+        else:
+            c.execute('SELECT id, status FROM reminder_deliveries WHERE provider_id = ?', (provider_id,))
+        row = c.fetchone()
+        if row and STATUS_RANK.get(row[1], 0) < STATUS_RANK[status]:
+            c.execute('''UPDATE reminder_deliveries SET status = ?, provider_id = coalesce(provider_id, ?),
+                         error = coalesce(?, error), updated_at = CURRENT_TIMESTAMP
+                         WHERE id = ?''', (status, provider_id or None, error, row[0]))
+            conn.commit()
+        conn.close()
+        return row is not None
+
+    def covered(self, appointments):
+        """Ids of the appointments whose SMS/email reminder for their current time is queued, sending or sent.
+        The rest still need a reminder call: channel not configured, no address, or the delivery failed."""
+        configured = [channel for channel, sender in self.senders.items() if sender.configured()]
+        candidates = [a for a in appointments if a.get('reminder_channel') in configured]
+        if not candidates:
+            return set()
+        conn = sqlite3.connect('appointments.db')
+        c = conn.cursor()
+        placeholders = ','.join('?' * len(candidates))
+        c.execute(f'''SELECT appointment_id, appointment_datetime, channel FROM reminder_deliveries
+                      WHERE appointment_id IN ({placeholders}) AND status NOT IN ('failed', 'undelivered', 'cancelled')''',
+                  [a['id'] for a in candidates])
+        live = set(c.fetchall())
+        conn.close()
+        return {a['id'] for a in candidates if (a['id'], a['datetime'], a['reminder_channel']) in live}
+
+    def deliveries(self, status=None, appointment_id=None, limit=100):
+        clauses, params = [], []
+        if status:
+            clauses.append('status = ?')
+            params.append(status)
+        if appointment_id:
+            clauses.append('appointment_id = ?')
+            params.append(appointment_id)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        conn = sqlite3.connect('appointments.db')
+        c = conn.cursor()
+        c.execute(f'''SELECT id, appointment_id, appointment_datetime, channel, recipient, status, provider_id,
+                             error, attempts, sent_at, created_at, updated_at
+                      FROM reminder_deliveries {where} ORDER BY id DESC LIMIT ?''', params + [limit])
+        rows = c.fetchall()
+        conn.close()
+        return [
+            {
+                "id": row[0],
+                "appointment_id": row[1],
+                "appointment_datetime": row[2],
+                "channel": row[3],
+                "recipient": row[4],
+                "status": row[5],
+                "provider_id": row[6],
+                "error": row[7],
+                "attempts": row[8],
+                "sent_at": row[9],
+                "created_at": row[10],
+                "updated_at": row[11]
+            }
+            for row in rows
+        ]
+
+    def stats(self):
+        conn = sqlite3.connect('appointments.db')
+        c = conn.cursor()
+        c.execute('SELECT channel, status, COUNT(*) FROM reminder_deliveries GROUP BY channel, status')
+        counts = {}
+        for channel, status, count in c.fetchall():
+            counts.setdefault(channel, {})[status] = count
+        conn.close()
+        return {
+            "configured": {channel: sender.configured() for channel, sender in self.senders.items()},
+            "deliveries": counts,
+            "last_run": self.last_run
+        }
+
+    # --- Scheduling ---
+
+    def start(self, interval_minutes=REMINDER_INTERVAL_MINUTES):
+        """Dispatch every interval_minutes on a background thread"""
+        if not interval_minutes or (self.thread and self.thread.is_alive()):
+            return
+        self.thread = threading.Thread(target=self._loop, args=(interval_minutes * 60,), daemon=True, name='reminder-dispatcher')
+        self.thread.start()
+
+    def _loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.dispatch()
+            except Exception as e:
+                print(f"[Reminders] Dispatch failed: {e}")
+
+reminder_dispatcher = ReminderDispatcher()
+
+# --- Local fakes for testing: python messaging_utils.py ---
+
+def start_fake_twilio(port=0):
+    """Twilio Messages API look-alike; returns (server, base_url, state)"""
+    import json
+    import uuid
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs
+
+    state = {"messages": [], "connections": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'   # keep-alive, so connection reuse shows up
+
+        def setup(self):
+            super().setup()
+            state["connections"] += 1
+
+        def do_POST(self):
+            form = {k: v[0] for k, v in parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()).items()}
+            if not form.get('To', '').startswith('+') or len(form['To']) < 8:
+                status, body = 400, {"code": 21211, "message": f"The 'To' number {form.get('To')} is not a valid phone number."}
+            else:
+                body = {"sid": 'SM' + uuid.uuid4().hex, "status": "queued", "to": form['To'], "body": form.get('Body')}
+                state["messages"].append(body)
+                status = 201
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}", state
+
+def start_fake_smtp(port=0):
+    """Minimal SMTP server that accepts everything; returns (server, port, state)"""
+    import socketserver
+
+    state = {"messages": [], "connections": 0}
+
+    class Handler(socketserver.StreamRequestHandler):
+        def reply(self, line):
+            self.wfile.write(line.encode() + b'\r\n')
+
+        def handle(self):
+            state["connections"] += 1
+            self.reply('220 fake-smtp ready')
+            envelope = {"to": []}
+            while True:
+                line = self.rfile.readline().decode(errors='replace').rstrip('\r\n')
+                if not line:
+                    return
+                command = line[:4].upper()
+                if command in ('HELO', 'EHLO'):
+                    self.reply('250 fake-smtp')
+                elif command == 'MAIL':
+                    envelope = {"from": line[10:].strip('<>'), "to": []}
+                    self.reply('250 OK')
+                elif command == 'RCPT':
+                    recipient = line[8:].strip('<>')
+                    if '@' not in recipient:
+                        self.reply('550 No such user')
+                    else:
+                        envelope["to"].append(recipient)
+                        self.reply('250 OK')
+                elif command == 'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    data = []
+                    while True:
+                        data_line = self.rfile.readline()
+                        if data_line in (b'.\r\n', b'.\n', b''):
+                            break
+                        data.append(data_line)
+                    state["messages"].append({**envelope, "data": b''.join(data).decode(errors='replace')})
+                    self.reply('250 OK queued')
+                elif command == 'QUIT':
+                    self.reply('221 Bye')
+                    return
+                else:
+                    self.reply('250 OK')
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1], state
+
+if __name__ == '__main__':
+    # Runs against a scratch database in a temporary directory
+    import tempfile
+
+    twilio_server, twilio_base, twilio_state = start_fake_twilio()
+    smtp_server, smtp_port, smtp_state = start_fake_smtp()
+    TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER = 'ACtest', 'token', '+15550001111'
+    TWILIO_API_BASE = twilio_base
+    SMTP_HOST, SMTP_PORT, SMTP_STARTTLS, SMTP_FROM = '127.0.0.1', smtp_port, False, 'clinic@example.com'
+    os.chdir(tempfile.mkdtemp())
+
+    conn = sqlite3.connect('appointments.db')
+    conn.execute('''CREATE TABLE appointments (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, phone TEXT,
+                    datetime TEXT, service TEXT, notes TEXT, status TEXT DEFAULT 'scheduled')''')
+    init_reminder_tables(conn)
+    soon = datetime.now() + timedelta(hours=3)
+    rows = []
+    for i in range(40):
+        channel = 'sms' if i % 2 else 'email'
+        phone = f"+1555{i:07d}" if i != 1 else 'bad'
+        email = f"patient{i}@example.com" if i != 2 else 'not-an-address'
+        rows.append((f"Patient {i}", phone, (soon + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'), 'Check-up', email, channel))
+    conn.executemany('INSERT INTO appointments (name, phone, datetime, service, email, reminder_channel) VALUES (?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+    dispatcher = ReminderDispatcher(batch_size=8)
+    dispatcher.senders = {'sms': TwilioSMSSender(rate=20, workers=4), 'email': SMTPEmailSender(rate=50)}
+    print(dispatcher.dispatch())
+    print("second run:", dispatcher.dispatch()["queued"], "queued")
+    print(f"fake Twilio: {len(twilio_state['messages'])} messages over {twilio_state['connections']} connections")
+    print(f"fake SMTP: {len(smtp_state['messages'])} messages over {smtp_state['connections']} connections")
+    sid = twilio_state['messages'][0]['sid']
+    dispatcher.update_status(sid, 'delivered')
+    dispatcher.update_status(sid, 'sent')
+    print(dispatcher.stats()['deliveries'])
+    print([d for d in dispatcher.deliveries() if d['status'] == 'failed'])
@@ -0,0 +1,183 @@
+import functools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from caller_utils import normalize_e164
+
+# On-demand sampling profiler for dialog turns. Off by default; when off the
+# only cost per turn is one attribute check in the @profiled_turn wrapper.
+# When switched on (for a fraction of turns and/or one caller), a sampler
+# thread records the turn thread's Python stack every few milliseconds.
+# Turns slower than the threshold are written to PROFILE_DIR in collapsed
+# stack format ("frame;frame;frame count" per line), which flamegraph.pl,
+# speedscope and inferno read directly; faster turns are discarded.
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+MAX_PROFILES = 200
+
+def _frame_name(code):
+    name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return name.replace(';', ',')
+
+class _Session:
+    def __init__(self, thread_id, root_code):
+        self.thread_id = thread_id
+        self.root_code = root_code
+        self.stacks = Counter()
+        self.samples = 0
+
+class TurnProfiler:
+    """Runtime-configurable sampler; sessions are opened per profiled turn"""
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.phone = None
+        self.threshold_ms = 2000
+        self.interval_ms = 5
+        self.expires_at = None
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.sampler = None
+        self.turns_sampled = 0
+        self.turns_captured = 0
+
+    def configure(self, enabled, sample_rate=1.0, phone=None, threshold_ms=2000, interval_ms=5, duration_minutes=30):
+        """Switch profiling on or off; it switches itself off after duration_minutes"""
+        if not 0 < float(sample_rate) <= 1:
+            raise ValueError("sample_rate must be in (0, 1]")
+        if float(interval_ms) < 1:
+            raise ValueError("interval_ms must be at least 1")
+        self.sample_rate = float(sample_rate)
+        self.phone = normalize_e164(phone) if phone else None
+        self.threshold_ms = float(threshold_ms)
+        self.interval_ms = float(interval_ms)
+        self.expires_at = time.time() + float(duration_minutes) * 60 if enabled and duration_minutes else None
+        self.enabled = bool(enabled)
+        print(f"[Profiler] {'enabled' if self.enabled else 'disabled'}: {self.status()}")
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "phone": self.phone,
+            "threshold_ms": self.threshold_ms,
+            "interval_ms": self.interval_ms,
+            "expires_at": datetime.fromtimestamp(self.expires_at).isoformat(timespec='seconds') if self.expires_at else None,
+            "active_sessions": len(self.sessions),
+            "turns_sampled": self.turns_sampled,
+            "turns_captured": self.turns_captured
+        }
+
+    def _selected(self, phone):
+        if self.expires_at and time.time() > self.expires_at:
+            self.enabled = False
+            print("[Profiler] disabled: time limit reached")
+            return False
+        if self.phone and normalize_e164(phone) != self.phone:
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    # --- Sampling ---
+
+    def _start(self, root_code):
+        with self.lock:
+            session = _Session(threading.get_ident(), root_code)
+            self.sessions[id(session)] = session
+            if self.sampler is None or not self.sampler.is_alive():
+                self.sampler = threading.Thread(target=self._sample_loop, daemon=True, name='turn-profiler')
+                self.sampler.start()
+            self.wakeup.notify()
+        return session
+
+    def _stop(self, session):
+        with self.lock:
+            self.sessions.pop(id(session), None)
+
+    def _sample_loop(self):
+        while True:
+            with self.lock:
+                # Sleep until a turn is being profiled; exit once profiling is off
+                while not self.sessions:
+                    if not self.enabled:
+                        self.sampler = None
+                        return
+                    self.wakeup.wait(timeout=5)
+                sessions = list(self.sessions.values())
+            frames = sys._current_frames()
+            for session in sessions:
+                frame = frames.get(session.thread_id)
+                stack = []
+                # Stop at the profiled call; the server frames above it are the same every time
+                while frame is not None and frame.f_code is not session.root_code:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    session.stacks[';'.join(reversed(stack))] += 1
+                    session.samples += 1
+            del frames
+            time.sleep(self.interval_ms / 1000)
+
+    # --- Storage ---
+
+    def _save(self, session, label, phone, elapsed_ms):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        digits = re.sub(r'\D', '', phone or '')[-4:] or 'unknown'
+        name = f"{stamp}_{label}_{digits}_{int(elapsed_ms)}ms.folded"
+        with open(os.path.join(PROFILE_DIR, name), 'w', encoding='utf-8') as f:
+            for stack, count in session.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.turns_captured += 1
+        # Keep the directory bounded
+        profiles = sorted(p for p in os.listdir(PROFILE_DIR) if p.endswith('.folded'))
+        for old in profiles[:-MAX_PROFILES]:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        print(f"[Profiler] {label} for {phone} took {elapsed_ms:.0f} ms; saved {name} ({session.samples} samples)")
+
+    def list_profiles(self):
+        if not os.path.isdir(PROFILE_DIR):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+            if name.endswith('.folded'):
+                stat = os.stat(os.path.join(PROFILE_DIR, name))
+                profiles.append({"name": name, "bytes": stat.st_size,
+                                 "created_at": datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='seconds')})
+        return profiles
+
+    def profile_path(self, name):
+        """Path of a stored profile, or None for anything that is not a plain profile file name"""
+        if not name.endswith('.folded') or os.path.basename(name) != name:
+            return None
+        path = os.path.join(PROFILE_DIR, name)
+        return path if os.path.isfile(path) else None
+
+turn_profiler = TurnProfiler()
+
+def profiled_turn(func):
+    """Profile calls of func(from_number, ...) while the profiler is on"""
+    @functools.wraps(func)
+    def wrapper(from_number, *args, **kwargs):
+        if not turn_profiler.enabled or not turn_profiler._selected(from_number):
+            return func(from_number, *args, **kwargs)
+        turn_profiler.turns_sampled += 1
+        session = turn_profiler._start(sys._getframe().f_code)
+        started = time.perf_counter()
+        try:
+            return func(from_number, *args, **kwargs)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            turn_profiler._stop(session)
+            if elapsed_ms >= turn_profiler.threshold_ms and session.stacks:
+                try:
+                    turn_profiler._save(session, func.__name__, from_number, elapsed_ms)
+                except OSError as e:
+                    print(f"[Profiler] Could not save profile: {e}")
+    return wrapper
@@ -0,0 +1,225 @@
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import time
+from datetime import datetime
+import hf_utils
+from hf_utils import top_label, normalize_intent, normalize_sentiment
+
+# Batch re-scoring of call_logs.intent / sentiment with the local models.
+# Live calls are scored by the Inference API and often fall back to
+# 'unknown' / 'neutral' when it times out; this job goes back over history.
+#
+# It walks call_logs in id order, one chunk at a time, and joins each call's
+# user messages. The chunk is split across forked worker processes, one per
+# core, which were forked after the models were loaded so they share the
+# weights copy-on-write. Each worker runs its share through the pipelines in
+# padded batches. Labels are normalised the same way log_call stores live
+# ones, and a model answer that maps to 'unknown' never replaces a known
+# intent. Changed labels and the job's checkpoint (the last id done)
+# are written in one short transaction per chunk, so an interrupted job
+# resumes where it stopped and live writes only wait for one chunk. The
+# dashboard rollups follow via the call_stats_au trigger.
+#
+# The job's upper bound is the newest call at the time it was created; later
+# calls were scored live. Archived calls (archive_utils) are not re-scored.
+# Each chunk's label updates bump the call_logs row in table_versions (cache_utils),
+# so a running server stops answering /api/admin/calls from its cache right away.
+#
+# Usage: python rescore_utils.py --job rescore-2024 [--only-fallback] [--processes 8] [--dry-run]
+
+def init_rescore_table(conn):
+    """Create the checkpoint table for re-scoring jobs"""
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS rescore_jobs (
+        job_name TEXT PRIMARY KEY,
+        intent_model TEXT,
+        sentiment_model TEXT,
+        only_fallback INTEGER DEFAULT 0,
+        last_id INTEGER DEFAULT 0,
+        max_id INTEGER,
+        scored INTEGER DEFAULT 0,
+        changed INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'running',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+def get_rescore_jobs():
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('''SELECT job_name, intent_model, sentiment_model, only_fallback, last_id, max_id,
+                        scored, changed, status, created_at, updated_at
+                 FROM rescore_jobs ORDER BY created_at DESC''')
+    rows = c.fetchall()
+    conn.close()
+    return [
+        {
+            "job_name": row[0],
+            "intent_model": row[1],
+            "sentiment_model": row[2],
+            "only_fallback": bool(row[3]),
+            "last_id": row[4],
+            "max_id": row[5],
+            "scored": row[6],
+            "changed": row[7],
+            "status": row[8],
+            "created_at": row[9],
+            "updated_at": row[10]
+        }
+        for row in rows
+    ]
+
+def user_text(conversation_data, max_chars=1000):
+    """The caller's side of a logged conversation as one string"""
+    try:
+        turns = json.loads(conversation_data) if conversation_data else []
+    except ValueError:
+        return ''
+    messages = [t.get('message') or '' for t in turns if isinstance(t, dict) and t.get('speaker') == 'user']
+    return ' '.join(m.strip() for m in messages if m.strip())[:max_chars]
+
+# --- Worker side ---
+
+def _init_worker():
+    # Below the web server in CPU priority; one intra-op thread per process.
+    # Ctrl+C is handled by the parent, which saves the job state.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except Exception:
+        pass
+
+def _score_texts(texts, batch_size):
+    intents = hf_utils.local_classify_batch(texts, task='intent', batch_size=batch_size)
+    sentiments = hf_utils.local_classify_batch(texts, task='sentiment', batch_size=batch_size)
+    return [(normalize_intent(top_label(i)), normalize_sentiment(top_label(s)))
+            for i, s in zip(intents, sentiments)]
+
+# --- Job ---
+
+def _split(items, parts):
+    size = -(-len(items) // parts)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def rescore_calls(job_name, chunk_size=2000, batch_size=64, processes=None, only_fallback=False,
+                  pause=0.2, dry_run=False, restart=False):
+    """Run (or resume) a re-scoring job; returns its checkpoint row.
+    A dry run only counts the labels that would change and records nothing."""
+    conn = sqlite3.connect('appointments.db', timeout=30)
+    c = conn.cursor()
+    init_rescore_table(conn)
+    if restart and not dry_run:
+        c.execute('DELETE FROM rescore_jobs WHERE job_name = ?', (job_name,))
+    c.execute('SELECT last_id, max_id, scored, changed, status, only_fallback FROM rescore_jobs WHERE job_name = ?', (job_name,))
+    row = None if dry_run else c.fetchone()
+    if row is None:
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM call_logs')
+        max_id = c.fetchone()[0]
+        last_id, scored, changed = 0, 0, 0
+        if not dry_run:
+            c.execute('''INSERT INTO rescore_jobs (job_name, intent_model, sentiment_model, only_fallback, max_id)
+                         VALUES (?, ?, ?, ?, ?)''',
+                      (job_name, hf_utils.INTENT_MODEL, hf_utils.SENTIMENT_MODEL, int(only_fallback), max_id))
+            conn.commit()
+    else:
+        last_id, max_id, scored, changed, status, only_fallback = row
+        if status == 'done':
+            print(f"[Rescore] Job {job_name} already finished; use --restart to run it again")
+            conn.close()
+            return _job(job_name)
+        print(f"[Rescore] Resuming {job_name} after call id {last_id} of {max_id}")
+        c.execute("UPDATE rescore_jobs SET status = 'running', updated_at = CURRENT_TIMESTAMP WHERE job_name = ?", (job_name,))
+        conn.commit()
+
+    processes = processes or os.cpu_count() or 1
+    # Load once here; the forked workers inherit the weights
+    hf_utils.load_local_classifiers()
+    pool = multiprocessing.get_context('fork').Pool(processes, initializer=_init_worker) if processes > 1 else None
+    where = "AND (intent IS NULL OR intent = 'unknown' OR sentiment IS NULL OR sentiment = 'neutral')" if only_fallback else ''
+    started = time.time()
+    done_this_run = 0
+    status = 'running'
+    try:
+        while True:
+            c.execute(f'''SELECT id, conversation_data, intent, sentiment FROM call_logs
+                          WHERE id > ? AND id <= ? {where} ORDER BY id LIMIT ?''', (last_id, max_id, chunk_size))
+            rows = c.fetchall()
+            if not rows:
+                status = 'done'
+                break
+            chunk = [(row_id, user_text(data), intent, sentiment) for row_id, data, intent, sentiment in rows]
+            chunk = [item for item in chunk if item[1]]
+            texts = [item[1] for item in chunk]
+            if not texts:
+                labels = []
+            elif pool:
+                parts = pool.starmap(_score_texts, [(part, batch_size) for part in _split(texts, processes)])
+                labels = [label for part in parts for label in part]
+            else:
+                labels = _score_texts(texts, batch_size)
+
+            updates = []
+            for (row_id, _, old_intent, old_sentiment), (intent, sentiment) in zip(chunk, labels):
+                if intent == 'unknown' and old_intent not in (None, 'unknown'):
+                    intent = old_intent
+                if (intent, sentiment) != (old_intent, old_sentiment):
+                    updates.append((intent, sentiment, row_id))
+            last_id = rows[-1][0]
+            scored += len(chunk)
+            changed += len(updates)
+            done_this_run += len(rows)
+            # Labels and checkpoint commit together, so a resume never redoes or skips a chunk
+            if not dry_run:
+                c.executemany('UPDATE call_logs SET intent = ?, sentiment = ? WHERE id = ?', updates)
+                c.execute('''UPDATE rescore_jobs SET last_id = ?, scored = ?, changed = ?, updated_at = CURRENT_TIMESTAMP
+                             WHERE job_name = ?''', (last_id, scored, changed, job_name))
+                conn.commit()
+            rate = done_this_run / max(time.time() - started, 1e-6)
+            print(f"[Rescore] {job_name}: up to id {last_id}/{max_id}, {scored} scored, {changed} changed ({rate:.0f} calls/s)")
+            time.sleep(pause)
+    except KeyboardInterrupt:
+        status = 'paused'
+        print(f"[Rescore] Interrupted; resume with --job {job_name}")
+    except Exception:
+        status = 'failed'
+        raise
+    finally:
+        if pool:
+            pool.terminate()
+        if not dry_run:
+            c.execute("UPDATE rescore_jobs SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE job_name = ?", (status, job_name))
+            conn.commit()
+        conn.close()
+    if dry_run:
+        return {"job_name": job_name, "dry_run": True, "max_id": max_id, "scored": scored, "would_change": changed}
+    return _job(job_name)
+
+def _job(job_name):
+    return next((job for job in get_rescore_jobs() if job['job_name'] == job_name), None)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-score call_logs intent/sentiment with the local models')
+    parser.add_argument('--job', default=f"rescore-{datetime.now().strftime('%Y%m%d')}",
+                        help='job name; running the same name again resumes it')
+    parser.add_argument('--chunk-size', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=64, help='texts per model forward pass')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--only-fallback', action='store_true', help="only calls logged as 'unknown' or 'neutral'")
+    parser.add_argument('--pause', type=float, default=0.2, help='seconds between chunks')
+    parser.add_argument('--dry-run', action='store_true', help='count changes without writing labels')
+    parser.add_argument('--restart', action='store_true', help='discard the checkpoint and start over')
+    args = parser.parse_args()
+
+    job = rescore_calls(args.job, chunk_size=max(1, args.chunk_size), batch_size=max(1, args.batch_size),
+                        processes=args.processes, only_fallback=args.only_fallback, pause=args.pause,
+                        dry_run=args.dry_run, restart=args.restart)
+    print(json.dumps(job, indent=2))
@@ -0,0 +1,157 @@
+import re
+import sqlite3
+from difflib import SequenceMatcher
+
+# Two FTS5 indexes are kept in sync with `appointments` by triggers:
+#   appointments_fts   - trigram tokenizer: phone substrings/suffixes and typo tolerance
+#   appointments_words - unicode61 with prefix indexes: fast "smi" -> "Smith" lookups
+# Both use the appointment id as rowid so hits join straight back to the table.
+
+PHONE_DIGITS_SQL = "replace(replace(replace(replace(replace(replace(coalesce({col}, ''), '+', ''), '-', ''), ' ', ''), '(', ''), ')', ''), '.', '')"
+
+def init_search_index(conn):
+    """Create the appointment search indexes and their sync triggers"""
+    c = conn.cursor()
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS appointments_fts USING fts5(
+        name, phone_digits, notes,
+        tokenize = 'trigram'
+    )''')
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS appointments_words USING fts5(
+        name, notes,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '1 2 3'
+    )''')
+
+    new_digits = PHONE_DIGITS_SQL.format(col='new.phone')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS appointments_search_ai AFTER INSERT ON appointments BEGIN
+        INSERT INTO appointments_fts (rowid, name, phone_digits, notes) VALUES (new.id, new.name, {new_digits}, new.notes);
+        INSERT INTO appointments_words (rowid, name, notes) VALUES (new.id, new.name, new.notes);
+    END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS appointments_search_au AFTER UPDATE OF name, phone, notes ON appointments BEGIN
+        DELETE FROM appointments_fts WHERE rowid = old.id;
+        DELETE FROM appointments_words WHERE rowid = old.id;
+        INSERT INTO appointments_fts (rowid, name, phone_digits, notes) VALUES (new.id, new.name, {new_digits}, new.notes);
+        INSERT INTO appointments_words (rowid, name, notes) VALUES (new.id, new.name, new.notes);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS appointments_search_ad AFTER DELETE ON appointments BEGIN
+        DELETE FROM appointments_fts WHERE rowid = old.id;
+        DELETE FROM appointments_words WHERE rowid = old.id;
+    END''')
+
+    # Backfill rows that existed before the index did
+    c.execute('SELECT COUNT(*) FROM appointments')
+    total = c.fetchone()[0]
+    c.execute('SELECT COUNT(*) FROM appointments_fts')
+    indexed = c.fetchone()[0]
+    if total != indexed:
+        rebuild_search_index(conn)
+
+def rebuild_search_index(conn):
+    """Repopulate both search indexes from the appointments table"""
+    c = conn.cursor()
+    c.execute('DELETE FROM appointments_fts')
+    c.execute('DELETE FROM appointments_words')
+    c.execute(f'''INSERT INTO appointments_fts (rowid, name, phone_digits, notes)
+                  SELECT id, name, {PHONE_DIGITS_SQL.format(col='phone')}, notes FROM appointments''')
+    c.execute('''INSERT INTO appointments_words (rowid, name, notes)
+                 SELECT id, name, notes FROM appointments''')
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+def _trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def _similarity(query, value):
+    """Best fuzzy ratio between the query and any word window of the value"""
+    if not value:
+        return 0.0
+    query = query.lower()
+    words = value.lower().split()
+    size = max(1, len(query.split()))
+    windows = [' '.join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))]
+    return max(SequenceMatcher(None, query, w).ratio() for w in windows)
+
+def _fetch_rows(c, ids):
+    if not ids:
+        return {}
+    placeholders = ','.join('?' * len(ids))
+    c.execute(f'''SELECT id, name, phone, datetime, service, notes, status, created_at
+                  FROM appointments WHERE id IN ({placeholders})''', list(ids))
+    return {row[0]: row for row in c.fetchall()}
+
+def search_appointments(query, limit=20, fuzzy_threshold=0.6):
+    """Search appointments by phone suffix, name/notes prefix, or fuzzy name match"""
+    query = (query or '').strip()
+    if not query:
+        return []
+
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    hits = {}  # id -> (match, score)
+
+    def add(appointment_id, match, score):
+        if appointment_id not in hits or hits[appointment_id][1] < score:
+            hits[appointment_id] = (match, score)
+
+    # Phone digits: suffix matches first, then numbers containing the digits
+    # elsewhere. The trigram index answers LIKE '%digits' itself, so the
+    # suffix query is never cut short by the looser substring matches.
+    digits = re.sub(r'\D', '', query)
+    if len(digits) >= 3 and len(digits) >= len(query.replace(' ', '')) // 2:
+        c.execute('''SELECT rowid FROM appointments_fts WHERE phone_digits LIKE ? LIMIT ?''',
+                  ('%' + digits, limit))
+        for (appointment_id,) in c.fetchall():
+            add(appointment_id, 'phone', 1.0)
+        c.execute('''SELECT rowid FROM appointments_fts
+                     WHERE appointments_fts MATCH ? LIMIT ?''',
+                  (f'phone_digits : {_quote(digits)}', limit))
+        for (appointment_id,) in c.fetchall():
+            add(appointment_id, 'phone', 0.8)
+
+    # Word prefix on name and notes ("jo smi" -> "John Smith")
+    words = re.findall(r'\w+', query)
+    if words:
+        match_expr = ' AND '.join(_quote(w) + '*' for w in words)
+        c.execute('''SELECT rowid, bm25(appointments_words, 10.0, 1.0) FROM appointments_words
+                     WHERE appointments_words MATCH ? ORDER BY bm25(appointments_words, 10.0, 1.0) LIMIT ?''',
+                  ('{name notes} : (' + match_expr + ')', limit))
+        for appointment_id, _rank in c.fetchall():
+            add(appointment_id, 'prefix', 0.9)
+
+    # Typo tolerance: any shared trigram makes a candidate, then rerank by similarity
+    if len(hits) < limit and len(query) >= 3:
+        grams = _trigrams(query)
+        if grams:
+            match_expr = ' OR '.join(_quote(g) for g in sorted(grams))
+            c.execute('''SELECT rowid, name FROM appointments_fts
+                         WHERE appointments_fts MATCH ? ORDER BY rank LIMIT ?''',
+                      ('name : (' + match_expr + ')', limit * 10))
+            for appointment_id, name in c.fetchall():
+                score = _similarity(query, name)
+                if score >= fuzzy_threshold:
+                    add(appointment_id, 'fuzzy', round(score * 0.85, 3))
+
+    ranked = sorted(hits.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    rows = _fetch_rows(c, [appointment_id for appointment_id, _ in ranked])
+    conn.close()
+
+    results = []
+    for appointment_id, (match, score) in ranked:
+        row = rows.get(appointment_id)
+        if not row:
+            continue
+        results.append({
+            "id": row[0],
+            "name": row[1],
+            "phone": row[2],
+            "datetime": row[3],
+            "service": row[4],
+            "notes": row[5],
+            "status": row[6],
+            "created_at": row[7],
+            "match": match,
+            "score": score
+        })
+    return results
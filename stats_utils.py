@@ -0,0 +1,170 @@
+import sqlite3
+from datetime import datetime, timedelta
+from archive_utils import archived_call_rollups
+
+# Rollup tables for the admin dashboard. They are maintained by triggers, so
+# every write path (log_call, create_appointment, the admin/status and
+# appointment update routes, deletes) keeps them current without extra code
+# in the request handlers. Reads touch a handful of rollup rows instead of
+# scanning call_logs/appointments.
+#
+# Call rollups are historical: they are never decremented when a call log is
+# removed (e.g. moved to an archive), only re-bucketed when its intent or
+# sentiment is updated. A rebuild counts call_logs plus the calls in the
+# archive index. Appointment rollups are a live snapshot.
+
+def init_stats_tables(conn):
+    """Create rollup tables and the triggers that keep them up to date"""
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS call_stats_daily (
+        day TEXT,
+        intent TEXT,
+        sentiment TEXT,
+        calls INTEGER DEFAULT 0,
+        total_duration INTEGER DEFAULT 0,
+        PRIMARY KEY (day, intent, sentiment)
+    ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS call_stats_totals (
+        intent TEXT,
+        sentiment TEXT,
+        calls INTEGER DEFAULT 0,
+        total_duration INTEGER DEFAULT 0,
+        PRIMARY KEY (intent, sentiment)
+    ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS appointment_status_counts (
+        status TEXT,
+        service TEXT,
+        appointments INTEGER DEFAULT 0,
+        PRIMARY KEY (status, service)
+    ) WITHOUT ROWID''')
+
+    c.execute('''CREATE TRIGGER IF NOT EXISTS call_stats_ai AFTER INSERT ON call_logs BEGIN
+        INSERT INTO call_stats_daily (day, intent, sentiment, calls, total_duration)
+            VALUES (date(coalesce(new.created_at, 'now')), coalesce(new.intent, 'unknown'), coalesce(new.sentiment, 'neutral'), 1, coalesce(new.duration_seconds, 0))
+            ON CONFLICT (day, intent, sentiment) DO UPDATE SET calls = calls + 1, total_duration = total_duration + excluded.total_duration;
+        INSERT INTO call_stats_totals (intent, sentiment, calls, total_duration)
+            VALUES (coalesce(new.intent, 'unknown'), coalesce(new.sentiment, 'neutral'), 1, coalesce(new.duration_seconds, 0))
+            ON CONFLICT (intent, sentiment) DO UPDATE SET calls = calls + 1, total_duration = total_duration + excluded.total_duration;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS call_stats_au AFTER UPDATE OF intent, sentiment, duration_seconds ON call_logs BEGIN
+        UPDATE call_stats_daily SET calls = calls - 1, total_duration = total_duration - coalesce(old.duration_seconds, 0)
+            WHERE day = date(coalesce(old.created_at, 'now')) AND intent = coalesce(old.intent, 'unknown') AND sentiment = coalesce(old.sentiment, 'neutral');
+        UPDATE call_stats_totals SET calls = calls - 1, total_duration = total_duration - coalesce(old.duration_seconds, 0)
+            WHERE intent = coalesce(old.intent, 'unknown') AND sentiment = coalesce(old.sentiment, 'neutral');
+        INSERT INTO call_stats_daily (day, intent, sentiment, calls, total_duration)
+            VALUES (date(coalesce(new.created_at, 'now')), coalesce(new.intent, 'unknown'), coalesce(new.sentiment, 'neutral'), 1, coalesce(new.duration_seconds, 0))
+            ON CONFLICT (day, intent, sentiment) DO UPDATE SET calls = calls + 1, total_duration = total_duration + excluded.total_duration;
+        INSERT INTO call_stats_totals (intent, sentiment, calls, total_duration)
+            VALUES (coalesce(new.intent, 'unknown'), coalesce(new.sentiment, 'neutral'), 1, coalesce(new.duration_seconds, 0))
+            ON CONFLICT (intent, sentiment) DO UPDATE SET calls = calls + 1, total_duration = total_duration + excluded.total_duration;
+    END''')
+
+    c.execute('''CREATE TRIGGER IF NOT EXISTS appointment_stats_ai AFTER INSERT ON appointments BEGIN
+        INSERT INTO appointment_status_counts (status, service, appointments)
+            VALUES (coalesce(new.status, 'scheduled'), coalesce(new.service, ''), 1)
+            ON CONFLICT (status, service) DO UPDATE SET appointments = appointments + 1;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS appointment_stats_au AFTER UPDATE OF status, service ON appointments BEGIN
+        UPDATE appointment_status_counts SET appointments = appointments - 1
+            WHERE status = coalesce(old.status, 'scheduled') AND service = coalesce(old.service, '');
+        INSERT INTO appointment_status_counts (status, service, appointments)
+            VALUES (coalesce(new.status, 'scheduled'), coalesce(new.service, ''), 1)
+            ON CONFLICT (status, service) DO UPDATE SET appointments = appointments + 1;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS appointment_stats_ad AFTER DELETE ON appointments BEGIN
+        UPDATE appointment_status_counts SET appointments = appointments - 1
+            WHERE status = coalesce(old.status, 'scheduled') AND service = coalesce(old.service, '');
+    END''')
+
+    # Backfill once when history predates the rollup tables
+    c.execute('''SELECT (SELECT COUNT(*) FROM call_stats_totals) = 0 AND EXISTS (SELECT 1 FROM call_logs),
+                        (SELECT COUNT(*) FROM appointment_status_counts) = 0 AND EXISTS (SELECT 1 FROM appointments)''')
+    calls_missing, appointments_missing = c.fetchone()
+    if calls_missing or appointments_missing:
+        backfill_rollups(conn)
+
+def backfill_rollups(conn=None):
+    """Rebuild every rollup table from call_logs (plus archived calls) and appointments in one transaction"""
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+    c.execute('DELETE FROM call_stats_daily')
+    c.execute('DELETE FROM call_stats_totals')
+    c.execute('DELETE FROM appointment_status_counts')
+    c.execute('''INSERT INTO call_stats_daily (day, intent, sentiment, calls, total_duration)
+                 SELECT date(coalesce(created_at, 'now')), coalesce(intent, 'unknown'), coalesce(sentiment, 'neutral'),
+                        COUNT(*), coalesce(SUM(duration_seconds), 0)
+                 FROM call_logs GROUP BY 1, 2, 3''')
+    c.executemany('''INSERT INTO call_stats_daily (day, intent, sentiment, calls, total_duration) VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT (day, intent, sentiment) DO UPDATE SET calls = calls + excluded.calls,
+                         total_duration = total_duration + excluded.total_duration''', archived_call_rollups(conn))
+    c.execute('''INSERT INTO call_stats_totals (intent, sentiment, calls, total_duration)
+                 SELECT intent, sentiment, SUM(calls), SUM(total_duration)
+                 FROM call_stats_daily GROUP BY intent, sentiment''')
+    c.execute('''INSERT INTO appointment_status_counts (status, service, appointments)
+                 SELECT coalesce(status, 'scheduled'), coalesce(service, ''), COUNT(*)
+                 FROM appointments GROUP BY 1, 2''')
+    if own_conn:
+        conn.commit()
+        conn.close()
+
+def get_dashboard_stats(days=7):
+    """Dashboard counters read from the rollup tables only"""
+    conn = sqlite3.connect('appointments.db')
+    c = conn.cursor()
+
+    today = datetime.utcnow().date()
+    since = (today - timedelta(days=days - 1)).isoformat()
+
+    c.execute('''SELECT day, SUM(calls), SUM(total_duration) FROM call_stats_daily
+                 WHERE day >= ? GROUP BY day ORDER BY day''', (since,))
+    calls_by_day = [
+        {"day": row[0], "calls": row[1], "total_duration": row[2]}
+        for row in c.fetchall()
+    ]
+
+    c.execute('SELECT intent, sentiment, calls, total_duration FROM call_stats_totals WHERE calls > 0')
+    by_intent = {}
+    by_sentiment = {}
+    total_calls = 0
+    total_duration = 0
+    for intent, sentiment, calls, duration in c.fetchall():
+        by_intent[intent] = by_intent.get(intent, 0) + calls
+        by_sentiment[sentiment] = by_sentiment.get(sentiment, 0) + calls
+        total_calls += calls
+        total_duration += duration
+
+    c.execute('SELECT status, service, appointments FROM appointment_status_counts WHERE appointments > 0')
+    by_status = {}
+    by_service = {}
+    status_service = []
+    total_appointments = 0
+    for status, service, count in c.fetchall():
+        by_status[status] = by_status.get(status, 0) + count
+        by_service[service or 'General'] = by_service.get(service or 'General', 0) + count
+        status_service.append({"status": status, "service": service, "appointments": count})
+        total_appointments += count
+    conn.close()
+
+    calls_today = next((d["calls"] for d in calls_by_day if d["day"] == today.isoformat()), 0)
+    return {
+        "appointments": {
+            "total": total_appointments,
+            "by_status": by_status,
+            "by_service": by_service,
+            "by_status_service": status_service
+        },
+        "calls": {
+            "total": total_calls,
+            "today": calls_today,
+            "avg_duration_seconds": round(total_duration / total_calls, 1) if total_calls else 0,
+            "by_intent": by_intent,
+            "by_sentiment": by_sentiment,
+            "by_day": calls_by_day
+        }
+    }
+
+if __name__ == '__main__':
+    backfill_rollups()
+    print("Rollup tables rebuilt")
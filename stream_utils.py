@@ -0,0 +1,306 @@
+import asyncio
+import base64
+import json
+import xml.etree.ElementTree as ET
+from functools import partial
+import numpy as np
+
+# Twilio Media Streams support: caller audio arrives as base64 8 kHz mu-law
+# frames (20 ms each) over a WebSocket. Frames are decoded, run through a
+# simple energy VAD, and speech is transcribed in chunks while the caller is
+# still talking, so only the last chunk is left to transcribe when they stop.
+
+TWILIO_SAMPLE_RATE = 8000
+WHISPER_SAMPLE_RATE = 16000
+FRAME_MS = 20
+
+def _mulaw_table():
+    codes = np.arange(256, dtype=np.int32)
+    u = ~codes & 0xFF
+    sign = u & 0x80
+    exponent = (u >> 4) & 0x07
+    mantissa = u & 0x0F
+    magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    return np.where(sign, -magnitude, magnitude).astype(np.int16)
+
+MULAW_TO_PCM16 = _mulaw_table()
+
+def mulaw_decode(data):
+    """mu-law bytes -> int16 samples"""
+    return MULAW_TO_PCM16[np.frombuffer(data, dtype=np.uint8)]
+
+def mulaw_encode(samples):
+    """int16 samples -> mu-law bytes (used by the replay client)"""
+    x = np.clip(samples.astype(np.int32), -32635, 32635)
+    sign = np.where(x < 0, 0x80, 0)
+    x = np.abs(x) + 0x84
+    exponent = np.floor(np.log2(x)).astype(np.int32) - 7
+    exponent = np.clip(exponent, 0, 7)
+    mantissa = (x >> (exponent + 3)) & 0x0F
+    return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+def _lowpass(samples, cutoff, rate):
+    """Windowed-sinc FIR low-pass, zero phase, for anti-aliasing before decimation"""
+    # Hamming transition band is about 3.3 * rate / taps wide; keep it within
+    # the top fifth of the target band so nothing above the new Nyquist leaks in
+    taps = int(np.ceil(3.3 * rate / (0.2 * cutoff))) | 1
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = np.sinc(2 * cutoff / rate * n) * np.hamming(taps)
+    kernel /= kernel.sum()
+    return np.convolve(samples, kernel, mode='same')
+
+def resample(samples, from_rate, to_rate):
+    """Resample a float32 signal, low-pass filtering first when downsampling"""
+    if from_rate == to_rate or len(samples) == 0:
+        return samples.astype(np.float32)
+    if to_rate < from_rate:
+        samples = _lowpass(samples, 0.45 * to_rate, from_rate)
+    duration = len(samples) / from_rate
+    target = np.arange(int(duration * to_rate)) / to_rate
+    source = np.arange(len(samples)) / from_rate
+    return np.interp(target, source, samples).astype(np.float32)
+
+class EnergyVAD:
+    """Frame-level speech detector with an adaptive noise floor"""
+
+    def __init__(self, threshold_ratio=3.0, min_rms=0.01, noise_adapt=0.05):
+        self.threshold_ratio = threshold_ratio
+        self.min_rms = min_rms
+        self.noise_adapt = noise_adapt
+        self.noise_floor = min_rms / threshold_ratio
+
+    def is_speech(self, frame):
+        rms = float(np.sqrt(np.mean(frame * frame))) if len(frame) else 0.0
+        speech = rms > max(self.noise_floor * self.threshold_ratio, self.min_rms)
+        if not speech:
+            self.noise_floor += self.noise_adapt * (rms - self.noise_floor)
+        return speech
+
+class UtteranceSegmenter:
+    """Groups VAD frames into utterances and cuts long speech into chunks.
+
+    push() returns a list of events: ('chunk', samples) for a completed piece
+    of an ongoing utterance and ('end', samples) for its final piece.
+    Samples are float32 at the input sample rate.
+    """
+
+    def __init__(self, sample_rate=TWILIO_SAMPLE_RATE, start_frames=3, end_silence_ms=600,
+                 preroll_ms=200, chunk_seconds=3.0, max_utterance_seconds=20.0, vad=None):
+        self.sample_rate = sample_rate
+        self.vad = vad or EnergyVAD()
+        self.start_frames = start_frames
+        self.end_frames = max(1, end_silence_ms // FRAME_MS)
+        self.preroll_frames = max(1, preroll_ms // FRAME_MS)
+        self.chunk_samples = int(chunk_seconds * sample_rate)
+        self.max_samples = int(max_utterance_seconds * sample_rate)
+        self.reset()
+
+    def reset(self):
+        self.in_speech = False
+        self.frames = []          # frames of the current chunk
+        self.frame_speech = []    # VAD decision per frame in self.frames
+        self.preroll = []
+        self.speech_run = 0
+        self.silence_run = 0
+        self.utterance_samples = 0
+
+    def _take_chunk(self, upto=None):
+        upto = len(self.frames) if upto is None else upto
+        samples = np.concatenate(self.frames[:upto]) if upto else np.zeros(0, dtype=np.float32)
+        self.frames = self.frames[upto:]
+        self.frame_speech = self.frame_speech[upto:]
+        return samples
+
+    def push(self, frame):
+        events = []
+        speech = self.vad.is_speech(frame)
+
+        if not self.in_speech:
+            self.preroll.append(frame)
+            self.preroll = self.preroll[-self.preroll_frames:]
+            self.speech_run = self.speech_run + 1 if speech else 0
+            if self.speech_run >= self.start_frames:
+                self.in_speech = True
+                self.frames = list(self.preroll)
+                self.frame_speech = [True] * len(self.frames)
+                self.utterance_samples = sum(len(f) for f in self.frames)
+                self.preroll = []
+                self.silence_run = 0
+            return events
+
+        self.frames.append(frame)
+        self.frame_speech.append(speech)
+        self.utterance_samples += len(frame)
+        self.silence_run = 0 if speech else self.silence_run + 1
+
+        if self.silence_run >= self.end_frames or self.utterance_samples >= self.max_samples:
+            # Drop the trailing silence that ended the utterance
+            keep = max(0, len(self.frames) - self.silence_run)
+            events.append(('end', self._take_chunk(keep)))
+            self.reset()
+            return events
+
+        if sum(len(f) for f in self.frames) >= self.chunk_samples:
+            # Cut at the last non-speech frame in the second half of the chunk
+            # so words are not split across chunks when the caller pauses.
+            cut = len(self.frames)
+            half = len(self.frames) // 2
+            for i in range(len(self.frames) - 1, half, -1):
+                if not self.frame_speech[i]:
+                    cut = i + 1
+                    break
+            events.append(('chunk', self._take_chunk(cut)))
+        return events
+
+    def flush(self):
+        """Finish any utterance in progress (e.g. when the stream stops)"""
+        if not self.in_speech or not self.frames:
+            self.reset()
+            return []
+        samples = self._take_chunk()
+        self.reset()
+        return [('end', samples)]
+
+class MediaStreamSession:
+    """State for one Twilio Media Stream connection.
+
+    transcribe(samples_16k, prompt=...) is a blocking function; it runs in the
+    default executor, one chunk at a time, with the previous chunk's text as
+    the prompt.
+    """
+
+    def __init__(self, transcribe, **segmenter_kwargs):
+        self.transcribe = transcribe
+        self.segmenter = UtteranceSegmenter(**segmenter_kwargs)
+        self.call_sid = None
+        self.stream_sid = None
+        self.parameters = {}
+        self.chunk_tasks = []
+
+    def _schedule(self, samples):
+        loop = asyncio.get_running_loop()
+        previous = self.chunk_tasks[-1] if self.chunk_tasks else None
+        audio = resample(samples, self.segmenter.sample_rate, WHISPER_SAMPLE_RATE)
+
+        async def run():
+            # Chained: wait for the earlier chunks, then use their text as the prompt
+            earlier = await previous if previous else ''
+            text = await loop.run_in_executor(None, partial(self.transcribe, audio, prompt=earlier or None))
+            return f"{earlier} {text or ''}".strip()
+        self.chunk_tasks.append(asyncio.ensure_future(run()))
+
+    async def _finish_utterance(self):
+        if not self.chunk_tasks:
+            return None
+        tasks, self.chunk_tasks = self.chunk_tasks, []
+        try:
+            text = await tasks[-1]
+        except Exception as e:
+            print(f"[Media Stream] Transcription error: {e}")
+            return None
+        return text or None
+
+    async def handle_message(self, message):
+        """Process one Media Streams message; returns finished utterance texts"""
+        event = message.get('event')
+        utterances = []
+        if event == 'start':
+            start = message.get('start', {})
+            self.call_sid = start.get('callSid')
+            self.stream_sid = start.get('streamSid') or message.get('streamSid')
+            self.parameters = start.get('customParameters', {}) or {}
+        elif event == 'media':
+            media = message.get('media', {})
+            if media.get('track', 'inbound') != 'inbound':
+                return utterances
+            pcm = mulaw_decode(base64.b64decode(media.get('payload', '')))
+            frame = pcm.astype(np.float32) / 32768.0
+            for kind, samples in self.segmenter.push(frame):
+                if len(samples):
+                    self._schedule(samples)
+                if kind == 'end':
+                    text = await self._finish_utterance()
+                    if text:
+                        utterances.append(text)
+        elif event == 'stop':
+            for kind, samples in self.segmenter.flush():
+                if len(samples):
+                    self._schedule(samples)
+            text = await self._finish_utterance()
+            if text:
+                utterances.append(text)
+        return utterances
+
+def twiml_for_stream(twiml, stream_url, parameters=None):
+    """Rewrite dialog TwiML so the caller's reply is streamed instead of gathered.
+
+    A <Gather> is replaced by its <Say> children (dropping its no-input
+    fallback) and, unless the call is hanging up, a <Connect><Stream> is
+    appended to resume streaming.
+    """
+    root = ET.fromstring(twiml)
+    flattened = []
+    for verb in list(root):
+        if verb.tag == 'Gather':
+            flattened.extend(list(verb))
+            # Verbs after a <Gather> are its no-input fallback; the stream replaces them
+            break
+        flattened.append(verb)
+    for verb in list(root):
+        root.remove(verb)
+    for verb in flattened:
+        root.append(verb)
+    if root.find('Hangup') is None:
+        connect = ET.SubElement(root, 'Connect')
+        stream = ET.SubElement(connect, 'Stream', url=stream_url)
+        for name, value in (parameters or {}).items():
+            if value is not None:
+                ET.SubElement(stream, 'Parameter', name=name, value=str(value))
+    return '<?xml version="1.0" encoding="UTF-8"?>' + ET.tostring(root, encoding='unicode')
+
+async def replay_wav(path, url, from_number='+15550000000', realtime=True):
+    """Stream a WAV file to a media-stream endpoint the way Twilio does and print replies"""
+    import wave
+    import websockets
+
+    with wave.open(path, 'rb') as wav:
+        rate = wav.getframerate()
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        raw = wav.readframes(wav.getnframes())
+    if width != 2:
+        raise ValueError("replay expects 16-bit PCM WAV files")
+    samples = np.frombuffer(raw, dtype=np.int16).reshape(-1, channels).mean(axis=1)
+    samples = resample(samples.astype(np.float32), rate, TWILIO_SAMPLE_RATE)
+    # Trailing silence so the VAD sees the end of the last utterance
+    samples = np.concatenate([samples, np.zeros(TWILIO_SAMPLE_RATE, dtype=np.float32)])
+    payload = mulaw_encode(samples)
+    frame_bytes = TWILIO_SAMPLE_RATE * FRAME_MS // 1000
+
+    async with websockets.connect(url) as ws:
+        await ws.send(json.dumps({"event": "connected", "protocol": "Call", "version": "1.0.0"}))
+        await ws.send(json.dumps({"event": "start", "streamSid": "MZreplay", "start": {
+            "streamSid": "MZreplay", "callSid": "CAreplay",
+            "customParameters": {"from": from_number, "replay": "1"}
+        }}))
+
+        async def receive():
+            async for reply in ws:
+                print(reply)
+
+        receiver = asyncio.ensure_future(receive())
+        for i in range(0, len(payload), frame_bytes):
+            await ws.send(json.dumps({"event": "media", "streamSid": "MZreplay", "media": {
+                "track": "inbound", "chunk": str(i // frame_bytes), "timestamp": str(i // 8),
+                "payload": base64.b64encode(payload[i:i + frame_bytes]).decode('ascii')
+            }}))
+            if realtime:
+                await asyncio.sleep(FRAME_MS / 1000)
+        await ws.send(json.dumps({"event": "stop", "streamSid": "MZreplay"}))
+        await asyncio.sleep(2)
+        receiver.cancel()
+
+if __name__ == '__main__':
+    # Usage: python stream_utils.py recording.wav ws://localhost:8000/twilio/media-stream
+    import sys
+    asyncio.run(replay_wav(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'ws://localhost:8000/twilio/media-stream'))
@@ -1,5 +1,12 @@
 from TTS.api import TTS
 import os
+import re
+import queue
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
 
 tts_models = {
     'en': 'tts_models/en/vctk/vits',
@@ -9,8 +16,157 @@ tts_models = {
     'xtts': 'tts_models/multilingual/xtts_v2',
 }
 
+# Voice for multi-speaker models (e.g. a VCTK id such as 'p225'); the model's first speaker otherwise
+TTS_SPEAKER = os.getenv('TTS_SPEAKER')
+
+# Loaded models, shared by every request (loading takes seconds)
+_tts_cache = {}
+_tts_locks = {}
+_cache_lock = threading.Lock()
+
+def get_tts(model_name):
+    with _cache_lock:
+        if model_name not in _tts_cache:
+            _tts_cache[model_name] = TTS(model_name)
+            _tts_locks[model_name] = threading.Lock()
+        return _tts_cache[model_name], _tts_locks[model_name]
+
+def _voice_args(tts, language):
+    # Coqui rejects `language` for single-language models and needs a `speaker` for multi-speaker ones
+    args = {}
+    if tts.is_multi_lingual:
+        languages = tts.languages or []
+        args['language'] = language if not languages or language in languages else languages[0]
+    if tts.is_multi_speaker:
+        speakers = tts.speakers or []
+        args['speaker'] = TTS_SPEAKER if TTS_SPEAKER in speakers else (speakers[0] if speakers else TTS_SPEAKER)
+    return args
+
 def coqui_tts(text, language='en', out_path='output.wav', model_key=None):
     model_name = tts_models.get(model_key or language, tts_models['en'])
-    tts = TTS(model_name)
-    tts.tts_to_file(text=text, file_path=out_path, speaker_wav=None, language=language)
-    return out_path 
\ No newline at end of file
+    tts, lock = get_tts(model_name)
+    with lock:
+        tts.tts_to_file(text=text, file_path=out_path, **_voice_args(tts, language))
+    return out_path
+
+# --- Sentence-pipelined synthesis ---
+# The LLM reply is consumed as a stream; each complete sentence is queued and
+# synthesized to its own clip by a second thread while the LLM keeps
+# generating, so the first clip is playable long before the reply is done.
+
+SENTENCE_END = re.compile(r'[.!?]+(?=\s)|\n')
+TTS_OUTPUT_DIR = os.getenv('TTS_OUTPUT_DIR', 'tts_output')
+MAX_SPEECH_REPLIES = 200
+
+speech_replies = OrderedDict()
+_replies_lock = threading.Lock()
+
+def iter_sentences(chunks):
+    # chunks: any iterable of text pieces (e.g. streamed LLM tokens)
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            match = SENTENCE_END.search(buffer)
+            if not match:
+                break
+            sentence = buffer[:match.end()].strip()
+            buffer = buffer[match.end():]
+            if sentence:
+                yield sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+class SpeechReply:
+    """Clips of one pipelined reply, published as soon as each is synthesized"""
+
+    def __init__(self, reply_id, out_dir):
+        self.id = reply_id
+        self.out_dir = out_dir
+        self.clips = []
+        self.sentences = []
+        self.done = False
+        self.error = None
+        self.started_at = time.time()
+        self.first_clip_seconds = None
+        self.condition = threading.Condition()
+
+    def add_clip(self, path, sentence):
+        with self.condition:
+            if self.first_clip_seconds is None:
+                self.first_clip_seconds = round(time.time() - self.started_at, 3)
+            self.clips.append(path)
+            self.sentences.append(sentence)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = self.error or error
+            self.condition.notify_all()
+
+    def wait_for_clip(self, index, timeout=30):
+        # Path of clip `index`, or None once the reply finished without it (or on timeout)
+        deadline = time.time() + timeout
+        with self.condition:
+            while index >= len(self.clips) and not self.done:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.clips[index] if index < len(self.clips) else None
+
+    @property
+    def text(self):
+        return ' '.join(self.sentences)
+
+def _register_reply(reply):
+    with _replies_lock:
+        speech_replies[reply.id] = reply
+        while len(speech_replies) > MAX_SPEECH_REPLIES:
+            _, old = speech_replies.popitem(last=False)
+            shutil.rmtree(old.out_dir, ignore_errors=True)
+
+def start_speech_reply(text_chunks, language='en', model_key=None, transform=None, max_sentences=None, synthesize=None):
+    """Start synthesizing a streamed reply sentence by sentence; returns a SpeechReply immediately"""
+    synthesize = synthesize or coqui_tts
+    reply_id = uuid.uuid4().hex
+    reply = SpeechReply(reply_id, os.path.join(TTS_OUTPUT_DIR, reply_id))
+    os.makedirs(reply.out_dir, exist_ok=True)
+    _register_reply(reply)
+    sentences = queue.Queue()
+
+    def produce():
+        try:
+            for i, sentence in enumerate(iter_sentences(text_chunks)):
+                if max_sentences and i >= max_sentences:
+                    break
+                sentences.put(transform(sentence) if transform else sentence)
+        except Exception as e:
+            print(f"[TTS Pipeline] Text stream error: {e}")
+            reply.error = str(e)
+        finally:
+            # Stop the upstream generator (closes the LLM connection early)
+            if hasattr(text_chunks, 'close'):
+                text_chunks.close()
+            sentences.put(None)
+
+    def synthesize_loop():
+        index = 0
+        try:
+            while True:
+                sentence = sentences.get()
+                if sentence is None:
+                    break
+                path = os.path.join(reply.out_dir, f'{index}.wav')
+                synthesize(sentence, language=language, out_path=path, model_key=model_key)
+                reply.add_clip(path, sentence)
+                index += 1
+            reply.finish()
+        except Exception as e:
+            print(f"[TTS Pipeline] Synthesis error: {e}")
+            reply.finish(str(e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    threading.Thread(target=synthesize_loop, daemon=True).start()
+    return reply 
\ No newline at end of file
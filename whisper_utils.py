@@ -1,16 +1,60 @@
 import whisper
 import torch
 from transformers import pipeline
+from audio_utils import decode_audio, split_on_silence, SAMPLE_RATE
 
 # Load the base model once
 model = whisper.load_model('base')
 
+# wav2vec2 pipelines are built once per model name
+_asr_pipelines = {}
+
+def _get_asr(model_name):
+    if model_name not in _asr_pipelines:
+        _asr_pipelines[model_name] = pipeline('automatic-speech-recognition', model=model_name)
+    return _asr_pipelines[model_name]
+
 def whisper_transcribe(audio_path, language=None):
     # language: 'en', 'hi', 'ta', or None for auto
     result = model.transcribe(audio_path, language=language)
     return result['text'].strip()
 
 def wav2vec2_transcribe(audio_path, model_name='facebook/wav2vec2-base-960h'):
-    asr = pipeline('automatic-speech-recognition', model=model_name)
+    asr = _get_asr(model_name)
     result = asr(audio_path)
-    return result['text'].strip() 
\ No newline at end of file
+    return result['text'].strip() 
+
+def whisper_transcribe_pcm(audio, language=None, prompt=None):
+    # audio: 16 kHz mono float32 samples in [-1, 1], already in memory
+    # prompt: text of the preceding chunk, to keep chunked transcription coherent
+    result = model.transcribe(audio, language=language, initial_prompt=prompt,
+                              fp16=torch.cuda.is_available(), condition_on_previous_text=False)
+    return result['text'].strip()
+
+def whisper_transcribe_audio(audio, language=None, batch_size=8):
+    # audio: bytes, a binary buffer, a path, or 16 kHz float32 samples.
+    # Decoded in memory; recordings longer than 30 s are split at quiet
+    # points and the 30 s windows are decoded by Whisper in batches.
+    samples = decode_audio(audio)
+    chunks = split_on_silence(samples)
+    if len(chunks) <= 1:
+        return whisper_transcribe_pcm(samples, language=language)
+
+    options = whisper.DecodingOptions(language=language, fp16=torch.cuda.is_available(), without_timestamps=True)
+    texts = []
+    for i in range(0, len(chunks), batch_size):
+        batch = chunks[i:i + batch_size]
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(chunk)), n_mels=model.dims.n_mels)
+            for chunk in batch
+        ]).to(model.device)
+        results = whisper.decode(model, mel, options)
+        texts.extend(r.text.strip() for r in results)
+    return ' '.join(t for t in texts if t).strip()
+
+def wav2vec2_transcribe_audio(audio, model_name='facebook/wav2vec2-base-960h', batch_size=8):
+    # Same inputs as whisper_transcribe_audio; the pipeline chunks and batches long audio itself
+    samples = decode_audio(audio)
+    asr = _get_asr(model_name)
+    result = asr({'raw': samples, 'sampling_rate': SAMPLE_RATE}, chunk_length_s=30, batch_size=batch_size)
+    return result['text'].strip()
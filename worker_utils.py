@@ -0,0 +1,301 @@
+import asyncio
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+# Model worker pools. CPU-bound inference (Whisper, Coqui TTS, local
+# classifiers) runs in separate processes so it never holds the web
+# worker's GIL. Models are loaded in the parent first and the workers are
+# forked afterwards, so the weights are shared copy-on-write instead of
+# being loaded once per process.
+#
+# Each pool has its own process count (its concurrency limit) and a cap on
+# queued jobs; submitting to a full pool raises ModelWorkerBusy so callers
+# can shed load instead of queueing without bound. A job keeps its slot
+# until a worker reports it, even if the caller gave up waiting, so
+# abandoned jobs still count against the cap. Crashed workers are
+# replaced and the job they were running fails with ModelWorkerError.
+#
+# Fork is required for the shared weights, so this is for CPU inference on
+# Linux; CUDA contexts do not survive a fork.
+
+MODEL_WORKERS_ENABLED = os.getenv('MODEL_WORKERS', '0') == '1'
+
+class ModelWorkerError(Exception):
+    """A job failed inside a worker process (or the worker died)"""
+
+class ModelWorkerBusy(Exception):
+    """The pool's queue is full"""
+
+def _worker_main(index, jobs, results, handlers, current):
+    # Runs in the forked child: no asyncio, no web server state is touched
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except Exception:
+        pass
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, job_type, args, kwargs = job
+        # Shared memory rather than the results queue, so the parent still
+        # knows which job was running if this process dies mid-job
+        current[index] = job_id
+        try:
+            result = handlers[job_type](*args, **kwargs)
+            results.put((job_id, True, result))
+        except Exception as e:
+            results.put((job_id, False, f"{type(e).__name__}: {e}"))
+        current[index] = 0
+
+class ModelWorkerPool:
+    """A fixed set of worker processes serving typed jobs from one queue"""
+
+    def __init__(self, name, handlers, processes=1, max_pending=32, job_timeout=120):
+        self.name = name
+        self.handlers = handlers
+        self.processes = processes
+        self.max_pending = max_pending
+        self.job_timeout = job_timeout
+        self.context = multiprocessing.get_context('fork')
+        self.jobs = self.context.Queue()
+        self.results = self.context.Queue()
+        self.workers = {}
+        self.current = self.context.Array('q', processes, lock=False)
+        self.futures = {}
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.restarts = 0
+        self.completed = 0
+        self.failed = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for index in range(self.processes):
+            self._spawn(index)
+        threading.Thread(target=self._read_results, daemon=True, name=f"{self.name}-results").start()
+        threading.Thread(target=self._monitor, daemon=True, name=f"{self.name}-monitor").start()
+
+    def _spawn(self, index):
+        process = self.context.Process(
+            target=_worker_main, args=(index, self.jobs, self.results, self.handlers, self.current),
+            name=f"{self.name}-worker-{index}", daemon=True
+        )
+        process.start()
+        self.workers[index] = process
+
+    def _resolve(self, job_id, ok, payload):
+        # The worker is done with the job: free its slot even if nobody is waiting any more
+        with self.lock:
+            future = self.futures.pop(job_id, None)
+        if future is None:
+            return
+        self.slots.release()
+        if future.done():
+            return
+        if ok:
+            self.completed += 1
+            future.set_result(payload)
+        else:
+            self.failed += 1
+            future.set_exception(ModelWorkerError(payload))
+
+    def _read_results(self):
+        while self.running:
+            try:
+                message = self.results.get(timeout=1)
+            except Exception:
+                continue
+            self._resolve(*message)
+
+    def _monitor(self):
+        while self.running:
+            time.sleep(0.5)
+            for index, process in list(self.workers.items()):
+                if process.is_alive() or not self.running:
+                    continue
+                job_id = self.current[index]
+                self.current[index] = 0
+                print(f"[Model Workers] {process.name} exited with code {process.exitcode}; restarting")
+                if job_id:
+                    self._resolve(job_id, False, f"worker crashed (exit code {process.exitcode})")
+                self.restarts += 1
+                self._spawn(index)
+
+    def submit(self, job_type, *args, **kwargs):
+        """Queue a job; returns a concurrent.futures.Future"""
+        if job_type not in self.handlers:
+            raise ValueError(f"{self.name} pool has no '{job_type}' handler")
+        if not self.slots.acquire(blocking=False):
+            raise ModelWorkerBusy(f"{self.name} pool is at capacity ({self.max_pending} jobs)")
+        job_id = next(self.ids)
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.futures[job_id] = future
+        self.jobs.put((job_id, job_type, args, kwargs))
+        return future
+
+    def call(self, job_type, *args, **kwargs):
+        """Run a job and wait for its result (for use from threads)"""
+        future = self.submit(job_type, *args, **kwargs)
+        try:
+            return future.result(timeout=self.job_timeout)
+        except concurrent.futures.TimeoutError:
+            # Only the wait ends here; the slot is held until the worker reports the job
+            raise ModelWorkerError(f"{job_type} job timed out after {self.job_timeout}s")
+
+    async def run(self, job_type, *args, **kwargs):
+        """Run a job without blocking the event loop"""
+        future = self.submit(job_type, *args, **kwargs)
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=self.job_timeout)
+        except asyncio.TimeoutError:
+            raise ModelWorkerError(f"{job_type} job timed out after {self.job_timeout}s")
+
+    def stats(self):
+        with self.lock:
+            pending = len(self.futures)
+        busy = sum(1 for job_id in self.current if job_id)
+        return {
+            "processes": self.processes,
+            "alive": sum(1 for p in self.workers.values() if p.is_alive()),
+            "busy": busy,
+            "pending": pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "restarts": self.restarts
+        }
+
+    def stop(self):
+        self.running = False
+        for _ in self.workers:
+            self.jobs.put(None)
+        for process in self.workers.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        with self.lock:
+            futures, self.futures = list(self.futures.values()), {}
+        for future in futures:
+            self.slots.release()
+            if not future.done():
+                future.set_exception(ModelWorkerError(f"{self.name} pool stopped"))
+
+# --- Job handlers (run inside the worker processes) ---
+
+def _transcribe(audio, language=None):
+    from whisper_utils import whisper_transcribe_audio
+    return whisper_transcribe_audio(audio, language=language)
+
+def _transcribe_pcm(audio, language=None, prompt=None):
+    from whisper_utils import whisper_transcribe_pcm
+    return whisper_transcribe_pcm(audio, language=language, prompt=prompt)
+
+def _synthesize(text, language='en', out_path='output.wav', model_key=None):
+    from tts_utils import coqui_tts
+    return coqui_tts(text, language=language, out_path=out_path, model_key=model_key)
+
+def _transcribe_wav2vec2(audio):
+    from whisper_utils import wav2vec2_transcribe_audio
+    return wav2vec2_transcribe_audio(audio)
+
+def _classify(text, task='intent'):
+    from hf_utils import local_intent_classification, local_sentiment_analysis
+    if task == 'sentiment':
+        return local_sentiment_analysis(text)
+    return local_intent_classification(text)
+
+model_pools = {}
+
+def start_model_workers():
+    """Load models in this process, then fork the worker pools"""
+    import whisper_utils  # noqa: F401  (loads the Whisper model)
+    from tts_utils import get_tts, tts_models
+    from hf_utils import load_local_classifiers
+
+    get_tts(tts_models['en'])
+    if os.getenv('PRELOAD_WAV2VEC2', '0') == '1':
+        # Otherwise each transcribe worker loads wav2vec2 on its first request
+        whisper_utils._get_asr('facebook/wav2vec2-base-960h')
+    try:
+        load_local_classifiers()
+    except Exception as e:
+        print(f"[Model Workers] Local classifiers not loaded: {e}")
+
+    model_pools['transcribe'] = ModelWorkerPool(
+        'transcribe', {'transcribe': _transcribe, 'transcribe_pcm': _transcribe_pcm,
+                       'transcribe_wav2vec2': _transcribe_wav2vec2},
+        processes=int(os.getenv('TRANSCRIBE_WORKERS', '2')),
+        max_pending=int(os.getenv('TRANSCRIBE_MAX_PENDING', '32'))
+    )
+    model_pools['synthesize'] = ModelWorkerPool(
+        'synthesize', {'synthesize': _synthesize},
+        processes=int(os.getenv('TTS_WORKERS', '1')),
+        max_pending=int(os.getenv('TTS_MAX_PENDING', '32'))
+    )
+    model_pools['classify'] = ModelWorkerPool(
+        'classify', {'classify': _classify},
+        processes=int(os.getenv('CLASSIFY_WORKERS', '1')),
+        max_pending=int(os.getenv('CLASSIFY_MAX_PENDING', '64')),
+        job_timeout=30
+    )
+    for pool in model_pools.values():
+        pool.start()
+
+def stop_model_workers():
+    for pool in model_pools.values():
+        pool.stop()
+    model_pools.clear()
+
+def get_pool(name):
+    """The named pool, or None when model workers are disabled"""
+    return model_pools.get(name)
+
+# --- Entry points: use a worker pool when enabled, otherwise run in-process ---
+
+def transcribe_audio(audio, language=None):
+    pool = get_pool('transcribe')
+    if pool:
+        return pool.call('transcribe', audio, language=language)
+    return _transcribe(audio, language=language)
+
+def transcribe_pcm(audio, language=None, prompt=None):
+    pool = get_pool('transcribe')
+    if pool:
+        return pool.call('transcribe_pcm', audio, language=language, prompt=prompt)
+    return _transcribe_pcm(audio, language=language, prompt=prompt)
+
+def transcribe_wav2vec2(audio):
+    pool = get_pool('transcribe')
+    if pool:
+        return pool.call('transcribe_wav2vec2', audio)
+    return _transcribe_wav2vec2(audio)
+
+def synthesize(text, language='en', out_path='output.wav', model_key=None):
+    pool = get_pool('synthesize')
+    if pool:
+        return pool.call('synthesize', text, language=language, out_path=out_path, model_key=model_key)
+    return _synthesize(text, language=language, out_path=out_path, model_key=model_key)
+
+def classify(text, task='intent'):
+    # The dialog's classifier: the local model in the worker pool, falling back to
+    # the Inference API when workers are disabled or the pool is busy or failing
+    pool = get_pool('classify')
+    if pool:
+        try:
+            return pool.call('classify', text, task=task)
+        except (ModelWorkerBusy, ModelWorkerError) as e:
+            print(f"[Model Workers] Local {task} classification unavailable, using the Inference API: {e}")
+    from hf_utils import hf_intent_classification, hf_sentiment_analysis
+    if task == 'sentiment':
+        return hf_sentiment_analysis(text)
+    return hf_intent_classification(text)